@@ -0,0 +1,272 @@
+# Copyright 2020-present, Netherlands Institute for Sound and Vision (Nanne van Noord)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##############################################################################
+
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pika
+from pika.adapters.asyncio_connection import AsyncioConnection
+from dane.handlers.RabbitMQHandler import MAX_RETRY, RETRY_INTERVAL
+from dane.errors import ResourceConnectionError
+from dane.state import ProcState
+from dane_server import codec
+from dane_server.RabbitMQPublisher import TaskMessages, message_ttl
+from dane_server.settings import get_setting
+
+logger = logging.getLogger("DANE")
+
+RETURNED = "returned"  # outcome of a publish that could not be routed
+NOT_SENT = "not sent"  # outcome of a publish while the channel was down
+
+
+class AsyncRabbitMQListener(TaskMessages):
+    """Response listener and publisher on pika's asyncio connection adapter.
+
+    Offers the same contract as RabbitMQListener (assign_callback, publish,
+    run, stop) without its global lock: the event loop consumes responses
+    and handles publisher confirms, while callbacks run on a thread pool of
+    at most `LISTENER.MAX_CONCURRENCY` at a time. Each response is acked once
+    its callback has finished. publish() may be called from any thread but
+    the event loop's, and blocks until the broker confirmed the message.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.callback = None
+        self.queue = self.config.RABBITMQ.RESPONSE_QUEUE
+        self.max_priority = get_setting(config, "QUEUE.MAX_PRIORITY", 10)
+        self.codecs = codec.codecs_from_config(config)
+        self.message_ttl = message_ttl(config)
+        self.max_concurrency = get_setting(config, "LISTENER.MAX_CONCURRENCY", 16)
+        self.publish_timeout = get_setting(config, "LISTENER.PUBLISH_TIMEOUT", 30)
+
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.max_concurrency, thread_name_prefix="DANE-callback"
+        )
+        self.connection = None
+        self.channel = None
+        self.pub_channel = None
+        self.retry = 0
+        self._ready = threading.Event()
+        self._loop_thread = None
+        self._stopped = None
+        self._semaphore = None
+        self._delivery_tag = 0
+        self._confirms = {}  # delivery tag -> (future, correlation id)
+        self._returned = set()
+
+    def assign_callback(self, callback):
+        self.callback = callback
+
+    def run(self):
+        logger.debug("Starting asyncio response queue listener")
+        self._loop_thread = threading.current_thread()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._main())
+        finally:
+            self.executor.shutdown(wait=True)
+
+    def stop(self):
+        if self._stopped is not None:
+            self.loop.call_soon_threadsafe(self._stopped.set)
+
+    async def _main(self):
+        self._stopped = asyncio.Event()
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._connect()
+        await self._stopped.wait()
+        if self.connection is not None and self.connection.is_open:
+            self.connection.close()
+
+    # connection management
+
+    def _connect(self):
+        credentials = pika.PlainCredentials(
+            self.config.RABBITMQ.USER, self.config.RABBITMQ.PASSWORD
+        )
+        self.connection = AsyncioConnection(
+            pika.ConnectionParameters(
+                credentials=credentials,
+                host=self.config.RABBITMQ.HOST,
+                port=self.config.RABBITMQ.PORT,
+            ),
+            on_open_callback=self._on_connection_open,
+            on_open_error_callback=self._on_connection_error,
+            on_close_callback=self._on_connection_closed,
+            custom_ioloop=self.loop,
+        )
+
+    def _on_connection_error(self, connection, error):
+        self.retry += 1
+        if self.retry > MAX_RETRY:
+            logger.critical("RabbitMQ connection failed, no retries left")
+            self._fail_pending(error)
+            self._stopped.set()
+            return
+        nap_time = RETRY_INTERVAL**self.retry
+        logger.warning(
+            "RabbitMQ Connection Failed. RETRYING in {} seconds".format(nap_time)
+        )
+        self.loop.call_later(nap_time, self._connect)
+
+    def _on_connection_closed(self, connection, reason):
+        self._ready.clear()
+        self.channel = self.pub_channel = None
+        self._fail_pending(reason)
+        if not self._stopped.is_set():
+            logger.warning("RabbitMQ connection closed: {}".format(reason))
+            self._on_connection_error(connection, reason)
+
+    def _on_connection_open(self, connection):
+        self.retry = 0
+        connection.channel(on_open_callback=self._on_channel_open)
+        connection.channel(on_open_callback=self._on_pub_channel_open)
+
+    def _on_channel_open(self, channel):
+        self.channel = channel
+        channel.exchange_declare(
+            exchange=self.config.RABBITMQ.EXCHANGE,
+            exchange_type="topic",
+            callback=lambda _: channel.queue_declare(
+                queue=self.queue, durable=True, callback=self._on_queue_declared
+            ),
+        )
+
+    def _on_queue_declared(self, _frame):
+        self.channel.basic_qos(
+            prefetch_count=self.max_concurrency,
+            callback=lambda _: self.channel.basic_consume(
+                self.queue, self._on_response
+            ),
+        )
+
+    def _on_pub_channel_open(self, channel):
+        self.pub_channel = channel
+        self._delivery_tag = 0
+        channel.add_on_close_callback(self._on_pub_channel_closed)
+        channel.add_on_return_callback(self._on_return)
+        channel.confirm_delivery(self._on_confirm, callback=lambda _: self._ready.set())
+
+    def _on_pub_channel_closed(self, channel, reason):
+        self._ready.clear()
+        self.pub_channel = None
+        self._fail_pending(reason)
+        # without the connection, _on_connection_closed() reconnects
+        if self.connection is not None and self.connection.is_open:
+            logger.warning("RabbitMQ publish channel closed: {}".format(reason))
+            self.connection.channel(on_open_callback=self._on_pub_channel_open)
+
+    # consuming responses
+
+    def _on_response(self, ch, method, props, body):
+        asyncio.ensure_future(self._handle_response(ch, method, props, body))
+
+    async def _handle_response(self, ch, method, props, body):
+        async with self._semaphore:
+            try:
+                response = codec.decode(
+                    memoryview(body), props.content_type, props.content_encoding
+                )
+            except ValueError:
+                logger.exception(
+                    "Dropping undecodable response for {}".format(props.correlation_id)
+                )
+            else:
+                await self.loop.run_in_executor(
+                    self.executor, self._do_callback, props.correlation_id, response
+                )
+            if ch.is_open:
+                ch.basic_ack(delivery_tag=method.delivery_tag)
+
+    def _do_callback(self, *args):
+        try:
+            return self.callback(*args)
+        except Exception:
+            logger.exception("Unhandled callback error")
+
+    # publishing tasks
+
+    def publish(self, routing_key, task, document, retry=False):
+        if threading.current_thread() is self._loop_thread:
+            raise RuntimeError("publish() would block the event loop")
+        if not self._ready.wait(self.publish_timeout):
+            raise ResourceConnectionError("Not connected to AMQ")
+
+        properties, body = self.message(task, document)
+        outcome = asyncio.run_coroutine_threadsafe(
+            self._publish(routing_key, properties, body), self.loop
+        ).result(self.publish_timeout)
+
+        if outcome == NOT_SENT:
+            if retry:
+                raise ResourceConnectionError("Not connected to AMQ")
+            # the connection dropped after it was ready, wait for the next one
+            return self.publish(routing_key, task, document, retry=True)
+        if outcome == RETURNED:
+            fail_resp = {
+                "state": ProcState.NO_ROUTE_TO_QUEUE.value,
+                "message": "Unroutable task",
+            }
+            self.callback(task._id, fail_resp)
+        elif not outcome:
+            raise ResourceConnectionError("Message was rejected by the broker")
+
+    async def _publish(self, routing_key, properties, body):
+        if self.pub_channel is None or not self.pub_channel.is_open:
+            # closed, but its close callback has not run yet
+            self._ready.clear()
+            return NOT_SENT
+        future = self.loop.create_future()
+        self._delivery_tag += 1
+        self._confirms[self._delivery_tag] = (future, properties.correlation_id)
+        self.pub_channel.basic_publish(
+            exchange=self.config.RABBITMQ.EXCHANGE,
+            routing_key=routing_key,
+            properties=properties,
+            mandatory=True,
+            body=body,
+        )
+        return await future
+
+    def _on_return(self, channel, method, props, body):
+        # a Basic.Return always arrives before the confirm of the same message
+        self._returned.add(props.correlation_id)
+
+    def _on_confirm(self, frame):
+        acked = isinstance(frame.method, pika.spec.Basic.Ack)
+        tag = frame.method.delivery_tag
+        if frame.method.multiple:
+            tags = [t for t in self._confirms if t <= tag]
+        else:
+            tags = [tag] if tag in self._confirms else []
+        for t in tags:
+            future, correlation_id = self._confirms.pop(t)
+            if correlation_id in self._returned:
+                self._returned.discard(correlation_id)
+                outcome = RETURNED
+            else:
+                outcome = acked
+            if not future.done():
+                future.set_result(outcome)
+
+    def _fail_pending(self, error):
+        for future, _ in self._confirms.values():
+            if not future.done():
+                future.set_exception(ResourceConnectionError(str(error)))
+        self._confirms = {}
+        self._returned = set()
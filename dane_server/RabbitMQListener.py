@@ -13,24 +13,51 @@
 # limitations under the License.
 ##############################################################################
 
-import pika
-import json
-import threading
+import functools
 import logging
-from dane.handlers import RabbitMQHandler
+import time
 from dane.errors import ResourceConnectionError
+from dane_server import codec
+from dane_server.dedup import ResponseDeduplicator
+from dane_server.executor import KeyedExecutor
+from dane_server.RabbitMQPublisher import RabbitMQPublisher
+from dane_server.settings import get_setting
 
 logger = logging.getLogger("DANE")
 
 
-class RabbitMQListener(RabbitMQHandler):
-
-    internal_lock = threading.RLock()
-
+class RabbitMQListener(RabbitMQPublisher):
     def __init__(self, config):
         self._connected = False
+        self.batch_callback = None
+        self.follow_up = None
+        # with a batch size > 1 responses are handled in batches of up to
+        # batch_size messages, or whatever arrived within batch_linger seconds
+        self.batch_size = get_setting(config, "LISTENER.BATCH_SIZE", 1)
+        self.batch_linger = get_setting(config, "LISTENER.BATCH_LINGER", 0.5)
+        # with parallel callbacks, responses for different tasks are handled
+        # on a pool of threads, responses for the same task stay in order
+        self.parallel_callbacks = get_setting(config, "LISTENER.PARALLEL_CALLBACKS", 0)
+        self.max_in_flight = get_setting(config, "LISTENER.MAX_IN_FLIGHT", 64)
+        self.executor = None
+        self.publisher = None
+        # recognises redelivered responses that were already handled
+        self.dedup = None
+        if get_setting(config, "LISTENER.DEDUP", True):
+            self.dedup = ResponseDeduplicator(
+                size=get_setting(config, "LISTENER.DEDUP_SIZE", 10000),
+                ttl=get_setting(config, "LISTENER.DEDUP_TTL", 3600),
+            )
         super().__init__(config)
 
+        if self.parallel_callbacks > 0:
+            self.executor = KeyedExecutor(
+                max_workers=self.parallel_callbacks, max_in_flight=self.max_in_flight
+            )
+            # callbacks publish from the pool threads, which must not touch
+            # the (not thread safe) connection we consume from
+            self.publisher = RabbitMQPublisher(config)
+
     def connect(self):
         if not self._connected:
 
@@ -38,13 +65,19 @@ class RabbitMQListener(RabbitMQHandler):
 
             self.queue = self.config.RABBITMQ.RESPONSE_QUEUE
 
-            self.channel.basic_qos(prefetch_count=1)
+            if self.parallel_callbacks > 0:
+                prefetch = self.max_in_flight
+            else:
+                prefetch = max(1, self.batch_size)
+            self.channel.basic_qos(prefetch_count=prefetch)
             self._connected = True
             self._is_interrupted = False
 
     def run(self):
         logger.debug("Starting blocking response queue listener")
         if self._connected:
+            if self.batch_size > 1 and self.batch_callback is not None:
+                return self._run_batched()
             for method, props, body in self.channel.consume(
                 self.queue, inactivity_timeout=1
             ):
@@ -52,17 +85,73 @@ class RabbitMQListener(RabbitMQHandler):
                     if self._is_interrupted or not self._connected:
                         break
                     if not method:
+                        if self.publisher is not None:
+                            self.publisher.heartbeat()
                         continue
                     self._on_response(self.channel, method, props, body)
         else:
             raise ResourceConnectionError("Not connected to AMQ")
 
+    def _run_batched(self):
+        batch = []
+        deadline = None
+        for method, props, body in self.channel.consume(
+            self.queue, inactivity_timeout=min(1, self.batch_linger)
+        ):
+            with self.internal_lock:
+                if self._is_interrupted or not self._connected:
+                    break
+                if method:
+                    batch.append((method, props, body))
+                    if deadline is None:
+                        deadline = time.monotonic() + self.batch_linger
+                if batch and (
+                    len(batch) >= self.batch_size or time.monotonic() >= deadline
+                ):
+                    self._on_batch(self.channel, batch)
+                    batch = []
+                    deadline = None
+
     def stop(self):
         if self._connected:
             self._is_interrupted = True
 
     def assign_callback(self, callback):
         self.callback = callback
+        if self.publisher is not None:
+            self.publisher.assign_callback(callback)
+
+    def assign_batch_callback(self, callback):
+        """`callback` receives a list of (correlation_id, response) tuples and
+        should raise if the batch could not be stored, it is then redelivered.
+        """
+        self.batch_callback = callback
+
+    def assign_dedup_check(self, applied, follow_up=None):
+        """`applied(correlation_id, response)` tells whether a response that
+        is not in the dedup cache was already handled before. Its state update
+        may have been written without the follow-up work, e.g. after a crash
+        in between, so such responses are passed to `follow_up(correlation_id,
+        response)` instead of the callback.
+        """
+        if self.dedup is not None:
+            self.dedup.applied = applied
+        self.follow_up = follow_up
+
+    def _duplicate(self, method, props, raw, response):
+        """None for a new response, otherwise see ResponseDeduplicator"""
+        if self.dedup is None:
+            return None
+        duplicate = self.dedup.is_duplicate(
+            props.correlation_id, raw, response, method.redelivered
+        )
+        if duplicate == "index" and self.follow_up is None:
+            return "cache"
+        return duplicate
+
+    def _handled(self, props, raw):
+        if self.dedup is not None:
+            self.dedup.handled(props.correlation_id, raw)
 
     def _do_callback(self, *args):
         try:
@@ -70,21 +159,113 @@ class RabbitMQListener(RabbitMQHandler):
         except Exception:
             logger.exception("Unhandled callback error")
 
-    def _on_response(self, ch, method, props, body):
-        # TODO find way to decode correctly to JSON
-        body = json.loads(body.decode("utf-8"))
+    def _do_follow_up(self, *args):
+        try:
+            return self.follow_up(*args)
+        except Exception:
+            logger.exception("Unhandled follow-up error")
+
+    def _decode(self, props, body):
+        return codec.decode(
+            memoryview(body), props.content_type, props.content_encoding
+        )
+
+    def _on_response(self, ch, method, props, raw):
+        try:
+            body = self._decode(props, raw)
+        except ValueError:
+            logger.exception(
+                "Dropping undecodable response for {}".format(props.correlation_id)
+            )
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+            return
 
-        self._do_callback(props.correlation_id, body)
+        duplicate = self._duplicate(method, props, raw, body)
+        if duplicate == "cache":
+            logger.info(
+                "Skipping duplicate response for {}".format(props.correlation_id)
+            )
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+            return
+        callback = self._do_callback
+        if duplicate == "index":
+            logger.info(
+                "Redoing follow-up of duplicate response for {}".format(
+                    props.correlation_id
+                )
+            )
+            callback = self._do_follow_up
+
+        if self.executor is not None:
+            # ack from the connection's thread once the callback is done
+            ack = functools.partial(ch.basic_ack, delivery_tag=method.delivery_tag)
+
+            def done():
+                self._handled(props, raw)
+                self.connection.add_callback_threadsafe(ack)
+
+            self.executor.submit(
+                props.correlation_id,
+                callback,
+                props.correlation_id,
+                body,
+                on_done=done,
+            )
+            return
+
+        callback(props.correlation_id, body)
+        self._handled(props, raw)
 
         ch.basic_ack(delivery_tag=method.delivery_tag)
 
+    def _sort_batch(self, batch):
+        """Returns the new responses, the duplicates whose follow-up work is
+        to be redone, and the (props, raw) of both. Undecodable responses and
+        handled duplicates are left out, they are only acked.
+        """
+        responses = []
+        follow_ups = []
+        handled = []
+        for method, props, raw in batch:
+            try:
+                response = self._decode(props, raw)
+            except ValueError:
+                logger.exception(
+                    "Dropping undecodable response for {}".format(props.correlation_id)
+                )
+                continue
+            duplicate = self._duplicate(method, props, raw, response)
+            if duplicate == "cache":
+                logger.info(
+                    "Skipping duplicate response for {}".format(props.correlation_id)
+                )
+                continue
+            if duplicate == "index":
+                follow_ups.append((props.correlation_id, response))
+            else:
+                responses.append((props.correlation_id, response))
+            handled.append((props, raw))
+        return responses, follow_ups, handled
+
+    def _on_batch(self, ch, batch):
+        responses, follow_ups, handled = self._sort_batch(batch)
+
+        last_tag = batch[-1][0].delivery_tag
+        try:
+            if responses:
+                self.batch_callback(responses)
+        except Exception:
+            logger.exception("Batch callback failed, requeueing {}".format(len(batch)))
+            ch.basic_nack(delivery_tag=last_tag, multiple=True, requeue=True)
+        else:
+            for correlation_id, response in follow_ups:
+                self._do_follow_up(correlation_id, response)
+            for props, raw in handled:
+                self._handled(props, raw)
+            ch.basic_ack(delivery_tag=last_tag, multiple=True)
+
     def publish(self, routing_key, task, document, retry=False):
+        if self.publisher is not None:
+            return self.publisher.publish(routing_key, task, document, retry)
         with self.internal_lock:
-            try:
-                super().publish(routing_key, task, document, retry)
-            except pika.exceptions.UnroutableError:
-                fail_resp = {"state": 422, "message": "Unroutable task"}
-                self.callback(task._id, fail_resp)
-                pass
-            except Exception as e:
-                raise e
+            super().publish(routing_key, task, document, retry)
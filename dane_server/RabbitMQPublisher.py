@@ -14,20 +14,112 @@
 ##############################################################################
 
 import pika
+import json
 import logging
+import threading
+import time
 from dane.handlers import RabbitMQHandler
 from dane.state import ProcState
+from dane_server import codec
+from dane_server.settings import get_setting
 
 logger = logging.getLogger("DANE")
 
 
-class RabbitMQPublisher(RabbitMQHandler):
+class ConfirmTimeoutError(pika.exceptions.AMQPError):
+    """The broker did not confirm enough messages to keep publishing"""
+
+
+def message_ttl(config):
+    """RETRY.MESSAGE_TTL (seconds), only if retries are enabled: without the
+    dead-letter topology of retry.py the broker silently drops expired tasks.
+    """
+    if not get_setting(config, "RETRY.ENABLED", False):
+        return None
+    return get_setting(config, "RETRY.MESSAGE_TTL", None)
+
+
+class TaskMessages:
+    """Builds the AMQP properties and body of a task message, shared by the
+    publishers. Expects `config`, `max_priority`, `message_ttl` (seconds or
+    None) and `codecs` (see codec.codecs_from_config) attributes.
+    """
+
+    def priority(self, task):
+        return max(0, min(int(task.priority or 0), self.max_priority))
+
+    def properties(self, task, content_type=codec.JSON, content_encoding=None):
+        return pika.BasicProperties(
+            reply_to=self.config.RABBITMQ.RESPONSE_QUEUE,
+            correlation_id=str(task._id),
+            priority=self.priority(task),
+            delivery_mode=2,
+            content_type=content_type,
+            content_encoding=content_encoding,
+            # tasks not picked up in time are dead-lettered, see retry.py
+            expiration=str(int(self.message_ttl * 1000)) if self.message_ttl else None,
+            # lets workers reply in a more compact format than JSON
+            headers={"x-accept": ", ".join(codec.accepted_content_types())},
+        )
+
+    def payload(self, task, document):
+        return {
+            "task": json.loads(task.to_json()),
+            "document": json.loads(document.to_json()),
+        }
+
+    def message(self, task, document):
+        """The (properties, body) of the message for this task, encoded with
+        the codec configured for its task key.
+        """
+        default, per_key = self.codecs
+        body, content_type, content_encoding = per_key.get(task.key, default).encode(
+            self.payload(task, document)
+        )
+        return self.properties(task, content_type, content_encoding), body
+
+
+class RabbitMQPublisher(TaskMessages, RabbitMQHandler):
     def __init__(self, config):
+        # pika connections are not thread safe, all use of the connection
+        # (publishing, heartbeats) goes through this lock
+        self.internal_lock = threading.RLock()
+        # DANE workers declare their queues with x-max-priority 10
+        self.max_priority = get_setting(config, "QUEUE.MAX_PRIORITY", 10)
+        self.codecs = codec.codecs_from_config(config)
+        self.message_ttl = message_ttl(config)
+        # max unconfirmed messages of publish_many()
+        self.confirm_window = get_setting(config, "QUEUE.CONFIRM_WINDOW", 256)
+        self._batch_channel = None
         super().__init__(config)
 
+    def heartbeat(self):
+        with self.internal_lock:
+            self.connection.process_data_events()
+
+    def _basic_publish(self, routing_key, properties, body, retry=False):
+        try:
+            with self.internal_lock:
+                self.pub_channel.basic_publish(
+                    exchange=self.config.RABBITMQ.EXCHANGE,
+                    routing_key=routing_key,
+                    properties=properties,
+                    mandatory=True,
+                    body=body,
+                )
+        except pika.exceptions.ChannelWrongStateError as e:
+            if not retry:  # retry once
+                logger.exception("Publish error")
+                with self.internal_lock:
+                    self.connect()
+                self._basic_publish(routing_key, properties, body, retry=True)
+            else:
+                raise e
+
     def publish(self, routing_key, task, document, retry=False):
         try:
-            super().publish(routing_key, task, document, retry)
+            properties, body = self.message(task, document)
+            self._basic_publish(routing_key, properties, body, retry)
         except pika.exceptions.UnroutableError:
             fail_resp = {
                 "state": ProcState.NO_ROUTE_TO_QUEUE.value,
@@ -37,3 +129,130 @@ class RabbitMQPublisher(RabbitMQHandler):
             pass
         except Exception as e:
             raise e
+
+    def _open_batch_channel(self):
+        # The blocking adapter waits for the confirm of every message, so
+        # pipelined publishing uses the underlying asynchronous channel and
+        # receives its confirms while processing data events.
+        if self._batch_channel is not None and self._batch_channel.is_open:
+            return self._batch_channel
+        channel = self.connection.channel()
+        selected = []
+        channel._impl.confirm_delivery(
+            ack_nack_callback=self._on_batch_confirm,
+            callback=lambda frame: selected.append(frame),
+        )
+        channel.add_on_return_callback(self._on_batch_return)
+        while not selected:
+            self.connection.process_data_events(time_limit=1)
+        self._batch_channel = channel
+        self._batch_tag = 0
+        return channel
+
+    def _on_batch_confirm(self, frame):
+        tag = frame.method.delivery_tag
+        if frame.method.multiple:
+            tags = [t for t in self._unconfirmed if t <= tag]
+        else:
+            tags = [tag] if tag in self._unconfirmed else []
+        acked = isinstance(frame.method, pika.spec.Basic.Ack)
+        for t in tags:
+            self._confirmed[self._unconfirmed.pop(t)] = acked
+
+    def _on_batch_return(self, channel, method, properties, body):
+        # a Basic.Return always arrives before the confirm of the message
+        self._returned.add(properties.correlation_id)
+
+    def publish_many(self, messages, timeout=60):
+        """Publishes [(routing_key, task, document)] without waiting for each
+        confirm, with at most `confirm_window` messages unconfirmed.
+
+        Unroutable tasks are reported through the callback, as in publish().
+        Returns {task id: error message} for the messages that were not
+        confirmed by the broker. Waiting for confirms, for room in the window
+        or for the last messages, takes at most `timeout` seconds; after that
+        the unconfirmed and unsent messages are returned as failed.
+        """
+        return self.publish_encoded_many(
+            (
+                (routing_key,) + self.message(task, document)
+                for routing_key, task, document in messages
+            ),
+            timeout,
+        )
+
+    def publish_encoded_many(self, messages, timeout=60):
+        """Like publish_many(), for messages that are already encoded:
+        [(routing_key, properties, body)], with the task id as correlation_id.
+        """
+        failed = {}
+        messages = iter(messages)
+        sending = None
+        with self.internal_lock:
+            self.connect()
+            channel = self._open_batch_channel()
+            self._unconfirmed = {}  # delivery tag -> task id
+            self._confirmed = {}  # task id -> acked
+            self._returned = set()
+            try:
+                for routing_key, properties, body in messages:
+                    sending = properties.correlation_id
+                    channel._impl.basic_publish(
+                        exchange=self.config.RABBITMQ.EXCHANGE,
+                        routing_key=routing_key,
+                        body=body,
+                        properties=properties,
+                        mandatory=True,
+                    )
+                    self._batch_tag += 1
+                    self._unconfirmed[self._batch_tag] = sending
+                    sending = None
+                    # room for the next message
+                    self._wait_for_window(timeout)
+
+                deadline = time.monotonic() + timeout
+                while self._unconfirmed and time.monotonic() < deadline:
+                    self.connection.process_data_events(time_limit=1)
+            except pika.exceptions.AMQPError as e:
+                logger.exception("Batch publish failed")
+                for task_id in self._unconfirmed.values():
+                    failed[task_id] = str(e)
+                # the messages that were not sent
+                if sending is not None:
+                    failed[sending] = str(e)
+                for _, properties, _ in messages:
+                    failed[properties.correlation_id] = str(e)
+                self._batch_channel = None
+            else:
+                for task_id in self._unconfirmed.values():
+                    failed[task_id] = "No publisher confirm within {}s".format(timeout)
+            returned, confirmed = self._returned, self._confirmed
+
+        self._report_batch(confirmed, returned, failed)
+        return failed
+
+    def _wait_for_window(self, timeout):
+        """Waits until fewer than `confirm_window` messages are unconfirmed,
+        raises ConfirmTimeoutError if that takes more than `timeout` seconds.
+        """
+        deadline = time.monotonic() + timeout
+        while len(self._unconfirmed) >= self.confirm_window:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise ConfirmTimeoutError(
+                    "No publisher confirm within {}s".format(timeout)
+                )
+            self.connection.process_data_events(time_limit=min(1, remaining))
+
+    def _report_batch(self, confirmed, returned, failed):
+        for task_id, acked in confirmed.items():
+            if task_id in returned:
+                self.callback(
+                    task_id,
+                    {
+                        "state": ProcState.NO_ROUTE_TO_QUEUE.value,
+                        "message": "Unroutable task",
+                    },
+                )
+            elif not acked:
+                failed[task_id] = "Message was rejected by the broker"
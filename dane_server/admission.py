@@ -0,0 +1,169 @@
+# Copyright 2020-present, Netherlands Institute for Sound and Vision (Nanne van Noord)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##############################################################################
+
+import logging
+import time
+import urllib.parse
+import requests
+import pika
+
+logger = logging.getLogger("DANE")
+
+# document target types, the first part of a task's routing key
+TARGET_TYPES = ["Dataset", "Image", "Video", "Sound", "Text"]
+
+
+def topic_matches(pattern, routing_key):
+    """Does an AMQP topic binding `pattern` match `routing_key`"""
+    words = routing_key.split(".")
+    parts = pattern.split(".")
+
+    def match(p, w):
+        if p == len(parts):
+            return w == len(words)
+        if parts[p] == "#":
+            return any(match(p + 1, i) for i in range(w, len(words) + 1))
+        if w == len(words):
+            return False
+        return (parts[p] == "*" or parts[p] == words[w]) and match(p + 1, w + 1)
+
+    return match(0, 0)
+
+
+class QueueMonitor:
+    """Keeps track of the depth and consumer count of the worker queues.
+
+    Uses the RabbitMQ management API (the same data as the /workers/ endpoint)
+    to find which queue a task key is routed to, and how deep it is. Without
+    the management plugin only queues listed in `queues` ({task key: queue
+    name}) are tracked, through a passive queue_declare on a channel of the
+    `publisher` connection.
+    Stats are refreshed at most every `refresh` seconds.
+    """
+
+    def __init__(self, config, publisher=None, queues=None, refresh=2, timeout=5):
+        self.config = config
+        self.publisher = publisher
+        self._channel = None
+        self.queues = dict(queues or {})
+        self.refresh = refresh
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.auth = (config.RABBITMQ.USER, config.RABBITMQ.PASSWORD)
+        self._stats = {}
+        self._bindings = []
+        self._updated = None
+
+    def _api(self, path):
+        url = "http://%s:%s/api/%s" % (
+            self.config.RABBITMQ.MANAGEMENT_HOST,
+            self.config.RABBITMQ.MANAGEMENT_PORT,
+            path,
+        )
+        response = self.session.get(url, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def update(self, force=False):
+        now = time.monotonic()
+        if not force and self._updated and now - self._updated < self.refresh:
+            return
+        self._updated = now
+
+        if self.config.RABBITMQ.MANAGEMENT:
+            vhost = urllib.parse.quote("/", safe="")
+            self._stats = {
+                q["name"]: (q.get("messages", 0), q.get("consumers", 0))
+                for q in self._api("queues/%s" % vhost)
+            }
+            self._bindings = [
+                (b["routing_key"], b["destination"])
+                for b in self._api(
+                    "exchanges/%s/%s/bindings/source"
+                    % (vhost, urllib.parse.quote(self.config.RABBITMQ.EXCHANGE))
+                )
+                if b["destination_type"] == "queue"
+            ]
+        elif self.publisher is not None:
+            with self.publisher.internal_lock:
+                for queue in self.queues.values():
+                    # a failed passive declare closes the channel, so reopen
+                    if self._channel is None or self._channel.is_closed:
+                        self._channel = self.publisher.connection.channel()
+                    try:
+                        ok = self._channel.queue_declare(queue=queue, passive=True)
+                    except pika.exceptions.ChannelClosedByBroker:
+                        logger.warning("Queue {} does not exist".format(queue))
+                        continue
+                    self._stats[queue] = (
+                        ok.method.message_count,
+                        ok.method.consumer_count,
+                    )
+
+    def queues_for(self, task_key):
+        if task_key in self.queues:
+            return [self.queues[task_key]]
+        routing_keys = ["{}.{}".format(t, task_key) for t in TARGET_TYPES]
+        return sorted(
+            {
+                queue
+                for pattern, queue in self._bindings
+                if any(topic_matches(pattern, rk) for rk in routing_keys)
+            }
+        )
+
+    def stats(self, task_key):
+        """(messages, consumers) of the fullest queue for this key, or None"""
+        known = [self._stats[q] for q in self.queues_for(task_key) if q in self._stats]
+        if not known:
+            return None
+        return max(known)
+
+
+class AdmissionController:
+    """Holds back tasks whose worker queue is at or above its high-water mark.
+
+    Tasks are admitted in the order given until their queue would reach
+    `high_water` messages; tasks for unknown queues are always admitted (they
+    end up as unroutable, as before).
+    """
+
+    def __init__(self, monitor, high_water=1000):
+        self.monitor = monitor
+        self.high_water = high_water
+
+    def admit(self, tasks):
+        try:
+            self.monitor.update()
+        except Exception:
+            # without queue stats we fall back to admitting everything
+            logger.exception("Could not fetch queue stats")
+            return tasks, []
+
+        admitted, held = [], []
+        budget = {}
+        for task in tasks:
+            key = task["key"]
+            if key not in budget:
+                stats = self.monitor.stats(key)
+                budget[key] = None if stats is None else self.high_water - stats[0]
+            if budget[key] is None:
+                admitted.append(task)
+            elif budget[key] > 0:
+                budget[key] -= 1
+                admitted.append(task)
+            else:
+                held.append(task)
+        return admitted, held
@@ -13,23 +13,44 @@
 # limitations under the License.
 ##############################################################################
 
-from flask import Flask, g
+from flask import Flask
 from flask import (
     Blueprint,
     abort,
     send_from_directory,
 )
-from flask import request, Response
+from flask import request, Response, stream_with_context
 from flask_restx import Api, Resource, fields, marshal
+from werkzeug.exceptions import HTTPException
 
+import argparse
+import datetime
+import functools
+import hashlib
 import json
 import os
 import logging
+import threading
+import time
+import zlib
 from logging.handlers import TimedRotatingFileHandler
-import requests
 
-from dane.handlers import ESHandler as Handler
-from dane_server.RabbitMQPublisher import RabbitMQPublisher
+from dane_server.handler import Handler
+from dane_server.publisher_pool import PublisherPool
+from dane_server.outbox import Outbox
+from dane_server.jobs import ElasticsearchJobStore, JobRunner
+from dane_server.cache import cache_from_config
+from dane_server.worker_stats import WorkerStatsCollector
+from dane_server.pagination import InvalidCursorError
+from dane_server.metrics import REGISTRY, CONTENT_TYPE
+from dane_server.settings import get_setting
+from dane_server.prefork import PreforkServer, available_cpus
+from dane_server.blobstore import (
+    BlobChecksumError,
+    is_claim_check,
+    resolve,
+    CLAIM_CHECK,
+)
 from dane import Document, Task, ProcState
 from dane.config import cfg
 from dane.errors import DocumentExistsError, TaskExistsError, ResultExistsError
@@ -64,7 +85,6 @@ logger.addHandler(ch)
 bp = Blueprint("DANE", __name__)
 
 app = Flask(__name__, static_url_path="/manage", static_folder="web")
-app.debug = True
 
 api = Api(bp, title="DANE API", description="API to interact with DANE")
 
@@ -206,7 +226,10 @@ _result = api.model(
             _generator, description="Result generator", required=True
         ),
         "payload": fields.Nested(
-            _anyField, description="Result payload", required=True
+            _anyField,
+            description="Result payload. In lists of results a large payload is "
+            "a claim check, fetch it from /result/<result_id>/payload",
+            required=True,
         ),
         "created_at": fields.String(
             description="Creation time", required=False, example="2020-12-12T10:53:57"
@@ -229,6 +252,16 @@ _worker = api.model(
         "in_queue": fields.Integer(
             description="Number of tasks in queue", required=True, default=0
         ),
+        "rate_in": fields.Float(
+            description="Tasks queued per second, over the stats window", example=2.5
+        ),
+        "rate_out": fields.Float(
+            description="Tasks delivered to workers per second", example=2.1
+        ),
+        "utilisation": fields.Float(
+            description="Fraction of time the workers could take a new task",
+            example=0.8,
+        ),
     },
 )
 
@@ -261,6 +294,44 @@ _batchResultDoc = api.model(
     },
 )
 
+_batchDocuments = api.model(
+    "BatchDocuments",
+    {
+        "documents": fields.List(
+            fields.Nested(_document), description="Documents found", required=True
+        ),
+        "not_found": fields.List(
+            fields.String,
+            description="Requested ids that are not a document",
+            required=True,
+        ),
+    },
+)
+
+_job = api.model(
+    "Job",
+    {
+        "id": fields.String(description="Job ID", required=True),
+        "name": fields.String(description="Job name", example="delete documents"),
+        "state": fields.String(
+            description="Job state",
+            required=True,
+            example="running",
+            enum=["queued", "running", "done", "failed"],
+        ),
+        "total": fields.Integer(description="Items to process", example=100000),
+        "done": fields.Integer(description="Items processed", example=5000),
+        "result": fields.Raw(description="Job result, once done"),
+        "error": fields.String(description="Error message, if the job failed"),
+        "created_at": fields.String(
+            description="Creation time", example="2020-12-12T10:53:57"
+        ),
+        "updated_at": fields.String(
+            description="Time of the last progress", example="2020-12-12T10:55:12"
+        ),
+    },
+)
+
 _failTasks = api.model(
     "Failure",
     {
@@ -296,9 +367,75 @@ _searchResult = api.model(
         "hits": fields.List(
             fields.Nested(_document), description="Documents returned", required=True
         ),
+        "next": fields.String(
+            description="Cursor of the next page, only when paging with a cursor"
+        ),
+    },
+)
+
+_documentPage = api.model(
+    "DocumentPage",
+    {
+        "hits": fields.List(fields.Nested(_document), required=True),
+        "next": fields.String(
+            description="Cursor of the next page, null after the last page"
+        ),
+    },
+)
+
+_taskPage = api.model(
+    "TaskPage",
+    {
+        "hits": fields.List(fields.Nested(_task), required=True),
+        "next": fields.String(
+            description="Cursor of the next page, null after the last page"
+        ),
+    },
+)
+
+_resultPage = api.model(
+    "ResultPage",
+    {
+        "hits": fields.List(fields.Nested(_result), required=True),
+        "next": fields.String(
+            description="Cursor of the next page, null after the last page"
+        ),
     },
 )
 
+_exportParams = {
+    "format": {
+        "description": "ndjson to stream all hits as newline delimited JSON",
+        "type": "string",
+        "enum": ["json", "ndjson"],
+        "required": False,
+    },
+    "fields": {
+        "description": "ndjson only: fields to export, e.g. payload.text,generator",
+        "type": "string",
+        "required": False,
+    },
+    "gzip": {
+        "description": "ndjson only: gzip compress the stream",
+        "type": "boolean",
+        "default": False,
+        "required": False,
+    },
+}
+
+_cursorParams = {
+    "cursor": {
+        "description": "Cursor of the page to fetch, empty for the first page",
+        "type": "string",
+        "required": False,
+    },
+    "size": {
+        "description": "Page size",
+        "type": "int",
+        "required": False,
+    },
+}
+
 _workerTasks = api.model(
     "WorkerTasks",
     {
@@ -322,6 +459,21 @@ _massResetResult = api.model(
 )
 
 
+def etagged(f):
+    """Serves the (marshalled) output of `f` with an ETag, and answers 304
+    Not Modified if it matches the If-None-Match of the request
+    """
+
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        body = json.dumps(f(*args, **kwargs))
+        response = Response(body, status=200, mimetype="application/json")
+        response.set_etag(hashlib.sha1(body.encode("utf-8")).hexdigest())
+        return response.make_conditional(request)
+
+    return wrapper
+
+
 @ns_doc.route("/")
 class DocumentListAPI(Resource):
     @ns_doc.marshal_with(_document)
@@ -358,6 +510,7 @@ class DocumentListAPI(Resource):
 
 @ns_doc.route("/<doc_id>")
 class DocumentAPI(Resource):
+    @etagged
     @ns_doc.marshal_with(_document)
     def get(self, doc_id):
         try:
@@ -387,6 +540,7 @@ class DocumentAPI(Resource):
 
 @ns_doc.route("/<doc_id>/tasks")
 class DocumentTasksAPI(Resource):
+    @etagged
     @ns_doc.marshal_with(_task, as_list=True)
     def get(self, doc_id):
         try:
@@ -443,7 +597,7 @@ class BatchDocumentsListAPI(Resource):
             }
         }
     )
-    @ns_doc.marshal_with(_document, as_list=True)
+    @ns_docs.response(200, "Success", _batchDocuments)
     def get(self):
         docs = request.args.getlist(
             "doc[]", type=str
@@ -454,28 +608,33 @@ class BatchDocumentsListAPI(Resource):
         # i.e. doc=A,B,C
         docs = [sd for d in docs for sd in d.split(",")]
 
-        output = []
-        for doc_id in docs:
-            try:
-                doc = get_handler().documentFromDocumentId(doc_id)
-            except DocumentExistsError:
-                logger.debug("Document {} not found.".format(doc_id))
-                abort(404)
-            except Exception:
-                logger.exception("Unhandled Error")
-                abort(500)
-            else:
-                output.append(json.loads(doc.to_json()))
+        try:
+            documents, not_found = get_handler().documentsFromDocumentIds(docs)
+        except Exception:
+            logger.exception("Unhandled Error")
+            abort(500)
 
-        return Response(json.dumps(output), status=200, mimetype="application/json")
+        if not_found:
+            logger.debug("Documents {} not found.".format(not_found))
+        return Response(
+            json.dumps({"documents": documents, "not_found": not_found}),
+            status=200,
+            mimetype="application/json",
+        )
 
     @ns_docs.doc(
         params={
-            "doc": {
+            "docs": {
                 "description": "Document ids",
                 "type": "array",
                 "items": {"type": "string"},
-            }
+            },
+            "background": {
+                "description": "Delete in a background job, poll /documents/jobs/<id>",
+                "type": "boolean",
+                "default": False,
+                "required": False,
+            },
         }
     )
     def delete(self):
@@ -486,25 +645,90 @@ class BatchDocumentsListAPI(Resource):
         # i.e. doc=A,B,C
         docs = [sd for d in docs for sd in d.split(",")]
 
-        for doc_id in docs:
+        if request.args.get("background", "false").lower() == "true":
+            job = get_jobs().submit(
+                "delete documents",
+                lambda job: get_handler().deleteDocuments(docs, job.progress),
+                total=len(set(docs)),
+            )
+            return marshal(job.to_dict(), _job), 202
+
+        # for batch its OK if a doc_id doesnt exist
+        try:
+            get_handler().deleteDocuments(docs)
+        except Exception:
+            logger.exception("Unhandled Error")
+            abort(500)
+
+        return ("", 200)
+
+
+def _parse_documents(lines):
+    """Yields (line number, Document or None, error) per non-empty line"""
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            pd = json.loads(line)
+            if "_id" in pd:
+                raise TypeError
+            doc = Document.from_json(pd)
+        except Exception:
+            # e.g. not JSON, or a missing field: only this line fails
+            yield line_number, None, "Invalid document format"
+        else:
+            yield line_number, doc, None
+
+
+@ns_docs.route("/ndjson")
+class BatchDocumentsIngestAPI(Resource):
+    @ns_docs.doc(
+        description="Registers newline delimited JSON documents, one per line, "
+        "and streams back one NDJSON status line per document"
+    )
+    def post(self):
+        handler = get_handler()
+
+        def statuses(pending):
+            documents = [doc for _, doc, _ in pending if doc is not None]
             try:
-                doc = get_handler().documentFromDocumentId(doc_id)
-                doc.delete()
-            except TypeError:
-                logger.exception("TypeError")
-                abort(500, f"document: {doc_id})")
-            except DocumentExistsError:
-                logger.debug("Batch delete document {} not found.".format(doc_id))
-                # for batch its OK if the doc_id doesnt exist
-                pass
-            except ValueError:
-                logger.exception("ValueError")
-                abort(400, f"document: {doc_id})")
+                results = iter(handler.ingestDocuments(documents) if documents else [])
             except Exception:
                 logger.exception("Unhandled Error")
-                abort(500, f"document: {doc_id})")
+                results = iter([(500, "Unhandled error")] * len(documents))
+            for line_number, doc, error in pending:
+                if doc is None:
+                    status = {"line": line_number, "status": 400, "error": error}
+                else:
+                    code, detail = next(results)
+                    status = {"line": line_number, "status": code}
+                    status["_id" if code == 201 else "error"] = detail
+                yield json.dumps(status) + "\n"
+
+        def ingest():
+            pending, documents = [], 0
+            for line_number, doc, error in _parse_documents(request.stream):
+                pending.append((line_number, doc, error))
+                if doc is not None:
+                    documents += 1
+                if documents >= handler.ingest_chunk_size:
+                    yield from statuses(pending)
+                    pending, documents = [], 0
+            yield from statuses(pending)
+
+        return Response(
+            stream_with_context(ingest()), status=200, mimetype="application/x-ndjson"
+        )
 
-        return ("", 200)
+
+@ns_docs.route("/jobs/<job_id>")
+class BatchDocumentsJobAPI(Resource):
+    @ns_docs.marshal_with(_job)
+    def get(self, job_id):
+        job = get_jobs().get(job_id)
+        if job is None:
+            abort(404)
+        return job
 
 
 @ns_search.route("/document/")
@@ -524,20 +748,38 @@ class SearchAPI(Resource):
                 "required": False,
             },
             "page": {
-                "description": "page number",
+                "description": "page number, ignored when paging with a cursor",
                 "type": "int",
                 "default": "1",
                 "required": False,
             },
+            **_cursorParams,
         }
     )
     @ns_doc.marshal_with(_searchResult, as_list=True)
     def get(self):
         target_id = request.args.get("target_id", "*")
         creator_id = request.args.get("creator_id", "*")
-        result, count = get_handler().search(
-            target_id, creator_id, int(request.args.get("page", 1))
-        )
+        cursor = "cursor" in request.args
+        if not cursor:
+            try:
+                page = int(request.args.get("page", 1))
+            except ValueError:
+                abort(400, "Invalid page number")
+
+        try:
+            if cursor:
+                # page_of() answers 400 to an invalid or expired cursor
+                result, count, next_cursor = page_of(
+                    get_handler().searchPage, target_id, creator_id
+                )
+                return {"total": count, "hits": result, "next": next_cursor}
+            result, count = get_handler().search(target_id, creator_id, page)
+        except HTTPException:
+            raise
+        except Exception:
+            logger.exception("Unhandled Error")
+            abort(500)
         return {"total": count, "hits": result}
 
 
@@ -593,6 +835,7 @@ class TaskListAPI(Resource):
 
 @ns_task.route("/<task_id>")
 class TaskAPI(Resource):
+    @etagged
     @ns_doc.marshal_with(_task)
     def get(self, task_id):
         try:
@@ -662,18 +905,29 @@ class TaskParentAPI(Resource):
 
 @ns_result.route("/<result_id>")
 class ResultAPI(Resource):
+    @etagged
     @ns_doc.marshal_with(_result)
     def get(self, result_id):
+        handler = get_handler()
         try:
-            result = get_handler().resultFromResultId(result_id)
+            result = handler.resultFromResultId(result_id)
         except ResultExistsError:
             logger.exception("ResultExistsError")
             abort(404)
         except Exception:
             logger.exception("Unhandled Error")
             abort(500)
-        else:
-            return result
+
+        # the payload a claim check refers to, see ResultPayloadAPI
+        try:
+            result.payload = resolve(result.payload, handler.blobs)
+        except (FileNotFoundError, ValueError):
+            logger.exception("Missing payload for result {}".format(result_id))
+            abort(404)
+        except BlobChecksumError:
+            logger.exception("Corrupt payload for result {}".format(result_id))
+            abort(500)
+        return result
 
     def delete(self, result_id):
         try:
@@ -689,6 +943,42 @@ class ResultAPI(Resource):
             return ("", 200)
 
 
+@ns_result.route("/<result_id>/payload")
+class ResultPayloadAPI(Resource):
+    def get(self, result_id):
+        handler = get_handler()
+        try:
+            result = handler.resultFromResultId(result_id)
+        except ResultExistsError:
+            logger.exception("ResultExistsError")
+            abort(404)
+        except Exception:
+            logger.exception("Unhandled Error")
+            abort(500)
+
+        if not is_claim_check(result.payload):
+            return Response(json.dumps(result.payload), mimetype="application/json")
+
+        # stream large payloads from the blob store, rather than loading them
+        reference = result.payload[CLAIM_CHECK]
+        try:
+            chunks = handler.blobs.stream(reference)
+        except (FileNotFoundError, ValueError):
+            logger.exception("Missing payload for result {}".format(result_id))
+            abort(404)
+        except BlobChecksumError:
+            logger.exception("Corrupt payload for result {}".format(result_id))
+            abort(500)
+        return Response(
+            chunks,
+            mimetype=reference.get("content_type", "application/json"),
+            headers={
+                "Content-Length": str(reference["size"]),
+                "ETag": '"{}"'.format(reference["sha256"]),
+            },
+        )
+
+
 @ns_workers.route("/")
 class WorkersListAPI(Resource):
     @ns_doc.marshal_with(_worker, as_list=True)
@@ -697,29 +987,10 @@ class WorkersListAPI(Resource):
             # no rabbitmq management plugin, so cant query workers
             abort(405)
         else:
-            virtual_host = ""
-
-            url = "http://%s:%s/api/queues/%s" % (
-                cfg.RABBITMQ.MANAGEMENT_HOST,
-                cfg.RABBITMQ.MANAGEMENT_PORT,
-                virtual_host,
-            )
-
-            response = requests.get(
-                url, auth=(cfg.RABBITMQ.USER, cfg.RABBITMQ.PASSWORD)
-            )
-
-            workers = [
-                {
-                    "name": q["name"],
-                    "active_workers": q["consumers"],
-                    "in_queue": q["messages"],
-                }
-                for q in response.json()
-                if q["name"] != cfg.RABBITMQ.RESPONSE_QUEUE
-            ]
-
-            return workers
+            collector = get_worker_stats()
+            if collector.updated is None:
+                abort(503, "No worker stats collected yet")
+            return collector.workers()
 
 
 @ns_workers.route("/<task_key>")
@@ -782,7 +1053,11 @@ class WorkerResetAPI(Resource):
                 }
             },
             "script": {
-                "source": f"ctx._source['task']['state'] = {ProcState.TASK_RESET.value}; ctx._source['task']['msg'] = 'Manual reset';"
+                "source": f"ctx._source['task']['state'] = {ProcState.TASK_RESET.value}; ctx._source['task']['msg'] = 'Manual reset'; ctx._source['updated_at'] = params.now;",
+                # bump updated_at so the incremental task scheduler notices the reset
+                "params": {
+                    "now": datetime.datetime.now().replace(microsecond=0).isoformat()
+                },
             },
         }
 
@@ -790,6 +1065,7 @@ class WorkerResetAPI(Resource):
             result = get_handler().es.update_by_query(
                 index=INDEX, body=query, refresh=True
             )
+            get_handler().invalidateAll()
             return {
                 "total": result["total"],
                 "error": "No tasks affected" if result["total"] == 0 else "",
@@ -801,41 +1077,137 @@ class WorkerResetAPI(Resource):
 
 @ns_creator.route("/<creator_id>/docs")
 class CreatorDocsAPI(Resource):
-    @ns_creator.marshal_with(_document, as_list=True)
+    @ns_creator.doc(params=_cursorParams)
+    @ns_creator.response(200, "Success, a page when paging with a cursor", [_document])
     def get(self, creator_id):
         try:
+            if "cursor" in request.args:
+                docs, next_cursor = page_of(get_handler().docsOfCreatorPage, creator_id)
+                return marshal({"hits": docs, "next": next_cursor}, _documentPage)
             docs = get_handler().get_docs_of_creator(creator_id, [])
+        except HTTPException:
+            raise
         except Exception:
             logger.exception("Unhandled Error")
             abort(500)
         else:
-            return docs
+            return marshal(docs, _document)
 
 
 @ns_creator.route("/<creator_id>/<task_key>/tasks")
 class CreatorTasksAPI(Resource):
-    @ns_creator.marshal_with(_task, as_list=True)
+    @ns_creator.doc(params={**_cursorParams, **_exportParams})
+    @ns_creator.response(200, "Success, a page when paging with a cursor", [_task])
     def get(self, creator_id, task_key):
+        if request.args.get("format") == "ndjson":
+            return ndjson_export(
+                get_handler().exportTasksOfCreator,
+                creator_id,
+                task_key,
+                "{}-{}-tasks".format(creator_id, task_key),
+            )
         try:
+            if "cursor" in request.args:
+                tasks, next_cursor = page_of(
+                    get_handler().tasksOfCreatorPage, creator_id, task_key
+                )
+                return marshal({"hits": tasks, "next": next_cursor}, _taskPage)
             tasks = get_handler().get_tasks_of_creator(creator_id, task_key, [])
+        except HTTPException:
+            raise
         except Exception:
             logger.exception("Unhandled Error")
             abort(500)
         else:
-            return tasks
+            return marshal(tasks, _task)
 
 
 @ns_creator.route("/<creator_id>/<task_key>/results")
 class CreatorResultsAPI(Resource):
-    @ns_creator.marshal_with(_result, as_list=True)
+    @ns_creator.doc(params={**_cursorParams, **_exportParams})
+    @ns_creator.response(200, "Success, a page when paging with a cursor", [_result])
     def get(self, creator_id, task_key):
+        if request.args.get("format") == "ndjson":
+            return ndjson_export(
+                get_handler().exportResultsOfCreator,
+                creator_id,
+                task_key,
+                "{}-{}-results".format(creator_id, task_key),
+            )
         try:
+            if "cursor" in request.args:
+                results, next_cursor = page_of(
+                    get_handler().resultsOfCreatorPage, creator_id, task_key
+                )
+                return marshal({"hits": results, "next": next_cursor}, _resultPage)
             results = get_handler().get_results_of_creator(creator_id, task_key, [])
+        except HTTPException:
+            raise
         except Exception:
             logger.exception("Unhandled Error")
             abort(500)
         else:
-            return results
+            return marshal(results, _result)
+
+
+def ndjson_export(export, creator_id, task_key, name):
+    """Streams the dicts yielded by export(creator_id, task_key, fields,
+    chunk_size) as NDJSON, gzip compressed if requested
+    """
+    fields = [f for f in request.args.get("fields", "").split(",") if f]
+    compress = request.args.get("gzip", "false").lower() == "true"
+    rows = export(
+        creator_id,
+        task_key,
+        fields,
+        get_setting(cfg, "API.EXPORT_CHUNK_SIZE", 1000),
+    )
+
+    def lines():
+        buffer = []
+        for row in rows:
+            buffer.append(json.dumps(row))
+            if len(buffer) >= 100:  # fewer, larger writes
+                yield ("\n".join(buffer) + "\n").encode("utf-8")
+                buffer = []
+        if buffer:
+            yield ("\n".join(buffer) + "\n").encode("utf-8")
+
+    def gzipped(chunks):
+        compressor = zlib.compressobj(wbits=31)  # gzip container
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+
+    headers = {
+        "Content-Disposition": 'attachment; filename="{}.ndjson{}"'.format(
+            name, ".gz" if compress else ""
+        )
+    }
+    if compress:
+        return Response(
+            gzipped(lines()),
+            mimetype="application/gzip",
+            headers=headers,
+        )
+    return Response(lines(), mimetype="application/x-ndjson", headers=headers)
+
+
+def page_of(fetch, *args):
+    """Calls fetch(*args, size, cursor) with the cursor and page size of the
+    request, aborts with 400 if the cursor is invalid or expired
+    """
+    try:
+        size = int(request.args.get("size", get_setting(cfg, "API.PAGE_SIZE", 100)))
+    except ValueError:
+        abort(400, "Invalid page size")
+    size = max(1, min(size, get_setting(cfg, "API.MAX_PAGE_SIZE", 1000)))
+    try:
+        return fetch(*args, size, request.args.get("cursor") or None)
+    except InvalidCursorError as e:
+        abort(400, str(e))
 
 
 """------------------------------------------------------------------------------
@@ -860,7 +1232,8 @@ def ReadyCheck():
     else:
         states["database"] = True
 
-    states["messagequeue"] = get_queue().connection.is_open
+    queue = get_queue()
+    states["messagequeue"] = queue is not None and queue.is_open()
 
     overall = all(states.values())
 
@@ -875,6 +1248,11 @@ def ReadyCheck():
     )
 
 
+@app.route("/metrics", methods=["GET"])
+def Metrics():
+    return Response(REGISTRY.render(), status=200, content_type=CONTENT_TYPE)
+
+
 """------------------------------------------------------------------------------
 DANE web admin thingy
 ------------------------------------------------------------------------------"""
@@ -896,31 +1274,192 @@ def manager():
 app.register_blueprint(bp, url_prefix="/DANE")
 
 
+# shared by all requests, see get_queue()
+_publisher_pool = None
+_publisher_pool_lock = threading.Lock()
+# no connection is tried again before this time, see get_queue()
+_publisher_pool_retry_at = 0.0
+
+
 def get_queue():
-    if "messageQueue" not in g:
-        try:
-            g.messageQueue = RabbitMQPublisher(cfg)
-            return g.messageQueue
-        except Exception:
-            logger.exception("Could not connect to queue")
-    return None
+    """The queue of this process, or None if RabbitMQ cannot be reached. A
+    failed connect is retried by a later call, at most once every
+    PUBLISHER_POOL.RETRY_INTERVAL seconds.
+    """
+    global _publisher_pool, _publisher_pool_retry_at
+    if _publisher_pool is None and time.monotonic() >= _publisher_pool_retry_at:
+        with _publisher_pool_lock:
+            if _publisher_pool is None and time.monotonic() >= _publisher_pool_retry_at:
+                try:
+                    if get_setting(cfg, "OUTBOX.ENABLED", False):
+                        # the relay connects to RabbitMQ once it is reachable
+                        _publisher_pool = Outbox.from_config(
+                            cfg, lambda: PublisherPool.from_config(cfg)
+                        )
+                    else:
+                        _publisher_pool = PublisherPool.from_config(cfg)
+                except Exception:
+                    logger.exception("Could not connect to queue")
+                    _publisher_pool_retry_at = time.monotonic() + get_setting(
+                        cfg, "PUBLISHER_POOL.RETRY_INTERVAL", 30
+                    )
+    return _publisher_pool
+
+
+# background jobs of this process, see get_jobs()
+_jobs = None
+_jobs_lock = threading.Lock()
+
+
+def get_jobs():
+    global _jobs
+    if _jobs is None:
+        with _jobs_lock:
+            if _jobs is None:
+                # in Elasticsearch, so every API process can report on them
+                store = ElasticsearchJobStore(
+                    get_handler().es,
+                    get_setting(cfg, "API.JOB_INDEX", INDEX + "-jobs"),
+                    ttl=get_setting(cfg, "API.JOB_TTL", 24 * 3600),
+                )
+                _jobs = JobRunner(
+                    max_workers=get_setting(cfg, "API.JOB_WORKERS", 2), store=store
+                )
+    return _jobs
+
+
+# polls the RabbitMQ management API, see get_worker_stats()
+_worker_stats = None
+_worker_stats_lock = threading.Lock()
+
+
+def get_worker_stats():
+    global _worker_stats
+    if _worker_stats is None:
+        with _worker_stats_lock:
+            if _worker_stats is None:
+                collector = WorkerStatsCollector(
+                    cfg,
+                    interval=get_setting(cfg, "WORKER_STATS.INTERVAL", 10),
+                    samples=get_setting(cfg, "WORKER_STATS.SAMPLES", 60),
+                    timeout=get_setting(cfg, "WORKER_STATS.TIMEOUT", 5),
+                    exclude=[cfg.RABBITMQ.RESPONSE_QUEUE],
+                )
+                try:
+                    # so the first request has something to show
+                    collector.collect()
+                except Exception:
+                    logger.exception("Could not collect worker stats")
+                collector.start()
+                _worker_stats = collector
+    return _worker_stats
+
+
+# shared by all requests, see get_handler()
+_handler = None
+_handler_lock = threading.Lock()
 
 
 def get_handler():
-    if "handler" not in g:
-        logger.info("No handler assigned yet, assigning it now")
-        g.handler = Handler(config=cfg, queue=get_queue())
+    global _handler
+    if _handler is None:
+        with _handler_lock:
+            if _handler is None:
+                logger.info("No handler assigned yet, assigning it now")
+                # the Handler assigns its callback to the queue
+                _handler = Handler(
+                    config=cfg, queue=get_queue(), cache=cache_from_config(cfg)
+                )
+                if _handler.queue is None:
+                    logger.warning(
+                        "Continuing without a working queue, retrying on "
+                        "later requests"
+                    )
+    elif _handler.queue is None:
         queue = get_queue()
-        if queue:
-            logger.info("Got a valid queue, assigning the callback handler")
-            queue.assign_callback(g.handler.callback)
-        else:
-            logger.warning("Continuing without a working queue!!")
-    return g.handler
+        if queue is not None:
+            with _handler_lock:
+                if _handler.queue is None:
+                    _handler.attach_queue(queue)
+                    logger.info("Connected to the queue")
+    return _handler
+
+
+def warm_up():
+    """Connects to Elasticsearch and RabbitMQ before serving the first
+    request, e.g. in a freshly started worker process.
+    """
+    get_handler().es.ping()
+
+
+def create_app(debug=False):
+    """Returns the WSGI app, e.g. for a WSGI server of choice. Connections
+    are made on the first request, or by warm_up().
+    """
+    app.debug = debug
+    return app
+
+
+def jobs_running():
+    """Whether background jobs of this process did not finish yet"""
+    return _jobs is not None and _jobs.busy()
+
+
+def interrupt_jobs():
+    if _jobs is not None:
+        _jobs.interrupt()
+
+
+def serve():
+    """Serves the API with pre-forked worker processes, see PreforkServer"""
+    workers = get_setting(cfg, "API.WORKERS", None) or available_cpus()
+    # the rotating log file cannot be shared by the worker processes
+    logger.removeHandler(fh)
+    fh.close()
+    if workers > 1 and get_setting(cfg, "CACHE.ENABLED", False):
+        if get_setting(cfg, "CACHE.BACKEND", "memory") == "memory":
+            logger.warning(
+                "Every worker has its own cache, changes made through one may "
+                "show up in the others after up to {}s, use the redis "
+                "backend to share it".format(get_setting(cfg, "CACHE.TTL", 5))
+            )
+    PreforkServer(
+        create_app,
+        host=cfg.DANE.HOST,
+        port=cfg.DANE.PORT,
+        workers=workers,
+        threads=get_setting(cfg, "API.THREADS", 8),
+        max_requests=get_setting(cfg, "API.MAX_REQUESTS", 0),
+        max_requests_jitter=get_setting(cfg, "API.MAX_REQUESTS_JITTER", 0),
+        graceful_timeout=get_setting(cfg, "API.GRACEFUL_TIMEOUT", 30),
+        post_fork=warm_up,
+        busy=jobs_running,
+        on_exit=interrupt_jobs,
+    ).run()
 
 
 def main():
-    app.run(port=cfg.DANE.PORT, host=cfg.DANE.HOST, use_reloader=True)
+    parser = argparse.ArgumentParser(description="DANE API")
+    parser.add_argument(
+        "--production",
+        action="store_true",
+        help="serve with pre-forked worker processes instead of the "
+        "development server",
+    )
+    args = parser.parse_args()
+
+    if args.production:
+        # connections are made in the workers, after they are forked
+        serve()
+        return
+
+    try:
+        warm_up()
+    except Exception:
+        logger.exception("Could not connect on startup, retrying on first request")
+    create_app(debug=True).run(
+        port=cfg.DANE.PORT, host=cfg.DANE.HOST, use_reloader=True
+    )
 
 
 if __name__ == "__main__":
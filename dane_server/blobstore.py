@@ -0,0 +1,171 @@
+# Copyright 2020-present, Netherlands Institute for Sound and Vision (Nanne van Noord)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##############################################################################
+
+# Claim-check storage for large result payloads: the payload is written to a
+# blob store and the result in Elasticsearch only keeps a reference
+# ({"claim_check": {...}}) with its checksum. Workers index their results
+# themselves, so the server offloads a payload once the task reported success
+# (Handler.offloadResults); the full payload does pass through Elasticsearch.
+
+import abc
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+from dane_server.settings import get_setting
+
+logger = logging.getLogger("DANE")
+
+CLAIM_CHECK = "claim_check"
+CHUNK_SIZE = 64 * 1024
+
+_KEY = re.compile(r"^[0-9a-f]{2}/[0-9a-f]{64}$")
+
+
+class BlobChecksumError(Exception):
+    pass
+
+
+class BlobStore(abc.ABC):
+    """Content addressed store, blobs are identified by their sha256"""
+
+    backend: str
+
+    @abc.abstractmethod
+    def put(self, data, content_type="application/json"):
+        """Stores `data` (bytes), returns its reference"""
+
+    @abc.abstractmethod
+    def open(self, reference):
+        """Binary file object for the referenced blob"""
+
+    @abc.abstractmethod
+    def delete(self, reference):
+        """Removes the referenced blob, False if it did not exist"""
+
+    def _reference(self, key, digest, size, content_type):
+        return {
+            "backend": self.backend,
+            "key": key,
+            "sha256": digest,
+            "size": size,
+            "content_type": content_type,
+        }
+
+    def stream(self, reference, chunk_size=CHUNK_SIZE):
+        """Verifies the checksum of the blob, then returns an iterator over
+        its chunks. Raises BlobChecksumError before anything is sent.
+        """
+        f = self.open(reference)
+        try:
+            digest = hashlib.sha256()
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                digest.update(chunk)
+            if digest.hexdigest() != reference["sha256"]:
+                logger.error("Checksum mismatch for blob {}".format(reference["key"]))
+                raise BlobChecksumError(reference["key"])
+            f.seek(0)
+        except BaseException:
+            f.close()
+            raise
+        return _chunks(f, chunk_size)
+
+
+def _chunks(f, chunk_size):
+    with f:
+        yield from iter(lambda: f.read(chunk_size), b"")
+
+
+class FileBlobStore(BlobStore):
+    """Blobs as files below `directory`, e.g. on the shared OUT_FOLDER volume"""
+
+    backend = "file"
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, key):
+        if not _KEY.match(key):
+            raise ValueError("Invalid blob key: {}".format(key))
+        return os.path.join(self.directory, key)
+
+    def put(self, data, content_type="application/json"):
+        digest = hashlib.sha256(data).hexdigest()
+        key = "{}/{}".format(digest[:2], digest)
+        path = self._path(key)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # write and rename, so readers never see a partial blob
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(tmp, path)
+            except Exception:
+                os.unlink(tmp)
+                raise
+        return self._reference(key, digest, len(data), content_type)
+
+    def open(self, reference):
+        return open(self._path(reference["key"]), "rb")
+
+    def delete(self, reference):
+        try:
+            os.unlink(self._path(reference["key"]))
+            return True
+        except FileNotFoundError:
+            return False
+
+
+def is_claim_check(payload):
+    return isinstance(payload, dict) and list(payload.keys()) == [CLAIM_CHECK]
+
+
+def offload(payload, store, threshold):
+    """Replaces `payload` by a claim check if its JSON is `threshold` bytes or
+    more, otherwise returns it unchanged.
+    """
+    if store is None or not threshold or is_claim_check(payload):
+        return payload
+    data = json.dumps(payload, separators=(",", ":")).encode("utf-8")
+    if len(data) < threshold:
+        return payload
+    return {CLAIM_CHECK: store.put(data, "application/json")}
+
+
+def resolve(payload, store):
+    """The payload a claim check refers to, read from `store` after its
+    checksum is verified. Any other payload is returned unchanged.
+    """
+    if store is None or not is_claim_check(payload):
+        return payload
+    return json.loads(b"".join(store.stream(payload[CLAIM_CHECK])))
+
+
+def blob_store_from_config(config):
+    """The blob store configured in DANE_SERVER.CLAIM_CHECK, by default files
+    below OUT_FOLDER/blobs
+    """
+    backend = get_setting(config, "CLAIM_CHECK.BACKEND", "file")
+    if backend != "file":
+        raise ValueError("Unknown blob store backend: {}".format(backend))
+    directory = get_setting(
+        config,
+        "CLAIM_CHECK.DIR",
+        os.path.join(get_setting(config, "OUT_FOLDER", "."), "blobs"),
+    )
+    return FileBlobStore(directory)
@@ -0,0 +1,127 @@
+# Copyright 2020-present, Netherlands Institute for Sound and Vision (Nanne van Noord)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##############################################################################
+
+import threading
+import time
+from collections import OrderedDict
+from dane_server.settings import get_setting
+
+try:
+    import redis
+except ImportError:  # pragma: no cover
+    redis = None
+
+
+class TTLCache:
+    """Thread safe LRU cache of at most `maxsize` entries, which expire
+    `ttl` seconds after they were set (never if ttl is None).
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires, value)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            if entry[0] is not None and entry[0] <= time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value):
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __contains__(self, key):
+        marker = object()
+        return self.get(key, marker) is not marker
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RedisCache:
+    """Cache with the interface of TTLCache in Redis, so processes share it
+    and see each other's invalidations. Values must be strings. Needs the
+    optional `redis` package.
+    """
+
+    def __init__(self, url, ttl=None, prefix="dane:"):
+        if redis is None:
+            raise ValueError("The redis cache backend requires the redis package")
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key, default=None):
+        value = self.client.get(self.prefix + key)
+        return default if value is None else value.decode("utf-8")
+
+    def set(self, key, value):
+        self.client.set(
+            self.prefix + key,
+            value,
+            px=None if self.ttl is None else int(self.ttl * 1000),
+        )
+
+    def pop(self, key, default=None):
+        value = self.client.get(self.prefix + key)
+        self.client.delete(self.prefix + key)
+        return default if value is None else value.decode("utf-8")
+
+    def clear(self):
+        for key in self.client.scan_iter(match=self.prefix + "*"):
+            self.client.delete(key)
+
+    def __contains__(self, key):
+        return self.client.exists(self.prefix + key) > 0
+
+
+def cache_from_config(config, shared_only=False):
+    """The lookup cache configured in DANE_SERVER.CACHE, None if disabled.
+
+    With `shared_only` only a cache shared between processes is returned,
+    e.g. for dane-server, whose changes should invalidate the API's entries.
+    """
+    if not get_setting(config, "CACHE.ENABLED", False):
+        return None
+    backend = get_setting(config, "CACHE.BACKEND", "memory")
+    if shared_only and backend == "memory":
+        return None
+    ttl = get_setting(config, "CACHE.TTL", 5)
+    if backend == "memory":
+        return TTLCache(maxsize=get_setting(config, "CACHE.SIZE", 10000), ttl=ttl)
+    elif backend == "redis":
+        return RedisCache(get_setting(config, "CACHE.URL", "redis://localhost"), ttl)
+    raise ValueError("Unknown cache backend: {}".format(backend))
@@ -0,0 +1,195 @@
+# Copyright 2020-present, Netherlands Institute for Sound and Vision (Nanne van Noord)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##############################################################################
+
+# Message body codecs, selected by the AMQP content_type and content_encoding
+# properties. JSON is the default and what messages without a content_type
+# are assumed to be, MessagePack and zstd need the optional `msgpack` and
+# `zstandard` packages.
+
+import gzip
+import json
+import logging
+from dane_server.settings import get_setting
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None  # type: ignore[assignment]
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None  # type: ignore[assignment]
+
+logger = logging.getLogger("DANE")
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+
+_ALIASES = {
+    None: JSON,
+    "": JSON,
+    "text/plain": JSON,
+    "application/x-msgpack": MSGPACK,
+    "application/vnd.msgpack": MSGPACK,
+}
+
+
+class UnsupportedContentType(ValueError):
+    pass
+
+
+class DecodeError(ValueError):
+    """A message body that could not be decompressed or decoded"""
+
+
+def _json_encode(obj):
+    return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+
+def _json_decode(data):
+    # json.loads takes bytes, but not a memoryview
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    return json.loads(data)
+
+
+def _msgpack_encode(obj):
+    return msgpack.packb(obj, use_bin_type=True)
+
+
+def _msgpack_decode(data):
+    return msgpack.unpackb(data, raw=False)
+
+
+def _zstd_compress(data):
+    return zstandard.ZstdCompressor().compress(data)
+
+
+def _zstd_decompress(data):
+    # decompressobj also handles frames without a content size in the header
+    return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+
+CONTENT_TYPES = {
+    JSON: (_json_encode, _json_decode),
+    MSGPACK: (_msgpack_encode, _msgpack_decode),
+}
+
+CONTENT_ENCODINGS = {
+    "gzip": (gzip.compress, gzip.decompress),
+    "zstd": (_zstd_compress, _zstd_decompress),
+}
+
+_REQUIREMENTS = {
+    MSGPACK: ("msgpack", lambda: msgpack),
+    "zstd": ("zstandard", lambda: zstandard),
+}
+
+
+def _check_encoding(content_encoding):
+    if content_encoding not in CONTENT_ENCODINGS:
+        raise UnsupportedContentType(
+            "Unsupported content encoding: {}".format(content_encoding)
+        )
+    _check_available(content_encoding)
+
+
+def _check_available(name):
+    if name in _REQUIREMENTS:
+        package, module = _REQUIREMENTS[name]
+        if module() is None:
+            raise UnsupportedContentType(
+                "{} requires the {} package".format(name, package)
+            )
+
+
+def normalise_content_type(content_type):
+    if content_type is not None:
+        content_type = content_type.split(";")[0].strip().lower()
+    content_type = _ALIASES.get(content_type, content_type)
+    if content_type not in CONTENT_TYPES:
+        raise UnsupportedContentType(
+            "Unsupported content type: {}".format(content_type)
+        )
+    return content_type
+
+
+def accepted_content_types():
+    """Content types this server can decode, in order of preference"""
+    return [
+        t
+        for t in (MSGPACK, JSON)
+        if t not in _REQUIREMENTS or _REQUIREMENTS[t][1]() is not None
+    ]
+
+
+def decode(body, content_type=None, content_encoding=None):
+    """Decode a message body (bytes or memoryview) to Python objects"""
+    content_type = normalise_content_type(content_type)
+    _check_available(content_type)
+    decompress = None
+    if content_encoding and content_encoding != "identity":
+        _check_encoding(content_encoding)
+        decompress = CONTENT_ENCODINGS[content_encoding][1]
+    try:
+        if decompress is not None:
+            body = decompress(body)
+        return CONTENT_TYPES[content_type][1](body)
+    except Exception as e:
+        # e.g. gzip raises OSError or EOFError, zstandard ZstdError
+        raise DecodeError(
+            "Invalid {} body: {}".format(content_encoding or content_type, e)
+        ) from e
+
+
+class Codec:
+    """Encodes message bodies as `content_type`, compressed with
+    `content_encoding` once they are at least `compress_min_size` bytes.
+    """
+
+    def __init__(
+        self, content_type=JSON, content_encoding=None, compress_min_size=1024
+    ):
+        self.content_type = normalise_content_type(content_type)
+        _check_available(self.content_type)
+        if content_encoding is not None:
+            _check_encoding(content_encoding)
+        self.content_encoding = content_encoding
+        self.compress_min_size = compress_min_size
+
+    def encode(self, obj):
+        """Returns (body, content_type, content_encoding or None)"""
+        body = CONTENT_TYPES[self.content_type][0](obj)
+        if self.content_encoding and len(body) >= self.compress_min_size:
+            compress = CONTENT_ENCODINGS[self.content_encoding][0]
+            return compress(body), self.content_type, self.content_encoding
+        return body, self.content_type, None
+
+
+def codecs_from_config(config):
+    """The default codec and the per task key overrides ({key: Codec}), from
+    the DANE_SERVER.CODEC settings.
+    """
+    encoding = get_setting(config, "CODEC.CONTENT_ENCODING", None)
+    min_size = get_setting(config, "CODEC.COMPRESS_MIN_SIZE", 1024)
+    default = Codec(get_setting(config, "CODEC.CONTENT_TYPE", JSON), encoding, min_size)
+    per_key = {
+        key: Codec(content_type, encoding, min_size)
+        for key, content_type in get_setting(
+            config, "CODEC.KEY_CONTENT_TYPES", {}
+        ).items()
+    }
+    return default, per_key
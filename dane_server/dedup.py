@@ -0,0 +1,76 @@
+# Copyright 2020-present, Netherlands Institute for Sound and Vision (Nanne van Noord)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##############################################################################
+
+import hashlib
+import logging
+from dane_server.cache import TTLCache
+from dane_server.metrics import REGISTRY
+
+logger = logging.getLogger("DANE")
+
+DEDUP_HITS = REGISTRY.counter(
+    "dane_response_dedup_hits_total",
+    "Redelivered worker responses recognised as already handled",
+    ["source"],
+)
+DEDUP_MISSES = REGISTRY.counter(
+    "dane_response_dedup_misses_total",
+    "Redelivered worker responses that had not been handled yet",
+)
+
+
+class ResponseDeduplicator:
+    """Recognises redelivered worker responses that were already handled.
+
+    Handled responses are remembered as (correlation id, body hash) in a
+    bounded LRU/TTL cache. A redelivery that is not in the cache (e.g. after
+    a restart) is checked with `applied(correlation_id, response)`, which
+    should tell whether the response is already reflected in the index.
+    Only redeliveries are checked: a task that is run again may legitimately
+    come back with the very same response.
+
+    is_duplicate() returns where a duplicate was recognised: "cache" for a
+    response that was handled completely, "index" for one whose state update
+    was written but whose follow-up work may not have run, None otherwise.
+    """
+
+    def __init__(self, size=10000, ttl=3600, applied=None):
+        self.cache = TTLCache(maxsize=size, ttl=ttl)
+        self.applied = applied
+
+    @staticmethod
+    def _key(correlation_id, body):
+        return (correlation_id, hashlib.sha1(body).hexdigest())
+
+    def is_duplicate(self, correlation_id, body, response, redelivered):
+        if not redelivered:
+            return None
+        if self._key(correlation_id, body) in self.cache:
+            DEDUP_HITS.inc(source="cache")
+            return "cache"
+        if self.applied is not None:
+            try:
+                if self.applied(correlation_id, response):
+                    DEDUP_HITS.inc(source="index")
+                    return "index"
+            except Exception:
+                logger.exception(
+                    "Could not check response of {}".format(correlation_id)
+                )
+        DEDUP_MISSES.inc()
+        return None
+
+    def handled(self, correlation_id, body):
+        self.cache.set(self._key(correlation_id, body), True)
@@ -0,0 +1,146 @@
+# Copyright 2020-present, Netherlands Institute for Sound and Vision (Nanne van Noord)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##############################################################################
+
+import datetime
+import logging
+import threading
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from dane import Task
+
+logger = logging.getLogger("DANE")
+
+
+def seconds_since(timestamp):
+    """Seconds since an index timestamp (e.g. `created_at`), None if unknown"""
+    if not timestamp:
+        return None
+    try:
+        moment = datetime.datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S")
+    except ValueError:
+        return None
+    return (datetime.datetime.now() - moment).total_seconds()
+
+
+class BatchReport:
+    """Outcome of dispatching one batch of tasks, counted per task key"""
+
+    def __init__(self):
+        self.dispatched = Counter()
+        self.failed = Counter()
+        self.errors = []  # (task_id, error message)
+        self.latencies = []  # (task key, seconds from created_at to dispatch)
+
+    def add(self, task, error=None):
+        key = task["key"]
+        if error is None:
+            self.dispatched[key] += 1
+            latency = seconds_since(task.get("created_at"))
+            if latency is not None:
+                self.latencies.append((key, latency))
+        else:
+            self.failed[key] += 1
+            self.errors.append(error)
+
+    def __str__(self):
+        return "dispatched {} failed {} ({})".format(
+            sum(self.dispatched.values()),
+            sum(self.failed.values()),
+            ", ".join(
+                "{}: {}/{}".format(key, self.dispatched[key], self.failed[key])
+                for key in sorted(set(self.dispatched) | set(self.failed))
+            ),
+        )
+
+
+class TaskDispatcher:
+    """Runs tasks on a pool of `concurrency` threads.
+
+    At most `per_key_concurrency` tasks of the same task key are in flight at
+    any time (None for no cap), so one big backlog cannot occupy every
+    thread. Whenever a thread frees up, the earliest task in the given order
+    whose key is below its cap is started next, so callers control urgency
+    through the order of the batch.
+    The handler and its queue must be safe to use from multiple threads.
+    """
+
+    def __init__(self, handler, concurrency=8, per_key_concurrency=None):
+        self.handler = handler
+        self.concurrency = concurrency
+        self.per_key_concurrency = per_key_concurrency or concurrency
+        self.executor = ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix="DANE-dispatch"
+        )
+
+    def dispatch(self, tasks):
+        report = BatchReport()
+        if len(tasks) == 0:
+            return report
+
+        # only this thread launches tasks, done-callbacks just record the
+        # outcome and wake it up. A callback runs inline if its task already
+        # finished, launching from it would recurse with the backlog.
+        changed = threading.Condition()
+        pending = {}
+        in_flight = Counter()
+        remaining = [len(tasks)]
+
+        for position, task in enumerate(tasks):
+            pending.setdefault(task["key"], deque()).append((position, task))
+
+        def ready():
+            return [
+                key
+                for key, queue in pending.items()
+                if queue and in_flight[key] < self.per_key_concurrency
+            ]
+
+        def can_launch():
+            return sum(in_flight.values()) < self.concurrency and ready()
+
+        def launch():
+            # must be called with the lock held
+            while can_launch():
+                key = min(ready(), key=lambda k: pending[k][0][0])
+                in_flight[key] += 1
+                _, task = pending[key].popleft()
+                future = self.executor.submit(self._run, task)
+                future.add_done_callback(lambda f, t=task: finished(t, f))
+
+        def finished(task, future):
+            key = task["key"]
+            error = future.result()
+            with changed:
+                report.add(task, error)
+                in_flight[key] -= 1
+                remaining[0] -= 1
+                changed.notify()
+
+        with changed:
+            while remaining[0] > 0:
+                launch()
+                changed.wait_for(lambda: remaining[0] == 0 or can_launch())
+        return report
+
+    def _run(self, task):
+        try:
+            Task.from_json(task).set_api(self.handler).run()
+        except Exception as e:
+            logger.exception("Error during task scheduler")
+            return (task["_id"], str(e))
+        return None
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
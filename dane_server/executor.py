@@ -0,0 +1,75 @@
+# Copyright 2020-present, Netherlands Institute for Sound and Vision (Nanne van Noord)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##############################################################################
+
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger("DANE")
+
+
+class KeyedExecutor:
+    """Thread pool that runs jobs with the same key strictly in submission
+    order, one at a time, while jobs with different keys run in parallel.
+
+    At most `max_in_flight` jobs can be queued or running, submit() blocks
+    until there is room. `on_done` is called (from the worker thread) after
+    the job finished, also when it raised.
+    """
+
+    def __init__(self, max_workers=8, max_in_flight=None):
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="DANE-keyed"
+        )
+        self._slots = threading.BoundedSemaphore(max_in_flight or max_workers * 4)
+        self._lock = threading.Lock()
+        self._queues = {}  # key -> deque of jobs waiting behind the running one
+
+    def submit(self, key, fn, *args, on_done=None):
+        self._slots.acquire()
+        job = (fn, args, on_done)
+        with self._lock:
+            if key in self._queues:
+                # a job with this key is running, wait for our turn
+                self._queues[key].append(job)
+                return
+            self._queues[key] = deque()
+        self.executor.submit(self._run, key, job)
+
+    def _run(self, key, job):
+        while job is not None:
+            fn, args, on_done = job
+            try:
+                fn(*args)
+            except Exception:
+                logger.exception("Unhandled error in keyed job {}".format(key))
+            finally:
+                self._slots.release()
+                if on_done is not None:
+                    try:
+                        on_done()
+                    except Exception:
+                        logger.exception("Unhandled error after keyed job")
+
+            with self._lock:
+                if self._queues[key]:
+                    job = self._queues[key].popleft()
+                else:
+                    del self._queues[key]
+                    job = None
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
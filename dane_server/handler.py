@@ -13,14 +13,844 @@
 # limitations under the License.
 ##############################################################################
 
+import datetime
+import hashlib
+import json
 import logging
+from elasticsearch7 import Elasticsearch, helpers, NotFoundError
+from dane import Document, Task, Result, ProcState
+from dane.es_queries import (
+    docs_of_creator_query,
+    tasks_of_creator_query,
+    results_of_creator_query,
+)
 from dane.handlers import ESHandler
+from dane.errors import TaskAssignedError, TaskExistsError
+from dane_server.blobstore import (
+    blob_store_from_config,
+    is_claim_check,
+    offload,
+    CLAIM_CHECK,
+)
+from dane_server.pagination import CursorPager
+from dane_server.settings import get_setting
 
 logger = logging.getLogger("DANE")
 
 
 class Handler(ESHandler):
-    def __init__(self, config, queue):
+    def __init__(self, config, queue, cache=None):
         super().__init__(config, queue)
-        # assigns the ESHandler.callback() to the RabbitMQPublisher
-        self.queue.assign_callback(self.callback)
+        # read-through cache of document, task and result lookups (see
+        # cache.cache_from_config), invalidated when this handler changes them
+        self.cache = cache
+        # tasks assigned in bulk are queued in chunks of this size
+        self.publish_batch_size = get_setting(config, "QUEUE.PUBLISH_BATCH_SIZE", 500)
+        # documents registered per bulk request of an NDJSON import
+        self.ingest_chunk_size = get_setting(config, "API.INGEST_CHUNK_SIZE", 500)
+        # cursor paging, see pager
+        self.cursor_keep_alive = get_setting(config, "API.CURSOR_KEEP_ALIVE", "5m")
+        self.point_in_time = get_setting(config, "API.POINT_IN_TIME", True)
+        # documents fetched per multi-get
+        self.mget_chunk_size = get_setting(config, "API.MGET_CHUNK_SIZE", 500)
+        # documents removed per step of a bulk delete
+        self.delete_chunk_size = get_setting(config, "API.DELETE_CHUNK_SIZE", 1000)
+        # result payloads of at least this many bytes go to the blob store
+        self.claim_check_threshold = get_setting(config, "CLAIM_CHECK.THRESHOLD", 0)
+        self.blobs = blob_store_from_config(config)
+        if self.queue is not None:
+            self.attach_queue(self.queue)
+
+    def attach_queue(self, queue):
+        """Uses `queue`, e.g. once it could connect after the handler was
+        created without one
+        """
+        self.queue = queue
+        # assigns callback() to the RabbitMQPublisher
+        queue.assign_callback(self.callback)
+        if hasattr(queue, "assign_batch_callback"):
+            queue.assign_batch_callback(self.callback_batch)
+        if hasattr(queue, "assign_dedup_check"):
+            queue.assign_dedup_check(self.responseApplied, self.followUp)
+
+    def connect(self):
+        """Connects with a client whose connection pool can be shared by all
+        threads of the process, see ELASTICSEARCH_POOL in the README.
+        """
+        es = Elasticsearch(
+            self.config.ELASTICSEARCH.HOST,
+            http_auth=(
+                self.config.ELASTICSEARCH.USER,
+                self.config.ELASTICSEARCH.PASSWORD,
+            ),
+            scheme=self.config.ELASTICSEARCH.SCHEME,
+            port=self.config.ELASTICSEARCH.PORT,
+            timeout=get_setting(
+                self.config,
+                "ELASTICSEARCH_POOL.TIMEOUT",
+                self.config.ELASTICSEARCH.TIMEOUT,
+            ),
+            retry_on_timeout=(self.config.ELASTICSEARCH.MAX_RETRIES > 0),
+            max_retries=self.config.ELASTICSEARCH.MAX_RETRIES,
+            # open connections per node, kept alive between requests
+            maxsize=get_setting(self.config, "ELASTICSEARCH_POOL.MAXSIZE", 10),
+            http_compress=get_setting(
+                self.config, "ELASTICSEARCH_POOL.HTTP_COMPRESS", False
+            ),
+        )
+        try:
+            exists = es.indices.exists(index=self.INDEX)
+        except Exception:
+            logger.exception("ES Connection Failed")
+            raise ConnectionError("ES Connection Failed")
+        if not exists:
+            # let ESHandler create the index with its mapping
+            super().connect()
+        self.es = es
+
+    def documentFromDocumentId(self, document_id):
+        if self.cache is None:
+            return super().documentFromDocumentId(document_id)
+        data = self.cache.get("document:" + document_id)
+        if data is not None:
+            return Document.from_json(data).set_api(self)
+        document = super().documentFromDocumentId(document_id)
+        self.cache.set("document:" + document_id, document.to_json())
+        return document
+
+    def taskFromTaskId(self, task_id):
+        if self.cache is None:
+            return super().taskFromTaskId(task_id)
+        data = self.cache.get("task:" + task_id)
+        if data is not None:
+            return Task.from_json(data).set_api(self)
+        task = super().taskFromTaskId(task_id)
+        self.cache.set("task:" + task_id, task.to_json())
+        return task
+
+    def resultFromResultId(self, result_id):
+        if self.cache is None:
+            return super().resultFromResultId(result_id)
+        data = self.cache.get("result:" + result_id)
+        if data is not None:
+            return Result.from_json(data)
+        result = super().resultFromResultId(result_id)
+        self.cache.set(
+            "result:" + result_id, json.dumps(json.loads(result.to_json())["result"])
+        )
+        return result
+
+    def invalidate(self, kind, ids):
+        """Drops documents, tasks or results (`kind`) from the cache"""
+        if self.cache is not None:
+            for _id in ids:
+                self.cache.pop("{}:{}".format(kind, _id))
+
+    def invalidateAll(self):
+        """Empties the cache, e.g. after changing an unknown set of tasks"""
+        if self.cache is not None:
+            self.cache.clear()
+
+    def updateTaskState(self, task_id, state, message):
+        super().updateTaskState(task_id, state, message)
+        self.invalidate("task", [task_id])
+
+    def run(self, task_id):
+        # decide on the current state, not on a cached one
+        self.invalidate("task", [task_id])
+        return super().run(task_id)
+
+    def retry(self, task_id, force=False):
+        self.invalidate("task", [task_id])
+        return super().retry(task_id, force)
+
+    def deleteDocument(self, document):
+        references = self._claim_checks(
+            {
+                "has_parent": {
+                    "parent_type": "document",
+                    "query": {"ids": {"values": [document._id]}},
+                }
+            }
+        )
+        try:
+            return super().deleteDocument(document)
+        finally:
+            # also removes the tasks and results of the document
+            self.invalidateAll()
+            self._release_blobs(references)
+
+    def deleteTask(self, task):
+        references = self._claim_checks({"ids": {"values": [task._id]}})
+        try:
+            return super().deleteTask(task)
+        finally:
+            self.invalidate("task", [task._id])
+            self._release_blobs(references)
+
+    def deleteResult(self, result):
+        payload = getattr(result, "payload", None)
+        try:
+            return super().deleteResult(result)
+        finally:
+            self.invalidate("result", [result._id])
+            if is_claim_check(payload):
+                self._release_blobs([payload[CLAIM_CHECK]])
+
+    def registerResult(self, result, task_id):
+        result.payload = offload(result.payload, self.blobs, self.claim_check_threshold)
+        return super().registerResult(result, task_id)
+
+    def callback(self, task_id, response):
+        # like ESHandler.callback(), but the results of a successful task are
+        # only offloaded once its state update is in the index
+        logger.info("Task {} came back with a response".format(task_id))
+        response = dict(response)
+        try:
+            state = int(response.pop("state"))
+            message = response.pop("message")
+            self.updateTaskState(task_id, state, message)
+        except NotFoundError:
+            logger.warning("Callback on non-existing task {}".format(task_id))
+            return
+        except Exception:
+            logger.exception("Unhandled error during callback")
+            return
+        self._follow_up(task_id, state, message, response)
+        if state == ProcState.SUCCESS.value:
+            self.offloadResults([task_id])
+
+    def offloadResults(self, task_ids):
+        """Moves the result payloads of these tasks of CLAIM_CHECK.THRESHOLD
+        bytes or more to the blob store, leaving a claim check in the index.
+        Workers write their results to Elasticsearch themselves, so this runs
+        once their task reported success. Returns the number of offloaded
+        payloads, errors are logged as the task state is already updated.
+        """
+        if not self.claim_check_threshold or not task_ids:
+            return 0
+        try:
+            actions = []
+            for hit in helpers.scan(
+                self.es,
+                index=self.INDEX,
+                query={
+                    "_source": ["result.payload"],
+                    "query": self._results_query({"ids": {"values": list(task_ids)}}),
+                },
+            ):
+                payload = hit["_source"].get("result", {}).get("payload")
+                offloaded = offload(payload, self.blobs, self.claim_check_threshold)
+                if offloaded is payload:
+                    continue
+                actions.append(
+                    {
+                        "_op_type": "update",
+                        "_index": self.INDEX,
+                        "_id": hit["_id"],
+                        "_routing": hit.get("_routing"),
+                        # a partial update would merge the payload objects
+                        "script": {
+                            "source": "ctx._source.result.payload = params.payload",
+                            "lang": "painless",
+                            "params": {"payload": offloaded},
+                        },
+                    }
+                )
+            if not actions:
+                return 0
+            succeeded, errors = helpers.bulk(
+                self.es, actions, raise_on_error=False, refresh=True
+            )
+            self.invalidate("result", [action["_id"] for action in actions])
+            for error in errors:
+                logger.warning("Could not offload result: {}".format(error["update"]))
+            logger.debug("Offloaded {} result payloads".format(succeeded))
+            return succeeded
+        except Exception:
+            logger.exception("Could not offload the results of {}".format(task_ids))
+            return 0
+
+    @staticmethod
+    def _results_query(task_query):
+        """Query for the results of the tasks matching `task_query`"""
+        return {
+            "bool": {
+                "must": [
+                    {"has_parent": {"parent_type": "task", "query": task_query}},
+                    {"exists": {"field": "result.generator.id"}},
+                ]
+            }
+        }
+
+    def _claim_checks(self, task_query):
+        """Blob references of the results of the tasks matching `task_query`"""
+        query = self._results_query(task_query)
+        query["bool"]["must"].append(
+            {"exists": {"field": "result.payload.{}.sha256".format(CLAIM_CHECK)}}
+        )
+        references = {}
+        for hit in helpers.scan(
+            self.es,
+            index=self.INDEX,
+            query={"_source": ["result.payload"], "query": query},
+        ):
+            payload = hit["_source"].get("result", {}).get("payload")
+            if is_claim_check(payload):
+                references[payload[CLAIM_CHECK]["sha256"]] = payload[CLAIM_CHECK]
+        return list(references.values())
+
+    def _release_blobs(self, references):
+        """Deletes the referenced blobs that no result refers to anymore.
+        Blobs are content addressed, so identical payloads share one.
+        """
+        if not references:
+            return
+        try:
+            self.es.indices.refresh(index=self.INDEX)
+            for reference in references:
+                in_use = self.es.count(
+                    index=self.INDEX,
+                    body={
+                        "query": {
+                            "match_phrase": {
+                                "result.payload.{}.sha256".format(
+                                    CLAIM_CHECK
+                                ): reference["sha256"]
+                            }
+                        }
+                    },
+                )["count"]
+                if not in_use:
+                    self.blobs.delete(reference)
+        except Exception:
+            logger.exception("Could not delete the blobs of deleted results")
+
+    def ingestDocuments(self, documents):
+        """Registers documents with one bulk request, like registerDocuments(),
+        but without refreshing the index, for large imports.
+
+        Returns a (status, _id or error message) per document, in order: 201
+        when it was created, 409 when it already existed (also when it occurs
+        twice in `documents`), otherwise the status of the failed create.
+        """
+        now = datetime.datetime.now().replace(microsecond=0).isoformat()
+        actions = []
+        for document in documents:
+            source = json.loads(document.to_json())
+            source["role"] = "document"
+            source["created_at"] = source["updated_at"] = now
+            # same id as ESHandler.registerDocument(), so imports are idempotent
+            document._id = hashlib.sha1(
+                (str(document.target["id"]) + str(document.creator["id"])).encode(
+                    "utf-8"
+                )
+            ).hexdigest()
+            actions.append(
+                {
+                    "_op_type": "create",
+                    "_index": self.INDEX,
+                    "_id": document._id,
+                    "_source": source,
+                }
+            )
+
+        # one item per action, in order: duplicates share an _id
+        statuses = []
+        for ok, item in helpers.streaming_bulk(
+            self.es, actions, chunk_size=max(1, len(actions)), raise_on_error=False
+        ):
+            result = item["create"]
+            if ok:
+                statuses.append((201, result["_id"]))
+            elif result["status"] == ProcState.ALREADY_EXISTS.value:
+                statuses.append((409, "Document already exists"))
+            else:
+                statuses.append((result["status"], result["error"]["reason"]))
+        return statuses
+
+    def documentsFromDocumentIds(self, document_ids):
+        """Fetches documents with one multi-get per chunk of ids.
+
+        Returns (documents, not_found): the documents as dicts, in the order
+        of `document_ids`, and the ids that are not a document.
+        """
+        documents, not_found = [], []
+        document_ids = list(dict.fromkeys(document_ids))  # unique, keeps order
+        for i in range(0, len(document_ids), self.mget_chunk_size):
+            result = self.es.mget(
+                index=self.INDEX,
+                body={"ids": document_ids[i : i + self.mget_chunk_size]},
+                _source_excludes=["role"],
+            )
+            for hit in result["docs"]:
+                # tasks and results share the index, but have no target
+                if hit.get("found") and "target" in hit["_source"]:
+                    documents.append({**hit["_source"], "_id": hit["_id"]})
+                else:
+                    not_found.append(hit["_id"])
+        return documents, not_found
+
+    def deleteDocuments(self, document_ids, progress=None):
+        """Deletes documents, with their tasks and results, in chunks: one
+        delete-by-query for the tasks and results and one bulk delete of the
+        documents per chunk. Ids that do not exist are skipped.
+
+        Calls progress(done, total) after every chunk. Returns the number of
+        deleted documents, and of deleted tasks and results.
+        """
+        document_ids = list(dict.fromkeys(document_ids))
+        deleted = {"documents": 0, "children": 0}
+        references = []
+        for i in range(0, len(document_ids), self.delete_chunk_size):
+            chunk = document_ids[i : i + self.delete_chunk_size]
+            of_documents = {
+                "has_parent": {
+                    "parent_type": "document",
+                    "query": {"ids": {"values": chunk}},
+                }
+            }
+            references.extend(self._claim_checks(of_documents))
+            # same selection as ESHandler.deleteDocument(), for many documents
+            query = {
+                "query": {
+                    "bool": {
+                        "should": [
+                            {
+                                "bool": {
+                                    "must": [
+                                        of_documents,
+                                        {"exists": {"field": "task.key"}},
+                                    ]
+                                }
+                            },
+                            self._results_query(of_documents),
+                        ]
+                    }
+                }
+            }
+            result = self.es.delete_by_query(
+                index=self.INDEX, body=query, conflicts="proceed"
+            )
+            deleted["children"] += result["deleted"]
+
+            succeeded, errors = helpers.bulk(
+                self.es,
+                [
+                    {"_op_type": "delete", "_index": self.INDEX, "_id": document_id}
+                    for document_id in chunk
+                ],
+                raise_on_error=False,
+            )
+            deleted["documents"] += succeeded
+            for error in errors:
+                if error["delete"]["status"] != 404:
+                    raise RuntimeError(
+                        "Bulk document delete failed: {}".format(error["delete"])
+                    )
+
+            if progress is not None:
+                progress(i + len(chunk), len(document_ids))
+
+        self.es.indices.refresh(index=self.INDEX)
+        self.invalidateAll()
+        self._release_blobs(references)
+        logger.debug(
+            "Deleted {} documents and {} tasks and results".format(
+                deleted["documents"], deleted["children"]
+            )
+        )
+        return deleted
+
+    @property
+    def pager(self):
+        return CursorPager(
+            self.es,
+            self.INDEX,
+            keep_alive=self.cursor_keep_alive,
+            point_in_time=self.point_in_time,
+        )
+
+    def searchPage(self, target_id, creator_id, size, cursor=None):
+        """Like search(), but pages with a cursor instead of a page number.
+        Returns (documents, total, next cursor).
+        """
+        # same selection as ESHandler.search()
+        query = {
+            "_source": {"excludes": ["role"]},
+            "query": {
+                "bool": {
+                    "must": [
+                        {"wildcard": {"target.id": {"value": target_id}}},
+                        {"wildcard": {"creator.id": {"value": creator_id}}},
+                    ]
+                }
+            },
+        }
+        hits, total, next_cursor = self.pager.page(query, size, cursor)
+        return [self._document(hit) for hit in hits], total, next_cursor
+
+    def docsOfCreatorPage(self, creator, size, cursor=None):
+        """A page of get_docs_of_creator(), returns (documents, next cursor)"""
+        query = docs_of_creator_query(creator, 0, size)
+        hits, _, next_cursor = self.pager.page(query, size, cursor)
+        return [self._document(hit) for hit in hits], next_cursor
+
+    def tasksOfCreatorPage(self, creator, task_key, size, cursor=None):
+        """A page of get_tasks_of_creator(), returns (tasks, next cursor)"""
+        query = tasks_of_creator_query(creator, task_key, 0, size)
+        hits, _, next_cursor = self.pager.page(query, size, cursor)
+        tasks = []
+        for hit in hits:
+            hit["_source"]["task"]["_id"] = hit["_id"]
+            tasks.append(Task.from_json(hit["_source"]))
+        return tasks, next_cursor
+
+    def resultsOfCreatorPage(self, creator, task_key, size, cursor=None):
+        """A page of get_results_of_creator(), returns (results, next cursor)"""
+        query = results_of_creator_query(creator, task_key, 0, size)
+        hits, _, next_cursor = self.pager.page(query, size, cursor)
+        results = [
+            Result.from_json(
+                json.dumps({"_id": hit["_id"], **hit["_source"]["result"]})
+            )
+            for hit in hits
+        ]
+        return results, next_cursor
+
+    def exportTasksOfCreator(self, creator, task_key, fields=None, chunk_size=1000):
+        """Yields the tasks of get_tasks_of_creator() as dicts, fetching
+        `chunk_size` at a time. `fields` limits the task fields returned.
+        """
+        query = tasks_of_creator_query(creator, task_key, 0, chunk_size)
+        if fields:
+            query["_source"] = ["task." + f for f in fields]
+        for hit in self.pager.walk(query, chunk_size):
+            source = hit["_source"]
+            task = source.pop("task", {})
+            source.pop("role", None)
+            yield {"_id": hit["_id"], **task, **source}
+
+    def exportResultsOfCreator(self, creator, task_key, fields=None, chunk_size=1000):
+        """Yields the results of get_results_of_creator() as dicts, fetching
+        `chunk_size` at a time. `fields` limits the result fields returned,
+        e.g. ["payload.text"].
+        """
+        query = results_of_creator_query(creator, task_key, 0, chunk_size)
+        if fields:
+            query["_source"] = ["result." + f for f in fields]
+        for hit in self.pager.walk(query, chunk_size):
+            yield {"_id": hit["_id"], **hit["_source"].get("result", {})}
+
+    @staticmethod
+    def _document(hit):
+        return Document.from_json({**hit["_source"], "_id": hit["_id"]})
+
+    def _unfinished_query(self, only_runnable=False):
+        # same selection as ESHandler.getUnfinished()
+        query = {
+            "_source": {"excludes": ["role"]},
+            "query": {
+                "bool": {
+                    "must": [
+                        {
+                            "has_parent": {
+                                "parent_type": "document",
+                                "query": {"exists": {"field": "target.id"}},
+                            }
+                        }
+                    ],
+                    "must_not": [
+                        {"match": {"task.state": ProcState.SUCCESS.value}},
+                        {
+                            "match": {
+                                "task.state": ProcState.UNFINISHED_DEPENDENCY.value
+                            }
+                        },
+                    ],
+                }
+            },
+        }
+
+        if only_runnable:
+            query["query"]["bool"]["must_not"].extend(
+                [
+                    {"match": {"task.state": ProcState.NO_ROUTE_TO_QUEUE.value}},
+                    {"match": {"task.state": ProcState.ERROR.value}},
+                    {"match": {"task.state": ProcState.BAD_REQUEST.value}},
+                    {"match": {"task.state": ProcState.ACCESS_DENIED.value}},
+                    {"match": {"task.state": ProcState.NOT_FOUND.value}},
+                    {"match": {"task.state": ProcState.QUEUED.value}},
+                ]
+            )
+        return query
+
+    def getUnfinished(self, only_runnable=False, size=1000):
+        """Unfinished tasks, most urgent (highest priority, then oldest) first"""
+        query = self._unfinished_query(only_runnable)
+        query["sort"] = [
+            {"task.priority": {"order": "desc"}},
+            {"created_at": {"order": "asc"}},
+        ]
+        return self._tasks_from_query(query, size)
+
+    def getUnfinishedSince(self, since=None, only_runnable=True, size=1000):
+        """Like getUnfinished(), but only returns tasks whose `updated_at` is at
+        or after `since` (formatted as stored in the index), oldest change first.
+        """
+        query = self._unfinished_query(only_runnable)
+        if since is not None:
+            query["query"]["bool"]["filter"] = [
+                {"range": {"updated_at": {"gte": since}}}
+            ]
+        query["sort"] = [{"updated_at": {"order": "asc"}}]
+        return self._tasks_from_query(query, size)
+
+    def _tasks_from_query(self, query, size):
+        result = self.es.search(index=self.INDEX, body=query, size=size)
+
+        ret = []
+        for t in result["hits"]["hits"]:
+            t["_source"]["task"]["_id"] = t["_id"]
+            task = Task.from_json(t["_source"])
+            ret.append(json.loads(task.to_json()))
+        return ret
+
+    def markTasks(self, task_ids, message):
+        """Set the message of tasks without changing their state, or their
+        `updated_at`, as that would make the scheduler pick them up again.
+        """
+        actions = [
+            {
+                "_op_type": "update",
+                "_index": self.INDEX,
+                "_id": task_id,
+                "doc": {"task": {"msg": message}},
+            }
+            for task_id in task_ids
+        ]
+        succeeded, errors = helpers.bulk(self.es, actions, raise_on_error=False)
+        self.invalidate("task", task_ids)
+        if len(errors) > 0:
+            logger.warning("Failed to mark {} tasks".format(len(errors)))
+        return succeeded
+
+    def responseApplied(self, task_id, response):
+        """Does the task already have the state and message of this response"""
+        try:
+            doc = self.es.get(index=self.INDEX, id=task_id, _source_includes=["task"])
+        except NotFoundError:
+            return False
+        task = doc["_source"].get("task", {})
+        return task.get("state") == int(response["state"]) and task.get(
+            "msg"
+        ) == response.get("message")
+
+    def _run_async(self, tasks):
+        """Queues the tasks created by assignTaskToMany(), which are all
+        fresh, in chunks: one search for their documents, one bulk state
+        update and a pipelined publish per chunk.
+        """
+        if not hasattr(self.queue, "publish_many"):
+            return super()._run_async(tasks)
+        for i in range(0, len(tasks), self.publish_batch_size):
+            try:
+                self._queue_tasks(tasks[i : i + self.publish_batch_size])
+            except Exception:
+                logger.exception("Exception during async run")
+
+    def _documents_of_tasks(self, task_ids):
+        query = {
+            "_source": {"excludes": ["role"]},
+            "query": {
+                "has_child": {
+                    "type": "task",
+                    "query": {"ids": {"values": task_ids}},
+                    "inner_hits": {"_source": False, "size": 100},
+                }
+            },
+        }
+        result = self.es.search(index=self.INDEX, body=query, size=len(task_ids))
+        documents = {}
+        for hit in result["hits"]["hits"]:
+            document = Document.from_json(
+                json.dumps({**hit["_source"], "_id": hit["_id"]})
+            )
+            for task_hit in hit["inner_hits"]["task"]["hits"]["hits"]:
+                documents[task_hit["_id"]] = document
+        return documents
+
+    def _set_states(self, states):
+        """Bulk update of task states, {task_id: (state, message)}"""
+        now = datetime.datetime.now().replace(microsecond=0).isoformat()
+        actions = [
+            {
+                "_op_type": "update",
+                "_index": self.INDEX,
+                "_id": task_id,
+                "doc": {"task": {"state": state, "msg": message}, "updated_at": now},
+            }
+            for task_id, (state, message) in states.items()
+        ]
+        _, errors = helpers.bulk(self.es, actions, raise_on_error=False, refresh=True)
+        self.invalidate("task", states.keys())
+        return errors
+
+    def _queue_tasks(self, tasks):
+        documents = self._documents_of_tasks([task._id for task in tasks])
+        queued = [task for task in tasks if task._id in documents]
+        for task in tasks:
+            if task._id not in documents:
+                logger.warning("No document found for task {}".format(task._id))
+
+        self._set_states(
+            {task._id: (ProcState.QUEUED.value, "Queued") for task in queued}
+        )
+        failed = self.queue.publish_many(
+            [
+                (
+                    "{}.{}".format(documents[task._id].target["type"], task.key),
+                    task,
+                    documents[task._id],
+                )
+                for task in queued
+            ]
+        )
+        if failed:
+            logger.warning("Failed to queue {} tasks".format(len(failed)))
+            self._set_states(
+                {
+                    task_id: (ProcState.ERROR.value, message)
+                    for task_id, message in failed.items()
+                }
+            )
+
+    def callback_batch(self, responses):
+        """Handles a batch of worker responses, [(task_id, response)].
+
+        All task state updates are written in one bulk request; raises if
+        that fails, so the batch can be redelivered. Follow-up work (assigning
+        dependencies, triggering waiting tasks) is then done per response,
+        like in callback().
+        """
+        now = datetime.datetime.now().replace(microsecond=0).isoformat()
+        updates = []
+        for task_id, response in responses:
+            response = dict(response)
+            state = int(response.pop("state"))
+            message = response.pop("message")
+            updates.append((task_id, state, message, response))
+
+        actions = [
+            {
+                "_op_type": "update",
+                "_index": self.INDEX,
+                "_id": task_id,
+                "doc": {"task": {"state": state, "msg": message}, "updated_at": now},
+            }
+            for task_id, state, message, _ in updates
+        ]
+        _, errors = helpers.bulk(self.es, actions, raise_on_error=False, refresh=True)
+        self.invalidate("task", [task_id for task_id, _, _, _ in updates])
+
+        missing = set()
+        for error in errors:
+            if error["update"]["status"] != 404:
+                raise RuntimeError(
+                    "Bulk task state update failed: {}".format(error["update"])
+                )
+            missing.add(error["update"]["_id"])
+            logger.warning(
+                "Callback on non-existing task {}".format(error["update"]["_id"])
+            )
+
+        logger.debug(
+            "Batch callback: updated {} tasks".format(len(updates) - len(missing))
+        )
+        for task_id, state, message, response in updates:
+            if task_id not in missing:
+                self._follow_up(task_id, state, message, response)
+        self.offloadResults(
+            [
+                task_id
+                for task_id, state, _, _ in updates
+                if task_id not in missing and state == ProcState.SUCCESS.value
+            ]
+        )
+
+    def followUp(self, task_id, response):
+        """Redoes the follow-up work of a response whose state update is
+        already in the index, e.g. redelivered after a crash in between.
+        Tasks that were assigned or triggered before are left alone.
+        """
+        response = dict(response)
+        state = int(response.pop("state"))
+        message = response.pop("message")
+        self._follow_up(task_id, state, message, response)
+        if state == ProcState.SUCCESS.value:
+            self.offloadResults([task_id])
+
+    def _follow_up(self, task_id, state, message, response):
+        # the part of ESHandler.callback() that runs after the state update
+        try:
+            doc = None
+            if state == ProcState.UNFINISHED_DEPENDENCY.value:
+                logger.debug("Dependencies for task {}".format(task_id))
+                doc = self._assign_dependencies(task_id, response.pop("dependencies"))
+            elif state != ProcState.SUCCESS.value:
+                logger.warning(
+                    "Task {} failed with msg: #{} {}".format(task_id, state, message)
+                )
+                # only continue if the task was succesful
+                return
+            else:
+                logger.debug("Callback for task {}".format(task_id))
+
+            # fetch the document that assigned the task
+            if doc is None:
+                doc = self.documentFromTaskId(task_id)
+                doc.set_api(self)
+
+            # see if any other tasks were assigned to this doc and trigger them
+            for at in doc.getAssignedTasks():
+                if at["_id"] != task_id and self._worth_running(at["state"], state):
+                    self.run(at["_id"])
+
+        except TaskExistsError:
+            logger.exception("Callback on non-existing task")
+        except Exception:
+            logger.exception("Unhandled error during callback")
+
+    def _assign_dependencies(self, task_id, dependencies):
+        if len(dependencies) == 0:
+            return None
+        doc = self.documentFromTaskId(task_id)
+        doc.set_api(self)
+
+        for dep in dependencies:
+            if isinstance(dep, dict):
+                td = Task.from_json(dep)
+                td.set_api(self)
+            else:
+                td = Task(dep, api=self)
+            try:
+                td.assign(doc._id)
+            except TaskAssignedError:
+                # e.g. a redelivered response, the task was assigned and run
+                logger.debug("Dependency {} was already assigned".format(td.key))
+                continue
+            self.run(td._id)  # run the task immediately
+        return doc
+
+    @staticmethod
+    def _worth_running(other_state, state):
+        # NOTE: these states are worth a (re)try
+        if other_state in [
+            ProcState.CREATED.value,
+            ProcState.ERROR_INVALID_INPUT.value,
+            ProcState.ERROR_PROXY.value,
+        ]:
+            return True
+        # also trigger tasks that wait for a dependency, unless this one does too
+        waiting = ProcState.UNFINISHED_DEPENDENCY.value
+        return other_state == waiting and state != waiting
@@ -0,0 +1,211 @@
+# Copyright 2020-present, Netherlands Institute for Sound and Vision (Nanne van Noord)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##############################################################################
+
+import datetime
+import logging
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from elasticsearch7 import NotFoundError
+from dane_server.cache import TTLCache
+
+logger = logging.getLogger("DANE")
+
+
+def _now(seconds_ago=0):
+    return (
+        (datetime.datetime.now() - datetime.timedelta(seconds=seconds_ago))
+        .replace(microsecond=0)
+        .isoformat()
+    )
+
+
+class Job:
+    """A long running API operation, e.g. a bulk delete, and its progress.
+    Every change is saved to `store`, if any.
+    """
+
+    def __init__(self, name, total=None, store=None):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.state = "queued"
+        self.total = total
+        self.done = 0
+        self.result = None
+        self.error = None
+        self.created_at = _now()
+        self.updated_at = self.created_at
+        self._lock = threading.Lock()
+        self._store = store
+
+    def progress(self, done, total=None):
+        with self._lock:
+            self.done = done
+            if total is not None:
+                self.total = total
+            self.updated_at = _now()
+        self._save()
+
+    def _finish(self, state, result=None, error=None):
+        with self._lock:
+            self.state = state
+            self.result = result
+            self.error = error
+            self.updated_at = _now()
+        self._save()
+
+    def _save(self):
+        if self._store is None:
+            return
+        try:
+            self._store.save(self)
+        except Exception:
+            # the job itself goes on
+            logger.exception("Could not save the state of job {}".format(self.id))
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "id": self.id,
+                "name": self.name,
+                "state": self.state,
+                "total": self.total,
+                "done": self.done,
+                "result": self.result,
+                "error": self.error,
+                "created_at": self.created_at,
+                "updated_at": self.updated_at,
+            }
+
+
+class MemoryJobStore:
+    """Jobs in the memory of this process, at most `maxsize` of them until
+    `ttl` seconds after they were last changed
+    """
+
+    def __init__(self, maxsize=1000, ttl=24 * 3600):
+        self.jobs = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def save(self, job):
+        self.jobs.set(job.id, job.to_dict())
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def expire(self):
+        pass  # the TTLCache drops them
+
+
+class ElasticsearchJobStore:
+    """Jobs as documents of their own `index`, so any API process can look
+    up a job that another one runs. Jobs created more than `ttl` seconds ago
+    are deleted by expire().
+    """
+
+    def __init__(self, es, index, ttl=24 * 3600):
+        self.es = es
+        self.index = index
+        self.ttl = ttl
+        # the job results are kept, but not indexed
+        self.es.indices.create(
+            index=self.index,
+            body={
+                "mappings": {
+                    "dynamic": False,
+                    "properties": {"created_at": {"type": "date"}},
+                }
+            },
+            ignore=400,  # it exists
+        )
+
+    def save(self, job):
+        self.es.index(index=self.index, id=job.id, body=job.to_dict())
+
+    def get(self, job_id):
+        try:
+            return self.es.get(index=self.index, id=job_id)["_source"]
+        except NotFoundError:
+            return None
+
+    def expire(self):
+        self.es.delete_by_query(
+            index=self.index,
+            body={"query": {"range": {"created_at": {"lt": _now(self.ttl)}}}},
+            conflicts="proceed",
+        )
+
+
+class JobRunner:
+    """Runs jobs on a pool of `max_workers` threads, and keeps their state in
+    `store` (by default a MemoryJobStore) so they can be looked up by id.
+    """
+
+    def __init__(self, max_workers=2, store=None):
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="DANE-job"
+        )
+        self.store = store if store is not None else MemoryJobStore()
+        self._active = set()  # jobs of this process that did not finish yet
+        self._lock = threading.Lock()
+
+    def submit(self, name, fn, *args, total=None):
+        """Runs fn(job, *args) in the background, its return value becomes
+        the result of the job
+        """
+        try:
+            self.store.expire()
+        except Exception:
+            logger.exception("Could not remove expired jobs")
+        job = Job(name, total, self.store)
+        job._save()
+        with self._lock:
+            self._active.add(job)
+        self.executor.submit(self._run, job, fn, args)
+        return job
+
+    def _run(self, job, fn, args):
+        job._finish("running")
+        try:
+            result = fn(job, *args)
+        except Exception as e:
+            logger.exception("Job {} ({}) failed".format(job.id, job.name))
+            job._finish("failed", error=str(e))
+        else:
+            job._finish("done", result=result)
+        finally:
+            with self._lock:
+                self._active.discard(job)
+
+    def get(self, job_id):
+        """The state of a job as a dict, None if it is not known"""
+        return self.store.get(job_id)
+
+    def busy(self):
+        """Whether jobs of this process are queued or running"""
+        with self._lock:
+            return len(self._active) > 0
+
+    def interrupt(self):
+        """Marks the unfinished jobs of this process as failed, e.g. when the
+        process has to exit before they are done
+        """
+        with self._lock:
+            active = list(self._active)
+        for job in active:
+            logger.warning("Interrupting job {} ({})".format(job.id, job.name))
+            job._finish("failed", error="Interrupted, the API process stopped")
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
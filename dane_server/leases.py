@@ -0,0 +1,329 @@
+# Copyright 2020-present, Netherlands Institute for Sound and Vision (Nanne van Noord)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##############################################################################
+
+import fcntl
+import hashlib
+import json
+import logging
+import math
+import os
+import socket
+import threading
+import time
+from abc import ABC, abstractmethod
+from elasticsearch7.exceptions import ConflictError, NotFoundError
+
+logger = logging.getLogger("DANE")
+
+
+def partition_of(task_id, partitions):
+    digest = hashlib.sha1(str(task_id).encode("utf-8")).hexdigest()
+    return int(digest, 16) % partitions
+
+
+def default_owner():
+    return "{}-{}".format(socket.gethostname(), os.getpid())
+
+
+class LeaseStore(ABC):
+    """Stores which scheduler instance owns which task partition.
+
+    Leases and memberships expire `ttl` seconds after they were last
+    written, expiry is based on wall-clock time so instances sharing a store
+    should have (roughly) synchronised clocks.
+    """
+
+    @abstractmethod
+    def acquire(self, partition, owner, ttl):
+        """Take or renew the lease on `partition`, returns True on success"""
+        return
+
+    @abstractmethod
+    def release(self, partition, owner):
+        return
+
+    @abstractmethod
+    def heartbeat(self, owner, ttl):
+        """Register `owner` as a live scheduler instance"""
+        return
+
+    @abstractmethod
+    def live_owners(self):
+        return
+
+
+class ESLeaseStore(LeaseStore):
+    def __init__(self, es, index):
+        self.es = es
+        self.index = index
+        if not self.es.indices.exists(index=self.index):
+            try:
+                self.es.indices.create(
+                    index=self.index,
+                    body={
+                        "mappings": {
+                            "properties": {
+                                "kind": {"type": "keyword"},
+                                "owner": {"type": "keyword"},
+                                "expires_at": {"type": "double"},
+                            }
+                        }
+                    },
+                )
+            except Exception:
+                # another instance might have created it in the meantime
+                logger.debug("Lease index creation failed", exc_info=True)
+
+    def _write(self, doc_id, body, current):
+        try:
+            if current is None:
+                self.es.index(
+                    index=self.index,
+                    id=doc_id,
+                    body=body,
+                    op_type="create",
+                    refresh=True,
+                )
+            else:
+                self.es.index(
+                    index=self.index,
+                    id=doc_id,
+                    body=body,
+                    if_seq_no=current["_seq_no"],
+                    if_primary_term=current["_primary_term"],
+                    refresh=True,
+                )
+        except ConflictError:
+            return False
+        return True
+
+    def _get(self, doc_id):
+        try:
+            return self.es.get(index=self.index, id=doc_id)
+        except NotFoundError:
+            return None
+
+    def acquire(self, partition, owner, ttl):
+        doc_id = "partition-{}".format(partition)
+        now = time.time()
+        current = self._get(doc_id)
+        if current is not None:
+            held_by = current["_source"]["owner"]
+            if held_by != owner and current["_source"]["expires_at"] > now:
+                return False
+        return self._write(
+            doc_id,
+            {"kind": "partition", "owner": owner, "expires_at": now + ttl},
+            current,
+        )
+
+    def release(self, partition, owner):
+        doc_id = "partition-{}".format(partition)
+        current = self._get(doc_id)
+        if current is None or current["_source"]["owner"] != owner:
+            return
+        try:
+            self.es.delete(
+                index=self.index,
+                id=doc_id,
+                if_seq_no=current["_seq_no"],
+                if_primary_term=current["_primary_term"],
+                refresh=True,
+            )
+        except (ConflictError, NotFoundError):
+            pass
+
+    def heartbeat(self, owner, ttl):
+        self.es.index(
+            index=self.index,
+            id="member-{}".format(owner),
+            body={"kind": "member", "owner": owner, "expires_at": time.time() + ttl},
+            refresh=True,
+        )
+
+    def live_owners(self):
+        result = self.es.search(
+            index=self.index,
+            body={
+                "_source": ["owner"],
+                "query": {
+                    "bool": {
+                        "must": [
+                            {"term": {"kind": "member"}},
+                            {"range": {"expires_at": {"gt": time.time()}}},
+                        ]
+                    }
+                },
+            },
+            size=1000,
+        )
+        return {hit["_source"]["owner"] for hit in result["hits"]["hits"]}
+
+
+class FileLeaseStore(LeaseStore):
+    """Lease store backed by a single JSON file guarded by an flock, for tests
+    and for multiple scheduler processes on a single host.
+    """
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, "scheduler-leases.json")
+        self.lock_path = self.path + ".lock"
+
+    def _update(self, fn):
+        with open(self.lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                state = {}
+                if os.path.exists(self.path):
+                    with open(self.path) as f:
+                        state = json.load(f)
+                result = fn(state)
+                tmp = self.path + ".tmp"
+                with open(tmp, "w") as f:
+                    json.dump(state, f)
+                os.replace(tmp, self.path)
+                return result
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def acquire(self, partition, owner, ttl):
+        def fn(state):
+            now = time.time()
+            current = state.get("partition-{}".format(partition))
+            if current and current["owner"] != owner and current["expires_at"] > now:
+                return False
+            state["partition-{}".format(partition)] = {
+                "owner": owner,
+                "expires_at": now + ttl,
+            }
+            return True
+
+        return self._update(fn)
+
+    def release(self, partition, owner):
+        def fn(state):
+            current = state.get("partition-{}".format(partition))
+            if current and current["owner"] == owner:
+                del state["partition-{}".format(partition)]
+
+        self._update(fn)
+
+    def heartbeat(self, owner, ttl):
+        def fn(state):
+            state["member-{}".format(owner)] = {
+                "owner": owner,
+                "expires_at": time.time() + ttl,
+            }
+
+        self._update(fn)
+
+    def live_owners(self):
+        def fn(state):
+            now = time.time()
+            for key in [k for k, v in state.items() if v["expires_at"] <= now]:
+                del state[key]  # garbage collect expired leases and members
+            return {v["owner"] for k, v in state.items() if k.startswith("member-")}
+
+        return self._update(fn)
+
+
+class PartitionLeases(threading.Thread):
+    """Keeps the leases of one scheduler instance up to date.
+
+    Every `ttl / 3` seconds the instance announces itself, renews the
+    partitions it holds, and then takes over free or expired partitions
+    (or gives some up) until it holds its fair share of them.
+    """
+
+    def __init__(self, store, partitions, owner=None, ttl=15):
+        super().__init__()
+        self.store = store
+        self.partitions = partitions
+        self.owner = owner or default_owner()
+        self.ttl = ttl
+        self.held = frozenset()
+        self.generation = 0  # bumped whenever the set of held partitions changes
+        self.renewed_at = None  # time.monotonic() when the last refresh started
+        self.stopped = threading.Event()
+        self.daemon = True
+
+    def owns(self, task_id):
+        return partition_of(task_id, self.partitions) in self.held
+
+    def run(self):
+        logger.info("Starting partition lease keeper for {}".format(self.owner))
+        while True:
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception("Error while refreshing scheduler leases")
+                self._drop_expiring()
+            if self.stopped.wait(self.ttl / 3):
+                break
+        for partition in self.held:
+            self.store.release(partition, self.owner)
+        self.held = frozenset()
+
+    def stop(self):
+        self.stopped.set()
+
+    def _drop_expiring(self):
+        """Without renewals, the held leases expire `ttl` seconds after the
+        last refresh and other instances may take the partitions over. Stop
+        dispatching them if they would expire before the next attempt.
+        """
+        if not self.held or self.renewed_at is None:
+            return
+        if time.monotonic() + self.ttl / 3 >= self.renewed_at + self.ttl:
+            logger.warning(
+                "{} could not renew its leases, giving up scheduler "
+                "partitions {}".format(self.owner, sorted(self.held))
+            )
+            self.held = frozenset()
+            self.generation += 1
+
+    def refresh(self):
+        started = time.monotonic()
+        self.store.heartbeat(self.owner, self.ttl)
+        owners = self.store.live_owners() | {self.owner}
+        target = math.ceil(self.partitions / len(owners))
+
+        held = {p for p in self.held if self.store.acquire(p, self.owner, self.ttl)}
+
+        # give up partitions beyond our fair share, so new instances can join
+        for partition in sorted(held, reverse=True)[: max(0, len(held) - target)]:
+            self.store.release(partition, self.owner)
+            held.discard(partition)
+
+        # start looking at a per-owner offset to avoid contention on partition 0
+        offset = partition_of(self.owner, self.partitions)
+        for i in range(self.partitions):
+            if len(held) >= target:
+                break
+            partition = (offset + i) % self.partitions
+            if partition not in held and self.store.acquire(
+                partition, self.owner, self.ttl
+            ):
+                held.add(partition)
+
+        if held != self.held:
+            logger.info(
+                "{} now holds scheduler partitions {}".format(self.owner, sorted(held))
+            )
+            self.held = frozenset(held)
+            self.generation += 1
+        # leases were written after `started`, they expire after started + ttl
+        self.renewed_at = started
@@ -0,0 +1,315 @@
+# Copyright 2020-present, Netherlands Institute for Sound and Vision (Nanne van Noord)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##############################################################################
+
+# Durable outbox for task messages: publishing only appends the encoded
+# message to a local SQLite journal, and a relay thread forwards the journal
+# to RabbitMQ in batches. A broker outage therefore delays tasks instead of
+# failing API requests, and messages left in the journal by a crash or
+# restart are sent once the relay runs again.
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+import pika
+from dane_server import codec
+from dane_server.RabbitMQPublisher import TaskMessages, message_ttl
+from dane_server.metrics import REGISTRY
+from dane_server.settings import get_setting
+
+logger = logging.getLogger("DANE")
+
+OUTBOX_DEPTH = REGISTRY.gauge(
+    "dane_outbox_depth", "Task messages in the outbox, waiting to be published"
+)
+OUTBOX_AGE = REGISTRY.gauge(
+    "dane_outbox_oldest_age_seconds", "Age of the oldest message in the outbox"
+)
+OUTBOX_RELAYED = REGISTRY.counter(
+    "dane_outbox_relayed_total", "Task messages published from the outbox"
+)
+OUTBOX_FAILURES = REGISTRY.counter(
+    "dane_outbox_failures_total", "Failed attempts to publish outbox messages"
+)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    routing_key TEXT NOT NULL,
+    properties TEXT NOT NULL,
+    body BLOB NOT NULL,
+    created REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    owner TEXT,
+    lease_until REAL NOT NULL DEFAULT 0
+)
+"""
+
+
+class OutboxJournal:
+    """Append-only SQLite journal of encoded messages.
+
+    Several processes may share the file: a relay leases a batch of rows
+    before publishing them, and rows whose lease expired (e.g. because their
+    relay died) are handed out again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(os.path.realpath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            path, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=FULL")
+        self._db.execute(_SCHEMA)
+
+    def append(self, messages):
+        """Stores [(routing_key, properties, body)] in one transaction"""
+        now = time.time()
+        rows = [
+            (routing_key, _dump_properties(properties), body, now)
+            for routing_key, properties, body in messages
+        ]
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.executemany(
+                    "INSERT INTO outbox (routing_key, properties, body, created) "
+                    "VALUES (?, ?, ?, ?)",
+                    rows,
+                )
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def lease(self, owner, size, duration):
+        """Leases the oldest `size` unleased messages to `owner` for `duration`
+        seconds, returns them as [(id, routing_key, properties, body)]
+        """
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.execute(
+                    "UPDATE outbox SET owner = ?, lease_until = ? WHERE id IN ("
+                    "SELECT id FROM outbox WHERE lease_until < ? ORDER BY id LIMIT ?"
+                    ")",
+                    (owner, now + duration, now, size),
+                )
+                rows = self._db.execute(
+                    "SELECT id, routing_key, properties, body FROM outbox "
+                    "WHERE owner = ? AND lease_until = ? ORDER BY id",
+                    (owner, now + duration),
+                ).fetchall()
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+        return [
+            (row_id, routing_key, _load_properties(properties), body)
+            for row_id, routing_key, properties, body in rows
+        ]
+
+    def remove(self, ids):
+        with self._lock:
+            self._db.executemany(
+                "DELETE FROM outbox WHERE id = ?", [(row_id,) for row_id in ids]
+            )
+
+    def release(self, ids, delay=0):
+        """Returns leased messages to the journal, to be retried after `delay`"""
+        with self._lock:
+            self._db.executemany(
+                "UPDATE outbox SET owner = NULL, lease_until = ?, "
+                "attempts = attempts + 1 WHERE id = ?",
+                [(time.time() + delay, row_id) for row_id in ids],
+            )
+
+    def stats(self):
+        """(number of messages, age of the oldest message in seconds)"""
+        with self._lock:
+            depth, oldest = self._db.execute(
+                "SELECT COUNT(*), MIN(created) FROM outbox"
+            ).fetchone()
+        return depth, 0 if oldest is None else max(0, time.time() - oldest)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def _dump_properties(properties):
+    return json.dumps(
+        {k: v for k, v in vars(properties).items() if v is not None},
+        separators=(",", ":"),
+    )
+
+
+def _load_properties(data):
+    return pika.BasicProperties(**json.loads(data))
+
+
+class Outbox(TaskMessages):
+    """Offers the queue interface of RabbitMQPublisher (assign_callback,
+    publish, publish_many), but only writes messages to an OutboxJournal.
+
+    A relay thread leases up to `batch_size` messages at a time and publishes
+    them with a publisher created by `publisher_factory` (e.g. a
+    PublisherPool), created once RabbitMQ can be reached. Messages that were
+    not confirmed go back to the journal and are retried after `interval`
+    seconds; while RabbitMQ is down the relay backs off exponentially, up to
+    `max_backoff` seconds.
+    """
+
+    def __init__(
+        self,
+        config,
+        journal,
+        publisher_factory,
+        batch_size=100,
+        interval=1,
+        max_backoff=30,
+        lease=120,
+    ):
+        self.config = config
+        self.max_priority = get_setting(config, "QUEUE.MAX_PRIORITY", 10)
+        self.codecs = codec.codecs_from_config(config)
+        self.message_ttl = message_ttl(config)
+        self.journal = journal
+        self.publisher_factory = publisher_factory
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self.lease = lease
+        self.callback = None
+        self.publisher = None
+        self._owner = uuid.uuid4().hex
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._relay = threading.Thread(
+            target=self._run, daemon=True, name="DANE-outbox-relay"
+        )
+
+    def start(self):
+        self._relay.start()
+        return self
+
+    @classmethod
+    def from_config(cls, config, publisher_factory):
+        path = get_setting(
+            config,
+            "OUTBOX.PATH",
+            os.path.join(get_setting(config, "TEMP_FOLDER", "."), "outbox.sqlite"),
+        )
+        return cls(
+            config,
+            OutboxJournal(path),
+            publisher_factory,
+            batch_size=get_setting(config, "OUTBOX.BATCH_SIZE", 100),
+            interval=get_setting(config, "OUTBOX.INTERVAL", 1),
+            max_backoff=get_setting(config, "OUTBOX.MAX_BACKOFF", 30),
+        ).start()
+
+    def assign_callback(self, callback):
+        self.callback = callback
+        if self.publisher is not None:
+            self.publisher.assign_callback(callback)
+
+    def publish(self, routing_key, task, document, retry=False):
+        self.publish_many([(routing_key, task, document)])
+
+    def publish_many(self, messages):
+        """Journals [(routing_key, task, document)]. Nothing fails at this
+        point, so this always returns an empty dict of failures.
+        """
+        self.journal.append(
+            [
+                (routing_key,) + self.message(task, document)
+                for routing_key, task, document in messages
+            ]
+        )
+        self._wakeup.set()
+        return {}
+
+    def is_open(self):
+        # the journal accepts messages whether or not RabbitMQ is up
+        return True
+
+    def _connect(self):
+        if self.publisher is None:
+            self.publisher = self.publisher_factory()
+            if self.callback is not None:
+                self.publisher.assign_callback(self.callback)
+        return self.publisher
+
+    def _run(self):
+        backoff = 0
+        while not self._stopped.is_set():
+            try:
+                relayed = self.relay()
+            except Exception:
+                OUTBOX_FAILURES.inc()
+                backoff = min(max(backoff * 2, self.interval), self.max_backoff)
+                logger.exception("Outbox relay failed, retrying in {}s".format(backoff))
+                self._stopped.wait(backoff)
+                continue
+            backoff = 0
+            if relayed < self.batch_size:
+                # journal drained, wait for new messages
+                self._wakeup.wait(self.interval)
+                self._wakeup.clear()
+
+    def relay(self):
+        """Publishes one batch from the journal, returns its size"""
+        self._update_stats()
+        rows = self.journal.lease(self._owner, self.batch_size, self.lease)
+        if not rows:
+            return 0
+        try:
+            failed = self._connect().publish_encoded_many([row[1:] for row in rows])
+        except Exception:
+            self.journal.release([row[0] for row in rows])
+            raise
+
+        retry = {row[0] for row in rows if row[2].correlation_id in failed}
+        self.journal.remove([row[0] for row in rows if row[0] not in retry])
+        OUTBOX_RELAYED.inc(len(rows) - len(retry))
+        if retry:
+            OUTBOX_FAILURES.inc()
+            logger.warning("{} outbox messages were not confirmed".format(len(retry)))
+            self.journal.release(retry, delay=self.interval)
+        self._update_stats()
+        return len(rows)
+
+    def _update_stats(self):
+        depth, age = self.journal.stats()
+        OUTBOX_DEPTH.set(depth)
+        OUTBOX_AGE.set(age)
+
+    def close(self):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._relay.is_alive():
+            self._relay.join()
+        self.journal.close()
+        if self.publisher is not None:
+            self.publisher.close()
@@ -0,0 +1,141 @@
+# Copyright 2020-present, Netherlands Institute for Sound and Vision (Nanne van Noord)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##############################################################################
+
+# Cursor based paging with search_after, optionally on a point in time so the
+# pages of a walk are consistent. Unlike from/size paging, every page costs the
+# same, also beyond Elasticsearch's max result window. The cursor handed to
+# clients is an opaque token with the point in time and the sort values of the
+# last hit.
+
+import base64
+import binascii
+import json
+import logging
+from elasticsearch7 import NotFoundError, RequestError
+
+logger = logging.getLogger("DANE")
+
+
+class InvalidCursorError(ValueError):
+    pass
+
+
+# the types of the sort values of a hit, anything else is a forged cursor
+_SORT_VALUES = (str, int, float, type(None))
+
+
+def encode_cursor(state):
+    data = json.dumps(state, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(data).decode("ascii").rstrip("=")
+
+
+def decode_cursor(token):
+    try:
+        data = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        state = json.loads(data)
+    except (binascii.Error, ValueError):
+        raise InvalidCursorError("Invalid cursor")
+    if not isinstance(state, dict) or not isinstance(state.get("after"), list):
+        raise InvalidCursorError("Invalid cursor")
+    if not all(isinstance(v, _SORT_VALUES) for v in state["after"]):
+        raise InvalidCursorError("Invalid cursor")
+    if not isinstance(state.get("pit", ""), str):
+        raise InvalidCursorError("Invalid cursor")
+    return state
+
+
+class CursorPager:
+    """Pages through the hits of a query on `index`.
+
+    With `point_in_time` (Elasticsearch 7.10+) a walk sees the index as it
+    was at its first page, kept for `keep_alive` between pages. Without it,
+    hits are sorted on `created_at` and `_id`, and changes during the walk
+    may show up.
+    """
+
+    def __init__(self, es, index, keep_alive="5m", point_in_time=True):
+        self.es = es
+        self.index = index
+        self.keep_alive = keep_alive
+        self.point_in_time = point_in_time
+
+    def page(self, query, size, cursor=None):
+        """Returns (hits, total, next cursor) for the page after `cursor`, or
+        the first page if there is none. The next cursor is None after the
+        last page.
+        """
+        state = decode_cursor(cursor) if cursor else {}
+        body = {k: v for k, v in query.items() if k not in ("from", "size")}
+        body["sort"] = [{"created_at": {"order": "asc"}}]
+        if "after" in state:
+            body["search_after"] = state["after"]
+
+        pit = None
+        try:
+            if self.point_in_time:
+                # the point in time adds the _shard_doc tiebreaker to the sort
+                pit = state.get("pit")
+                if not pit:
+                    pit = self.es.open_point_in_time(
+                        index=self.index, keep_alive=self.keep_alive
+                    )["id"]
+                body["pit"] = {"id": pit, "keep_alive": self.keep_alive}
+                result = self.es.search(body=body, size=size)
+                pit = result.get("pit_id", pit)
+            else:
+                body["sort"].append({"_id": {"order": "asc"}})
+                result = self.es.search(index=self.index, body=body, size=size)
+        except NotFoundError:
+            # the point in time expired
+            raise InvalidCursorError("Expired cursor")
+        except RequestError:
+            if cursor:
+                # e.g. sort values that do not match the sort
+                raise InvalidCursorError("Invalid cursor")
+            raise
+
+        hits = result["hits"]["hits"]
+        if len(hits) < size:
+            self.close(pit)
+            next_cursor = None
+        else:
+            next_state = {"after": hits[-1]["sort"]}
+            if pit is not None:
+                next_state["pit"] = pit
+            next_cursor = encode_cursor(next_state)
+        return hits, result["hits"]["total"]["value"], next_cursor
+
+    def walk(self, query, size):
+        """Yields all hits of the query, fetching `size` hits at a time"""
+        cursor = None
+        try:
+            while True:
+                hits, _, cursor = self.page(query, size, cursor)
+                yield from hits
+                if cursor is None:
+                    return
+        finally:
+            # e.g. the client of a stream went away
+            if cursor is not None:
+                self.close(decode_cursor(cursor).get("pit"))
+
+    def close(self, pit):
+        if pit is None:
+            return
+        try:
+            self.es.close_point_in_time(body={"id": pit})
+        except Exception:
+            # it expires by itself
+            logger.warning("Could not close point in time")
@@ -0,0 +1,356 @@
+# Copyright 2020-present, Netherlands Institute for Sound and Vision (Nanne van Noord)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##############################################################################
+
+# Pre-fork WSGI server for production: the master process binds the listening
+# socket and forks worker processes that accept from it, each serving requests
+# on a fixed number of threads. Workers are forked before any connection to
+# Elasticsearch or RabbitMQ is made, they connect after the fork. A worker
+# that has served `max_requests` requests stops accepting, finishes what it
+# is doing (including background work, see `busy`) and exits, and the master
+# replaces it.
+
+import logging
+import math
+import os
+import random
+import signal
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+logger = logging.getLogger("DANE")
+
+
+def available_cpus(cgroup_root="/sys/fs/cgroup"):
+    """The CPUs this process may use: the ones it is pinned to, capped by the
+    CPU quota of its cgroup (e.g. a Kubernetes CPU limit). os.cpu_count()
+    counts all CPUs of the node.
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:  # not on Linux
+        return os.cpu_count() or 1
+    for quota_file, period_file in (
+        ("cpu.max", None),  # cgroup v2: "<quota> <period>" or "max <period>"
+        ("cpu/cpu.cfs_quota_us", "cpu/cpu.cfs_period_us"),  # cgroup v1
+    ):
+        try:
+            with open(os.path.join(cgroup_root, quota_file)) as f:
+                values = f.read().split()
+            if period_file is not None:
+                with open(os.path.join(cgroup_root, period_file)) as f:
+                    values.append(f.read().strip())
+            quota, period = values[0], values[1]
+        except (OSError, IndexError):
+            continue
+        if quota not in ("max", "-1"):
+            cpus = min(cpus, math.ceil(int(quota) / int(period)))
+        break
+    return max(1, cpus)
+
+
+class _RequestHandler(WSGIRequestHandler):
+    # one request per connection, an idle keep-alive connection would hold
+    # one of the worker's threads
+    protocol_version = "HTTP/1.0"
+
+
+class _WorkerServer(BaseWSGIServer):
+    """Serves requests from an inherited listening socket on a pool of
+    `threads` threads. No new connections are accepted while all threads are
+    busy, so they are left to the other workers.
+    """
+
+    multithread = True
+
+    def __init__(self, host, port, app, fd, threads, max_requests=0, busy=None):
+        super().__init__(host, port, app, handler=_RequestHandler, fd=fd)
+        # several workers wait on the same socket, the ones that lose the
+        # race for a connection must not block in accept()
+        self.socket.setblocking(False)
+        self.executor = ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix="DANE-api"
+        )
+        self.max_requests = max_requests
+        self.busy = busy
+        self.handled = 0
+        self._slots = threading.BoundedSemaphore(threads)
+        self._retiring = threading.Event()
+
+    def _handle_request_noblock(self):
+        if self._retiring.is_set():
+            return  # serve_forever() is about to return
+        with self._slots:
+            pass  # wait for a free thread before accepting
+        super()._handle_request_noblock()
+
+    def process_request(self, request, client_address):
+        self._slots.acquire()
+        self.handled += 1
+        if self.max_requests and self.handled >= self.max_requests:
+            # this request is still served before the worker exits, which
+            # waits for a request after the background work is done
+            if self.busy is None or not self.busy():
+                self.retire()
+        self.executor.submit(self._process, request, client_address)
+
+    def _process(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._slots.release()
+
+    def retire(self):
+        """Stops accepting connections, serve_forever() returns once the
+        requests in progress are done
+        """
+        if not self._retiring.is_set():
+            self._retiring.set()
+            # shutdown() blocks until serve_forever() has returned
+            threading.Thread(target=self.shutdown, daemon=True).start()
+
+    def server_close(self):
+        self.executor.shutdown(wait=True)
+        super().server_close()
+
+
+class PreforkServer:
+    """Serves the WSGI app returned by `app_factory` with `workers` processes
+    of `threads` threads each.
+
+    `app_factory` and `post_fork` are called in every worker after it was
+    forked, `post_fork` e.g. to open connections before the first request.
+    Workers are recycled after `max_requests` requests plus a random jitter
+    of up to `max_requests_jitter`, so they do not all restart at once, 0
+    disables this. On SIGTERM or SIGINT workers get `graceful_timeout`
+    seconds to finish their requests; SIGHUP replaces all workers one by one.
+
+    `busy` is called in a worker to ask whether it has background work (e.g.
+    jobs) that must finish first: it is not recycled until then, and when
+    asked to stop it waits for it until shortly before `graceful_timeout`.
+    `on_exit` is called in a worker right before it exits, e.g. to record
+    the background work it did not finish.
+    """
+
+    def __init__(
+        self,
+        app_factory,
+        host,
+        port,
+        workers=2,
+        threads=8,
+        max_requests=0,
+        max_requests_jitter=0,
+        graceful_timeout=30,
+        post_fork=None,
+        backlog=2048,
+        busy=None,
+        on_exit=None,
+    ):
+        self.app_factory = app_factory
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.threads = threads
+        self.max_requests = max_requests
+        self.max_requests_jitter = max_requests_jitter
+        self.graceful_timeout = graceful_timeout
+        self.post_fork = post_fork
+        self.backlog = backlog
+        self.busy = busy
+        self.on_exit = on_exit
+        self.socket = None
+        self._children = {}  # pid -> time it was forked
+        self._stopping = False
+        self._reload = False
+        self._stop_by = None  # in a worker, when it has to exit
+
+    def bind(self):
+        self.socket = socket.create_server((self.host, self.port), backlog=self.backlog)
+        self.port = self.socket.getsockname()[1]
+        return self.socket
+
+    def run(self):
+        if self.socket is None:
+            self.bind()
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGHUP, self._recycle)
+        logger.info(
+            "Serving on {}:{} with {} workers of {} threads".format(
+                self.host, self.port, self.workers, self.threads
+            )
+        )
+        try:
+            while not self._stopping:
+                self._reap()
+                if self._reload:
+                    self._reload = False
+                    self._replace_all()
+                while not self._stopping and len(self._children) < self.workers:
+                    self._spawn()
+                time.sleep(0.5)
+        finally:
+            self._shutdown()
+            self.socket.close()
+
+    def _stop(self, signum, frame):
+        self._stopping = True
+
+    def _recycle(self, signum, frame):
+        self._reload = True
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                self._work()
+                code = 0
+            except BaseException:
+                logger.exception("Worker {} failed".format(os.getpid()))
+            finally:
+                logging.shutdown()
+                os._exit(code)
+        self._children[pid] = time.monotonic()
+        return pid
+
+    def _reap(self):
+        """Forgets about exited workers"""
+        while self._children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self._children.clear()
+                return
+            if pid == 0:
+                return
+            started = self._children.pop(pid, None)
+            code = os.waitstatus_to_exitcode(status)
+            if code != 0 and not self._stopping:
+                logger.warning("Worker {} exited with {}".format(pid, code))
+                if started is not None and time.monotonic() - started < 1:
+                    # e.g. the app cannot be loaded, do not fork in a loop
+                    time.sleep(1)
+
+    def _replace_all(self):
+        """Replaces the workers one by one, so there always are workers to
+        accept new connections
+        """
+        for pid in list(self._children):
+            self._spawn()
+            self._terminate([pid])
+            self._reap()
+
+    def _terminate(self, pids):
+        """Asks workers to stop, and kills them after graceful_timeout"""
+        self._signal(pids, signal.SIGTERM)
+        pids = self._wait(pids, time.monotonic() + self.graceful_timeout)
+        for pid in pids:
+            logger.warning("Worker {} did not stop in time, killing it".format(pid))
+            self._signal([pid], signal.SIGKILL)
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+            self._children.pop(pid, None)
+
+    @staticmethod
+    def _signal(pids, signum):
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def _wait(self, pids, deadline):
+        """Forgets about the workers in `pids` that exit before `deadline`,
+        returns the others
+        """
+        while True:
+            for pid in pids:
+                try:
+                    done, _ = os.waitpid(pid, os.WNOHANG)
+                except ChildProcessError:
+                    done = pid
+                if done:
+                    self._children.pop(pid, None)
+            pids = [pid for pid in pids if pid in self._children]
+            if not pids or time.monotonic() >= deadline:
+                return pids
+            time.sleep(0.1)
+
+    def _shutdown(self):
+        logger.info("Stopping workers")
+        self._terminate(list(self._children))
+
+    def _work(self):
+        # the master handles SIGINT (e.g. ctrl-c) and SIGHUP
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        app = self.app_factory()
+        if self.post_fork is not None:
+            try:
+                self.post_fork()
+            except Exception:
+                logger.exception("Could not warm up, retrying on first request")
+
+        max_requests = self.max_requests
+        if max_requests and self.max_requests_jitter:
+            max_requests += random.randint(0, self.max_requests_jitter)
+        server = _WorkerServer(
+            self.host,
+            self.port,
+            app,
+            fd=self.socket.fileno(),
+            threads=self.threads,
+            max_requests=max_requests,
+            busy=self.busy,
+        )
+
+        def stop(signum, frame):
+            # leave time for on_exit before the master kills the worker
+            self._stop_by = time.monotonic() + max(0, self.graceful_timeout - 1)
+            server.retire()
+
+        signal.signal(signal.SIGTERM, stop)
+        try:
+            server.serve_forever(poll_interval=0.5)
+        finally:
+            server.server_close()
+        self._wait_until_idle()
+        if self.on_exit is not None:
+            self.on_exit()
+        logger.info(
+            "Worker {} stopped after {} requests".format(os.getpid(), server.handled)
+        )
+
+    def _wait_until_idle(self):
+        """Waits for the background work of this worker, until it is asked to
+        stop and its time is up
+        """
+        while self.busy is not None and self.busy():
+            if self._stop_by is not None and time.monotonic() >= self._stop_by:
+                logger.warning(
+                    "Worker {} stopping with unfinished work".format(os.getpid())
+                )
+                return
+            time.sleep(0.1)
@@ -0,0 +1,153 @@
+# Copyright 2020-present, Netherlands Institute for Sound and Vision (Nanne van Noord)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##############################################################################
+
+import contextlib
+import logging
+import queue
+import threading
+import pika
+from dane.errors import ResourceConnectionError
+from dane_server.RabbitMQPublisher import RabbitMQPublisher
+from dane_server.settings import get_setting
+
+logger = logging.getLogger("DANE")
+
+
+class PublisherPool:
+    """Process wide pool of `size` RabbitMQ publisher connections.
+
+    Offers the queue interface of RabbitMQPublisher (assign_callback, publish)
+    and can be shared by all request threads: every publish checks out one
+    of the connections for its duration, waiting at most `timeout` seconds
+    for one to become free. Closed connections are reopened on checkout, and
+    idle connections are kept alive by a background heartbeat every
+    `heartbeat_interval` seconds.
+    """
+
+    def __init__(self, config, size=2, timeout=30, heartbeat_interval=10):
+        self.config = config
+        self.timeout = timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.callback = None
+        self._publishers = [RabbitMQPublisher(config) for _ in range(size)]
+        self._idle = queue.Queue()
+        for publisher in self._publishers:
+            self._idle.put(publisher)
+
+        self._stopped = threading.Event()
+        self._heartbeat = threading.Thread(
+            target=self._keep_alive, daemon=True, name="DANE-publisher-heartbeat"
+        )
+        self._heartbeat.start()
+
+    @classmethod
+    def from_config(cls, config):
+        """Raises right away if RabbitMQ cannot be reached, rather than
+        after the retries of every publisher's first connect
+        """
+        check_connection(
+            config, timeout=get_setting(config, "PUBLISHER_POOL.CONNECT_TIMEOUT", 5)
+        )
+        return cls(
+            config,
+            size=get_setting(config, "PUBLISHER_POOL.SIZE", 2),
+            timeout=get_setting(config, "PUBLISHER_POOL.TIMEOUT", 30),
+            heartbeat_interval=get_setting(
+                config, "PUBLISHER_POOL.HEARTBEAT_INTERVAL", 10
+            ),
+        )
+
+    @contextlib.contextmanager
+    def checkout(self, timeout=None):
+        try:
+            publisher = self._idle.get(
+                timeout=self.timeout if timeout is None else timeout
+            )
+        except queue.Empty:
+            raise ResourceConnectionError("No free RabbitMQ publisher connection")
+        try:
+            with publisher.internal_lock:
+                publisher.connect()  # only reconnects if the connection closed
+            yield publisher
+        finally:
+            self._idle.put(publisher)
+
+    def assign_callback(self, callback):
+        self.callback = callback
+        for publisher in self._publishers:
+            publisher.assign_callback(callback)
+
+    def publish(self, routing_key, task, document, retry=False):
+        with self.checkout() as publisher:
+            publisher.publish(routing_key, task, document, retry)
+
+    def publish_many(self, messages):
+        with self.checkout() as publisher:
+            return publisher.publish_many(messages)
+
+    def publish_encoded_many(self, messages):
+        with self.checkout() as publisher:
+            return publisher.publish_encoded_many(messages)
+
+    def is_open(self):
+        return all(
+            p.connection is not None and p.connection.is_open for p in self._publishers
+        )
+
+    def _keep_alive(self):
+        while not self._stopped.wait(self.heartbeat_interval):
+            # only idle connections, busy ones are kept alive by their use
+            for _ in range(len(self._publishers)):
+                try:
+                    publisher = self._idle.get_nowait()
+                except queue.Empty:
+                    break
+                try:
+                    publisher.heartbeat()
+                except Exception:
+                    logger.warning("Publisher heartbeat failed, reconnecting")
+                    try:
+                        with publisher.internal_lock:
+                            publisher.connect()
+                    except Exception:
+                        logger.exception("Could not reconnect publisher")
+                finally:
+                    self._idle.put(publisher)
+
+    def close(self):
+        self._stopped.set()
+        for publisher in self._publishers:
+            with publisher.internal_lock:
+                if publisher.connection.is_open:
+                    publisher.connection.close()
+
+
+def check_connection(config, timeout=5):
+    """Opens and closes a single connection to RabbitMQ, raises if that does
+    not succeed within about `timeout` seconds
+    """
+    connection = pika.BlockingConnection(
+        pika.ConnectionParameters(
+            host=config.RABBITMQ.HOST,
+            port=config.RABBITMQ.PORT,
+            credentials=pika.PlainCredentials(
+                config.RABBITMQ.USER, config.RABBITMQ.PASSWORD
+            ),
+            connection_attempts=1,
+            socket_timeout=timeout,
+            stack_timeout=timeout,
+        )
+    )
+    connection.close()
@@ -0,0 +1,253 @@
+# Copyright 2020-present, Netherlands Institute for Sound and Vision (Nanne van Noord)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##############################################################################
+
+# Delayed retries of task messages inside RabbitMQ.
+#
+# Worker queues dead-letter rejected and expired task messages to the
+# <EXCHANGE>-dead queue (set through a policy, as the workers declare their
+# own queues), and with RETRY.UNROUTABLE unroutable tasks end up there too,
+# through an alternate exchange, instead of being returned to the publisher
+# (and set to NO_ROUTE_TO_QUEUE at once). The RetryRelay consumes that queue and
+# republishes each message to a delay queue (<EXCHANGE>-retry-<n>s) whose TTL
+# dead-letters it back to the task exchange, with its original routing key.
+# Only once a task has used up its attempts is its state updated in
+# Elasticsearch.
+
+import logging
+import re
+import urllib.parse
+import pika
+import requests
+from dane.state import ProcState
+from dane_server.RabbitMQPublisher import RabbitMQPublisher
+from dane_server.settings import get_setting
+
+logger = logging.getLogger("DANE")
+
+ATTEMPT_HEADER = "x-dane-attempt"
+DELAY_HEADER = "x-dane-delay"
+
+
+class RetryPolicy:
+    """Backoff `delays` (seconds) per attempt, the last one is used for any
+    further attempts, and the number of attempts per task key.
+    """
+
+    def __init__(self, delays=(10, 60, 300, 1800), max_attempts=3, key_attempts=None):
+        self.delays = sorted(set(delays))
+        self.max_attempts = max_attempts
+        self.key_attempts = dict(key_attempts or {})
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            delays=get_setting(config, "RETRY.DELAYS", [10, 60, 300, 1800]),
+            max_attempts=get_setting(config, "RETRY.MAX_ATTEMPTS", 3),
+            key_attempts=get_setting(config, "RETRY.KEY_MAX_ATTEMPTS", {}),
+        )
+
+    def attempts_for(self, task_key):
+        return self.key_attempts.get(task_key, self.max_attempts)
+
+    def delay(self, attempt):
+        return self.delays[min(attempt, len(self.delays)) - 1]
+
+
+class RetryRelay(RabbitMQPublisher):
+    def __init__(self, config, policy=None):
+        self.policy = policy or RetryPolicy.from_config(config)
+        exchange = config.RABBITMQ.EXCHANGE
+        self.retry_exchange = exchange + "-retry"
+        self.dead_exchange = exchange + "-dead"
+        self.dead_queue = exchange + "-dead"
+        self._stopped = False
+        super().__init__(config)
+
+    def delay_queue(self, delay):
+        return "{}-{}s".format(self.retry_exchange, delay)
+
+    def connect(self):
+        super().connect()
+        self.channel.exchange_declare(
+            exchange=self.retry_exchange, exchange_type="headers", durable=True
+        )
+        for delay in self.policy.delays:
+            queue = self.delay_queue(delay)
+            self.channel.queue_declare(
+                queue=queue,
+                durable=True,
+                arguments={
+                    "x-message-ttl": int(delay * 1000),
+                    # no dead letter routing key, so the original one is kept
+                    "x-dead-letter-exchange": self.config.RABBITMQ.EXCHANGE,
+                },
+            )
+            self.channel.queue_bind(
+                queue=queue,
+                exchange=self.retry_exchange,
+                arguments={"x-match": "all", DELAY_HEADER: str(delay)},
+            )
+        self.channel.exchange_declare(
+            exchange=self.dead_exchange, exchange_type="fanout", durable=True
+        )
+        self.channel.queue_declare(queue=self.dead_queue, durable=True)
+        self.channel.queue_bind(queue=self.dead_queue, exchange=self.dead_exchange)
+        self.channel.basic_qos(prefetch_count=32)
+
+    def apply_policies(self):
+        """Dead-letter the worker queues (and unroutable tasks) to the dead
+        queue. Needs the management plugin, a policy replaces any policy of
+        lower priority on the same queues.
+        """
+        exchange = self.config.RABBITMQ.EXCHANGE
+        pattern = get_setting(
+            self.config,
+            "RETRY.QUEUE_PATTERN",
+            "^(?!{}-|{}$)".format(
+                re.escape(exchange), re.escape(self.config.RABBITMQ.RESPONSE_QUEUE)
+            ),
+        )
+        priority = get_setting(self.config, "RETRY.POLICY_PRIORITY", 0)
+        definition = {"dead-letter-exchange": self.dead_exchange}
+        if self.message_ttl:
+            # dead-lettering removes the expiration of a message, so retried
+            # tasks only expire again through a TTL of the queue itself
+            definition["message-ttl"] = int(self.message_ttl * 1000)
+        self._put_policy(
+            exchange + "-retry-queues",
+            {
+                "pattern": pattern,
+                "apply-to": "queues",
+                "priority": priority,
+                "definition": definition,
+            },
+        )
+        if get_setting(self.config, "RETRY.UNROUTABLE", False):
+            self._put_policy(
+                exchange + "-retry-unroutable",
+                {
+                    "pattern": "^{}$".format(re.escape(exchange)),
+                    "apply-to": "exchanges",
+                    "priority": priority,
+                    "definition": {"alternate-exchange": self.dead_exchange},
+                },
+            )
+        else:
+            # unroutable tasks are returned to the publisher
+            self._delete_policy(exchange + "-retry-unroutable")
+
+    def _policy_url(self, name):
+        return "http://%s:%s/api/policies/%s/%s" % (
+            self.config.RABBITMQ.MANAGEMENT_HOST,
+            self.config.RABBITMQ.MANAGEMENT_PORT,
+            urllib.parse.quote("/", safe=""),
+            urllib.parse.quote(name),
+        )
+
+    def _put_policy(self, name, policy):
+        response = requests.put(
+            self._policy_url(name),
+            json=policy,
+            auth=(self.config.RABBITMQ.USER, self.config.RABBITMQ.PASSWORD),
+            timeout=10,
+        )
+        response.raise_for_status()
+
+    def _delete_policy(self, name):
+        response = requests.delete(
+            self._policy_url(name),
+            auth=(self.config.RABBITMQ.USER, self.config.RABBITMQ.PASSWORD),
+            timeout=10,
+        )
+        if response.status_code != 404:
+            response.raise_for_status()
+
+    def run(self):
+        logger.debug("Starting retry relay")
+        for method, props, body in self.channel.consume(
+            self.dead_queue, inactivity_timeout=1
+        ):
+            with self.internal_lock:
+                if self._stopped:
+                    break
+                if method:
+                    self._on_dead(method, props, body)
+
+    def stop(self):
+        self._stopped = True
+
+    def _on_dead(self, method, props, body):
+        headers = dict(props.headers or {})
+        attempt = int(headers.get(ATTEMPT_HEADER, 0)) + 1
+        reason = self.reason(headers)
+        # routing keys are <target type>.<task key>
+        task_key = method.routing_key.split(".", 1)[-1]
+
+        if attempt <= self.policy.attempts_for(task_key):
+            delay = self.policy.delay(attempt)
+            headers[ATTEMPT_HEADER] = attempt
+            headers[DELAY_HEADER] = str(delay)
+            props.headers = headers
+            # an unroutable task still has its expiration, which would cut
+            # short the delay: the lower of it and the queue's TTL applies
+            props.expiration = None
+            logger.info(
+                "Retrying task {} ({}, {}) in {}s, attempt {}".format(
+                    props.correlation_id, task_key, reason, delay, attempt
+                )
+            )
+            try:
+                self.pub_channel.basic_publish(
+                    exchange=self.retry_exchange,
+                    routing_key=method.routing_key,
+                    properties=props,
+                    mandatory=True,
+                    body=body,
+                )
+            except pika.exceptions.UnroutableError:
+                logger.exception("No delay queue for {}s".format(delay))
+                self._give_up(props.correlation_id, reason, attempt - 1)
+        else:
+            self._give_up(props.correlation_id, reason, attempt - 1)
+        self.channel.basic_ack(delivery_tag=method.delivery_tag)
+
+    def reason(self, headers):
+        """Why a message is in the dead queue: dead-lettering records the
+        queue it left and the reason in its headers, the alternate exchange
+        records nothing. So a message that was last dead-lettered by one of
+        the delay queues (or never) was unroutable.
+        """
+        queue = headers.get("x-last-death-queue")
+        reason = headers.get("x-last-death-reason")
+        deaths = headers.get("x-death") or []
+        if queue is None and deaths:
+            # before RabbitMQ 3.13, the most recent death comes first
+            queue = deaths[0].get("queue")
+            reason = deaths[0].get("reason")
+        if queue is None or queue.startswith(self.retry_exchange + "-"):
+            return "unroutable"
+        return reason or "rejected"
+
+    def _give_up(self, task_id, reason, retries):
+        if reason == "unroutable":
+            state = ProcState.NO_ROUTE_TO_QUEUE.value
+            message = "Unroutable task"
+        else:
+            state = ProcState.ERROR.value
+            message = "Task was {}".format(reason)
+        if retries > 0:
+            message += " (after {} retries)".format(retries)
+        logger.warning("Giving up on task {}: {}".format(task_id, message))
+        self.callback(task_id, {"state": state, "message": message})
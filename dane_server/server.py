@@ -19,10 +19,51 @@ import logging
 from logging.handlers import TimedRotatingFileHandler
 from dane_server.handler import Handler
 from dane_server.RabbitMQListener import RabbitMQListener
+from dane_server.AsyncRabbitMQListener import AsyncRabbitMQListener
 from dane_server.RabbitMQPublisher import RabbitMQPublisher
+from dane_server.admission import AdmissionController, QueueMonitor
+from dane_server.dispatcher import TaskDispatcher, seconds_since
+from dane_server.leases import ESLeaseStore, FileLeaseStore, PartitionLeases
+from dane_server.retry import RetryRelay
+from dane_server.cache import cache_from_config
+from dane_server.metrics import REGISTRY, start_metrics_server
+from dane_server.settings import get_setting
 from dane import Task
 from dane.config import cfg
+import datetime
 import threading
+import time
+
+SCHEDULER_PASS_SECONDS = REGISTRY.histogram(
+    "dane_scheduler_pass_seconds", "Duration of a task scheduler pass"
+)
+SCHEDULER_BATCH_SIZE = REGISTRY.histogram(
+    "dane_scheduler_batch_size",
+    "Number of tasks returned by the unfinished tasks query per pass",
+    buckets=(0, 1, 10, 50, 100, 500, 1000, 5000, 10000),
+)
+TASKS_FETCHED = REGISTRY.counter(
+    "dane_scheduler_tasks_fetched_total", "Tasks fetched by the scheduler", ["key"]
+)
+TASKS_DISPATCHED = REGISTRY.counter(
+    "dane_scheduler_tasks_dispatched_total", "Tasks dispatched", ["key"]
+)
+TASKS_FAILED = REGISTRY.counter(
+    "dane_scheduler_tasks_failed_total", "Tasks that failed to dispatch", ["key"]
+)
+TASKS_HELD = REGISTRY.gauge(
+    "dane_scheduler_tasks_held", "Tasks held back by admission control"
+)
+DISPATCH_LATENCY = REGISTRY.histogram(
+    "dane_task_dispatch_latency_seconds",
+    "Time from task creation to its dispatch to the queue",
+    ["key"],
+    buckets=(1, 5, 10, 30, 60, 300, 900, 3600, 4 * 3600, 24 * 3600),
+)
+HEARTBEAT_MISSES = REGISTRY.counter(
+    "dane_scheduler_heartbeat_misses_total",
+    "Failed queue heartbeats and scheduler passes that started overdue",
+)
 
 
 def main():
@@ -51,24 +92,37 @@ def main():
     logger.addHandler(fh)
     logger.addHandler(ch)
 
-    messageQueue = RabbitMQListener(cfg)
-    # handler = Handler(config=cfg, queue=messageQueue)
+    metrics_port = get_setting(cfg, "METRICS.PORT", None)
+    if metrics_port:
+        start_metrics_server(
+            metrics_port, host=get_setting(cfg, "METRICS.HOST", "0.0.0.0")
+        )
+
+    if get_setting(cfg, "LISTENER.MODE", "blocking") == "asyncio":
+        messageQueue = AsyncRabbitMQListener(cfg)
+    else:
+        messageQueue = RabbitMQListener(cfg)
+    # assigns the handler callbacks to the response listener
+    handler = Handler(
+        config=cfg, queue=messageQueue, cache=cache_from_config(cfg, shared_only=True)
+    )
     logger.info("Connected to ElasticSearch")
     logger.info("Connecting to RabbitMQ")
 
+    if get_setting(cfg, "RETRY.ENABLED", False):
+        start_retry_relay(logger, handler)
+
+    partitions = get_setting(cfg, "SCHEDULER.PARTITIONS", 1)
+    if partitions > 1:
+        # sharded mode, every process schedules its share of the partitions
+        start_scheduler(logger, partitions)
     # only start task scheduler if we run without supervisor
     # or if we're the first (this does restrict naming scheme
     # used in supervisor TODO
-    if "SUPERVISOR_PROCESS_NAME" not in os.environ or os.environ[
+    elif "SUPERVISOR_PROCESS_NAME" not in os.environ or os.environ[
         "SUPERVISOR_PROCESS_NAME"
     ].endswith("_00"):
-        # The Handler wraps an ESHandler and assigns a RabbitMQPublisher as queue
-        es_handler_with_queue = Handler(config=cfg, queue=RabbitMQPublisher(cfg))
-        # TODO make interval configable
-        scheduler = TaskScheduler(
-            handler=es_handler_with_queue, logger=logger, interval=5
-        )
-        scheduler.start()
+        start_scheduler(logger)
     else:
         logger.info(
             os.environ["SUPERVISOR_PROCESS_NAME"] + " started without task scheduler"
@@ -77,28 +131,296 @@ def main():
     messageQueue.run()  # blocking from here on
 
 
+def start_retry_relay(logger, handler):
+    relay = RetryRelay(cfg)
+    # only tasks that used up their retries reach the handler
+    relay.assign_callback(handler.callback)
+    if cfg.RABBITMQ.MANAGEMENT:
+        relay.apply_policies()
+    else:
+        logger.warning(
+            "No RabbitMQ management plugin, worker queues need a dead letter "
+            "exchange policy to {}".format(relay.dead_exchange)
+        )
+    threading.Thread(target=relay.run, daemon=True, name="DANE-retry").start()
+    logger.info("Started retry relay")
+
+
+def start_scheduler(logger, partitions=1):
+    # The Handler wraps an ESHandler and assigns a RabbitMQPublisher as queue
+    es_handler_with_queue = Handler(
+        config=cfg,
+        queue=RabbitMQPublisher(cfg),
+        cache=cache_from_config(cfg, shared_only=True),
+    )
+
+    leases = None
+    if partitions > 1:
+        if get_setting(cfg, "SCHEDULER.LEASE_BACKEND", "elasticsearch") == "file":
+            store = FileLeaseStore(
+                get_setting(cfg, "SCHEDULER.LEASE_DIR", "/tmp/dane-server-leases")
+            )
+        else:
+            store = ESLeaseStore(
+                es_handler_with_queue.es, es_handler_with_queue.INDEX + "-leases"
+            )
+        leases = PartitionLeases(
+            store, partitions, ttl=get_setting(cfg, "SCHEDULER.LEASE_TTL", 15)
+        )
+        leases.start()
+
+    dispatcher = None
+    concurrency = get_setting(cfg, "SCHEDULER.CONCURRENCY", 8)
+    if concurrency > 1:
+        dispatcher = TaskDispatcher(
+            es_handler_with_queue,
+            concurrency=concurrency,
+            per_key_concurrency=get_setting(cfg, "SCHEDULER.PER_KEY_CONCURRENCY", 0),
+        )
+
+    admission = None
+    if get_setting(cfg, "ADMISSION.ENABLED", False):
+        monitor = QueueMonitor(
+            cfg,
+            publisher=es_handler_with_queue.queue,
+            queues=get_setting(cfg, "ADMISSION.QUEUES", {}),
+            refresh=get_setting(cfg, "ADMISSION.REFRESH", 2),
+        )
+        admission = AdmissionController(
+            monitor, high_water=get_setting(cfg, "ADMISSION.HIGH_WATER", 1000)
+        )
+
+    scheduler = TaskScheduler(
+        handler=es_handler_with_queue,
+        logger=logger,
+        interval=get_setting(cfg, "SCHEDULER.INTERVAL", 5),
+        min_interval=get_setting(cfg, "SCHEDULER.MIN_INTERVAL", 0.5),
+        incremental=get_setting(cfg, "SCHEDULER.INCREMENTAL", True),
+        full_rescan_interval=get_setting(cfg, "SCHEDULER.FULL_RESCAN_INTERVAL", 300),
+        batch_size=get_setting(cfg, "SCHEDULER.BATCH_SIZE", 1000),
+        watermark_lag=get_setting(cfg, "SCHEDULER.WATERMARK_LAG", 2),
+        leases=leases,
+        dispatcher=dispatcher,
+        admission=admission,
+        max_held=get_setting(cfg, "ADMISSION.MAX_HELD", 100000),
+    )
+    scheduler.start()
+    return scheduler
+
+
 class TaskScheduler(threading.Thread):
-    def __init__(self, handler, logger, interval=1):
+    """Periodically (re)runs unfinished tasks.
+
+    In incremental mode only tasks whose `updated_at` lies after the last seen
+    change (the watermark) are fetched, with an occasional full rescan as a
+    safety net. The poll interval shrinks to `min_interval` while tasks keep
+    coming in and backs off (doubling) to `interval` when idle.
+    """
+
+    TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"  # matches the `updated_at` index mapping
+
+    def __init__(
+        self,
+        handler,
+        logger,
+        interval=1,
+        min_interval=None,
+        incremental=False,
+        full_rescan_interval=300,
+        batch_size=1000,
+        watermark_lag=2,
+        leases=None,
+        dispatcher=None,
+        admission=None,
+        max_held=100000,
+    ):
         super().__init__()
         self.stopped = threading.Event()
         self.interval = interval
+        self.min_interval = min(
+            interval, min_interval if min_interval is not None else interval
+        )
+        self.incremental = incremental
+        self.full_rescan_interval = full_rescan_interval
+        self.batch_size = batch_size
+        # timestamps are written by several processes with second resolution,
+        # so we re-read a small window before the watermark and dedupe on it
+        self.watermark_lag = watermark_lag
+        self.watermark = None
+        self._seen = {}
+        self._last_full_rescan = None
+        # with leases only tasks in the partitions we hold are dispatched
+        self.leases = leases
+        self._lease_generation = None
+        self.dispatcher = dispatcher
+        # tasks held back by admission control, waiting for queue capacity
+        self.admission = admission
+        self.max_held = max_held
+        self._held = {}
+        self._marked = set()
+        self._last_pass = None
         self.daemon = True
         self.handler = handler
         self.logger = logger
 
     def run(self):
         self.logger.info("Starting Task Scheduler")
-        while not self.stopped.wait(self.interval):
+        wait = self.min_interval
+        while not self.stopped.wait(wait):
+            started = time.monotonic()
+            if self._last_pass is not None and (
+                started - self._last_pass > wait + max(self.interval, 1)
+            ):
+                HEARTBEAT_MISSES.inc()  # woke up late, e.g., a pass took too long
+            self._last_pass = started
+            try:
+                found = self.schedule()
+            except Exception:
+                self.logger.exception("Error during task scheduler")
+                found = 0
+            SCHEDULER_PASS_SECONDS.observe(time.monotonic() - started)
+            wait = self._next_interval(wait, found)
+
+    def stop(self):
+        self.stopped.set()
+
+    def schedule(self):
+        if self.leases is not None and self.leases.generation != self._lease_generation:
+            # partitions changed hands, taken over tasks can predate our watermark
+            self._lease_generation = self.leases.generation
+            self._last_full_rescan = None
+
+        if not self.incremental or self._full_rescan_due():
             unfinished = self.handler.getUnfinished(only_runnable=True)
-            if len(unfinished) > 0:
-                for task in unfinished:
-                    try:
-                        Task.from_json(task).set_api(self.handler).run()
-                    except Exception:
-                        self.logger.exception("Error during task scheduler")
+            self._last_full_rescan = time.monotonic()
+        else:
+            unfinished = self._fetch_changed()
+
+        if self.leases is not None:
+            unfinished = [t for t in unfinished if self.leases.owns(t["_id"])]
+
+        SCHEDULER_BATCH_SIZE.observe(len(unfinished))
+        for task in unfinished:
+            TASKS_FETCHED.inc(key=task["key"])
+
+        if self.admission is not None:
+            unfinished = self._admit(unfinished)
+
+        if len(unfinished) > 0:
+            self._dispatch(unfinished)
+        else:
+            # for heartbeat
+            try:
+                self.handler.queue.heartbeat()
+            except Exception:
+                HEARTBEAT_MISSES.inc()
+                raise
+        return len(unfinished)
+
+    def _admit(self, tasks):
+        # tasks held back earlier are offered again, together with the new ones
+        candidates = dict(self._held)
+        candidates.update((t["_id"], t) for t in tasks)
+        admitted, held = self.admission.admit(
+            sorted(candidates.values(), key=self.urgency)
+        )
+
+        # anything beyond max_held is forgotten, until a rescan finds it again
+        self._held = {t["_id"]: t for t in held[: self.max_held]}
+
+        newly_held = [t_id for t_id in self._held if t_id not in self._marked]
+        if newly_held:
+            self.logger.info(
+                "Holding back {} more tasks until their queue drains ({} held)".format(
+                    len(newly_held), len(self._held)
+                )
+            )
+            self.handler.markTasks(newly_held, "Pending, worker queue is full")
+        self._marked = set(self._held.keys())
+        TASKS_HELD.set(len(self._held))
+        return admitted
+
+    def _dispatch(self, tasks):
+        tasks = sorted(tasks, key=self.urgency)
+        if self.dispatcher is not None:
+            report = self.dispatcher.dispatch(tasks)
+            self.logger.debug("Task scheduler pass: {}".format(report))
+            for key, count in report.dispatched.items():
+                TASKS_DISPATCHED.inc(count, key=key)
+            for key, count in report.failed.items():
+                TASKS_FAILED.inc(count, key=key)
+            for key, latency in report.latencies:
+                DISPATCH_LATENCY.observe(latency, key=key)
+            return
+        for task in tasks:
+            try:
+                Task.from_json(task).set_api(self.handler).run()
+            except Exception:
+                self.logger.exception("Error during task scheduler")
+                TASKS_FAILED.inc(key=task["key"])
             else:
-                # for heartbeat
-                self.handler.queue.connection.process_data_events()
+                TASKS_DISPATCHED.inc(key=task["key"])
+                latency = seconds_since(task.get("created_at"))
+                if latency is not None:
+                    DISPATCH_LATENCY.observe(latency, key=task["key"])
+
+    @staticmethod
+    def urgency(task):
+        # highest priority first, then oldest first
+        return (-int(task.get("priority") or 0), task.get("created_at") or "")
+
+    def _next_interval(self, current, found):
+        if found > 0:
+            return self.min_interval
+        return min(self.interval, max(current, self.min_interval) * 2)
+
+    def _full_rescan_due(self):
+        if self._last_full_rescan is None:
+            return True
+        elapsed = time.monotonic() - self._last_full_rescan
+        return elapsed >= self.full_rescan_interval
+
+    def _fetch_changed(self):
+        since = self._lagged(self.watermark) if self.watermark else None
+        tasks = self.handler.getUnfinishedSince(
+            since, only_runnable=True, size=self.batch_size
+        )
+
+        fresh = []
+        for task in tasks:
+            updated_at = task.get("updated_at")
+            if task["_id"] in self._seen and self._seen[task["_id"]] == updated_at:
+                continue  # already handled this version of the task
+            self._seen[task["_id"]] = updated_at
+            fresh.append(task)
+            if updated_at and (self.watermark is None or updated_at > self.watermark):
+                self.watermark = updated_at
+
+        if len(tasks) >= self.batch_size and len(fresh) == 0:
+            # a full page of already handled tasks sharing the same timestamp,
+            # step over it; anything skipped is picked up by the full rescan
+            self.logger.warning(
+                "Scheduler watermark stalled at {}, skipping ahead".format(
+                    self.watermark
+                )
+            )
+            self.watermark = self._shift(self.watermark, 1)
+
+        if self.watermark:
+            horizon = self._lagged(self.watermark)
+            self._seen = {
+                t_id: t_upd
+                for t_id, t_upd in self._seen.items()
+                if t_upd is not None and t_upd >= horizon
+            }
+        return fresh
+
+    def _lagged(self, timestamp):
+        return self._shift(timestamp, -self.watermark_lag)
+
+    def _shift(self, timestamp, seconds):
+        moment = datetime.datetime.strptime(timestamp, self.TIME_FORMAT)
+        return (moment + datetime.timedelta(seconds=seconds)).strftime(self.TIME_FORMAT)
 
 
 if __name__ == "__main__":
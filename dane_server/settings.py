@@ -0,0 +1,28 @@
+# Copyright 2020-present, Netherlands Institute for Sound and Vision (Nanne van Noord)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##############################################################################
+
+# The DANE base config (dane.config) is frozen and only the top-level node
+# accepts new keys, so all DANE-server specific settings live below the
+# DANE_SERVER section and are optional. This helper resolves a dotted path
+# below DANE_SERVER and falls back to a default if any part is missing.
+
+
+def get_setting(config, path, default=None):
+    node = config.get("DANE_SERVER", None)
+    for part in path.split("."):
+        if node is None or not hasattr(node, "get"):
+            return default
+        node = node.get(part, None)
+    return default if node is None else node
@@ -0,0 +1,120 @@
+# Copyright 2020-present, Netherlands Institute for Sound and Vision (Nanne van Noord)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##############################################################################
+
+import logging
+import threading
+import time
+from collections import deque
+import requests
+
+logger = logging.getLogger("DANE")
+
+
+class QueueSample:
+    __slots__ = ("time", "messages", "consumers", "published", "delivered", "usage")
+
+    def __init__(self, time, queue):
+        stats = queue.get("message_stats", {})
+        self.time = time
+        self.messages = queue.get("messages", 0)
+        self.consumers = queue.get("consumers", 0)
+        # cumulative counters, rates are derived from their differences
+        self.published = stats.get("publish", 0)
+        self.delivered = stats.get("deliver_get", 0)
+        # fraction of time the consumers could take new messages
+        self.usage = queue.get("consumer_utilisation")
+
+
+class WorkerStatsCollector(threading.Thread):
+    """Polls the queues of the RabbitMQ management API every `interval`
+    seconds over one pooled session, and keeps the last `samples` samples
+    per queue in a ring buffer. The /workers/ endpoint is served from these.
+    """
+
+    def __init__(self, config, interval=10, samples=60, timeout=5, exclude=()):
+        super().__init__(daemon=True, name="DANE-worker-stats")
+        self.config = config
+        self.interval = interval
+        self.timeout = timeout
+        self.exclude = set(exclude)
+        self.session = requests.Session()
+        self.session.auth = (config.RABBITMQ.USER, config.RABBITMQ.PASSWORD)
+        self._lock = threading.Lock()
+        self._samples = {}  # queue name -> deque of QueueSample
+        self._max_samples = samples
+        self._stopped = threading.Event()
+        self.updated = None  # time.time() of the last successful poll
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                self.collect()
+            except Exception:
+                logger.exception("Could not collect worker stats")
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        self._stopped.set()
+
+    def collect(self):
+        url = "http://%s:%s/api/queues/" % (
+            self.config.RABBITMQ.MANAGEMENT_HOST,
+            self.config.RABBITMQ.MANAGEMENT_PORT,
+        )
+        response = self.session.get(url, timeout=self.timeout)
+        response.raise_for_status()
+        self.record(response.json(), time.time())
+
+    def record(self, queues, now):
+        """Adds a sample of every queue in a /api/queues response"""
+        queues = [q for q in queues if q["name"] not in self.exclude]
+        with self._lock:
+            for q in queues:
+                if q["name"] not in self._samples:
+                    self._samples[q["name"]] = deque(maxlen=self._max_samples)
+                self._samples[q["name"]].append(QueueSample(now, q))
+            # forget deleted queues
+            for name in set(self._samples) - {q["name"] for q in queues}:
+                del self._samples[name]
+            self.updated = now
+
+    def workers(self):
+        """Latest stats per queue, with message rates (per second) and mean
+        consumer utilisation over the buffered samples
+        """
+        with self._lock:
+            samples = {name: list(s) for name, s in self._samples.items()}
+        workers = []
+        for name, history in sorted(samples.items()):
+            first, last = history[0], history[-1]
+            elapsed = last.time - first.time
+            usage = [s.usage for s in history if s.usage is not None]
+            workers.append(
+                {
+                    "name": name,
+                    "active_workers": last.consumers,
+                    "in_queue": last.messages,
+                    "rate_in": _rate(first.published, last.published, elapsed),
+                    "rate_out": _rate(first.delivered, last.delivered, elapsed),
+                    "utilisation": sum(usage) / len(usage) if usage else None,
+                }
+            )
+        return workers
+
+
+def _rate(first, last, elapsed):
+    if elapsed <= 0 or last < first:  # counters reset when a queue is recreated
+        return None
+    return (last - first) / elapsed
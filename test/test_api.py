@@ -0,0 +1,218 @@
+import io
+import json
+import unittest
+from types import SimpleNamespace
+
+from elasticsearch7 import RequestError
+from elasticsearch7.serializer import JSONSerializer
+
+from dane_server import api
+from dane_server.handler import Handler
+from dane_server.pagination import encode_cursor
+
+
+class FakeQueue:
+    def __init__(self):
+        self.callback = None
+
+    def assign_callback(self, callback):
+        self.callback = callback
+
+
+class FakePublisherPool:
+    reachable = False
+    connects = 0
+
+    @classmethod
+    def from_config(cls, config):
+        cls.connects += 1
+        if not cls.reachable:
+            raise ConnectionError("RabbitMQ is down")
+        return FakeQueue()
+
+
+class FakeHandler:
+    def __init__(self):
+        self.queue = None
+
+    def attach_queue(self, queue):
+        self.queue = queue
+        queue.assign_callback(self.callback)
+
+    def callback(self, task_id, response):
+        pass
+
+
+class TestQueue(unittest.TestCase):
+    def setUp(self):
+        self.saved = (api.PublisherPool, api._publisher_pool, api._handler)
+        api.PublisherPool = FakePublisherPool
+        api._publisher_pool = None
+        api._publisher_pool_retry_at = 0.0
+        FakePublisherPool.reachable = False
+        FakePublisherPool.connects = 0
+
+    def tearDown(self):
+        api.PublisherPool, api._publisher_pool, api._handler = self.saved
+        api._publisher_pool_retry_at = 0.0
+
+    def test_connect_is_retried_after_interval(self):
+        self.assertIsNone(api.get_queue())
+        self.assertIsNone(api.get_queue())
+        self.assertEqual(FakePublisherPool.connects, 1)
+
+        # once the retry interval passed
+        api._publisher_pool_retry_at = 0.0
+        FakePublisherPool.reachable = True
+        self.assertIsInstance(api.get_queue(), FakeQueue)
+        self.assertEqual(FakePublisherPool.connects, 2)
+
+    def test_handler_gets_queue_later(self):
+        handler = FakeHandler()
+        api._handler = handler
+        self.assertIsNone(api.get_handler().queue)
+
+        api._publisher_pool_retry_at = 0.0
+        FakePublisherPool.reachable = True
+        self.assertIs(api.get_handler(), handler)
+        self.assertIsInstance(handler.queue, FakeQueue)
+        self.assertEqual(handler.queue.callback, handler.callback)
+
+
+class FakeElasticsearch:
+    """Creates documents of a bulk request, once per _id"""
+
+    def __init__(self):
+        self.transport = SimpleNamespace(serializer=JSONSerializer())
+        self.created = set()
+        self.requests = 0
+
+    def bulk(self, body, **kwargs):
+        self.requests += 1
+        items = []
+        for line in body.splitlines()[::2]:
+            _id = json.loads(line)["create"]["_id"]
+            if _id in self.created:
+                error = {"type": "version_conflict_engine_exception", "reason": "x"}
+                items.append({"create": {"_id": _id, "status": 409, "error": error}})
+            else:
+                self.created.add(_id)
+                items.append({"create": {"_id": _id, "status": 201}})
+        errors = any(item["create"]["status"] != 201 for item in items)
+        return {"errors": errors, "items": items}
+
+
+def document_line(target_id):
+    return json.dumps(
+        {
+            "target": {"id": target_id, "url": "http://x", "type": "Video"},
+            "creator": {"id": "c", "type": "Human"},
+        }
+    )
+
+
+class TestIngest(unittest.TestCase):
+    def setUp(self):
+        self.handler = Handler.__new__(Handler)  # without connecting
+        self.handler.INDEX = "dane-index"
+        self.handler.es = FakeElasticsearch()
+        self.handler.ingest_chunk_size = 2
+        self.handler.queue = SimpleNamespace()  # connected
+        self.saved = api._handler
+        api._handler = self.handler
+
+    def tearDown(self):
+        api._handler = self.saved
+
+    def _post(self, lines):
+        response = api.app.test_client().post(
+            "/DANE/documents/ndjson",
+            input_stream=io.BytesIO("\n".join(lines).encode("utf-8")),
+        )
+        self.assertEqual(response.status_code, 200)
+        return [
+            json.loads(line) for line in response.get_data(as_text=True).splitlines()
+        ]
+
+    def test_statuses_per_line(self):
+        statuses = self._post(
+            [
+                document_line("a"),
+                "not json",
+                "",
+                json.dumps({"_id": "x"}),
+                document_line("a"),
+                document_line("b"),
+            ]
+        )
+        self.assertEqual([s["line"] for s in statuses], [1, 2, 4, 5, 6])
+        self.assertEqual([s["status"] for s in statuses], [201, 400, 400, 409, 201])
+        self.assertEqual(statuses[1]["error"], "Invalid document format")
+        self.assertEqual(statuses[3]["error"], "Document already exists")
+        # one bulk request per chunk of 2 documents
+        self.assertEqual(self.handler.es.requests, 2)
+
+    def test_missing_field(self):
+        line = json.loads(document_line("b"))
+        del line["target"]["type"]
+        statuses = self._post([document_line("a"), json.dumps(line)])
+        self.assertEqual([s["status"] for s in statuses], [201, 400])
+        self.assertEqual(statuses[1]["error"], "Invalid document format")
+        self.assertEqual(len(self.handler.es.created), 1)
+
+    def test_duplicates_in_one_chunk(self):
+        statuses = self._post([document_line("a"), document_line("a")])
+        self.assertEqual([s["status"] for s in statuses], [201, 409])
+        self.assertIn("_id", statuses[0])
+        self.assertNotIn("_id", statuses[1])
+        self.assertEqual(self.handler.es.requests, 1)
+
+
+class RejectingElasticsearch:
+    """Rejects every search, as Elasticsearch does with forged sort values"""
+
+    def open_point_in_time(self, index, keep_alive):
+        return {"id": "pit-1"}
+
+    def close_point_in_time(self, body):
+        pass
+
+    def search(self, body, size, index=None):
+        raise RequestError(400, "parsing_exception", {})
+
+
+class TestSearch(unittest.TestCase):
+    def setUp(self):
+        self.handler = Handler.__new__(Handler)  # without connecting
+        self.handler.INDEX = "dane-index"
+        self.handler.es = RejectingElasticsearch()
+        self.handler.cursor_keep_alive = "5m"
+        self.handler.point_in_time = True
+        self.handler.queue = SimpleNamespace()  # connected
+        self.saved = api._handler
+        api._handler = self.handler
+
+    def tearDown(self):
+        api._handler = self.saved
+
+    def _search(self, **args):
+        return api.app.test_client().get("/DANE/search/document/", query_string=args)
+
+    def test_invalid_cursor(self):
+        for cursor in (
+            "not a cursor",
+            encode_cursor({"after": [{"script": 1}]}),
+            encode_cursor({"after": ["x"]}),
+        ):
+            response = self._search(cursor=cursor)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.get_json()["message"], "Invalid cursor")
+
+    def test_invalid_page(self):
+        response = self._search(page="x")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_json()["message"], "Invalid page number")
+
+
+if __name__ == "__main__":
+    unittest.main()
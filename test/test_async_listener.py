@@ -0,0 +1,153 @@
+import asyncio
+import json
+import threading
+import unittest
+from types import SimpleNamespace
+
+import pika
+from dane.errors import ResourceConnectionError
+from dane.state import ProcState
+
+from dane_server.AsyncRabbitMQListener import AsyncRabbitMQListener
+
+
+class Config(dict):
+    def __getattr__(self, name):
+        return self[name]
+
+
+class FakeTask:
+    def __init__(self, _id, key="TEST", priority=1):
+        self._id = _id
+        self.key = key
+        self.priority = priority
+
+    def to_json(self):
+        return json.dumps({"_id": self._id, "key": self.key})
+
+
+class FakeDocument:
+    def to_json(self):
+        return json.dumps({"_id": "doc"})
+
+
+class FakeChannel:
+    """Confirms every message from the event loop, like the broker would"""
+
+    def __init__(self, listener, nack=(), unroutable=()):
+        self.listener = listener
+        self.nack = set(nack)
+        self.unroutable = set(unroutable)
+        self.is_open = True
+        self.tag = 0
+        self.acked = []
+
+    def basic_publish(self, exchange, routing_key, properties, mandatory, body):
+        self.tag += 1
+        if properties.correlation_id in self.unroutable:
+            self.listener.loop.call_soon(
+                self.listener._on_return, self, None, properties, body
+            )
+        method = (
+            pika.spec.Basic.Ack
+            if properties.correlation_id not in self.nack
+            else pika.spec.Basic.Nack
+        )
+        frame = SimpleNamespace(method=method(delivery_tag=self.tag))
+        self.listener.loop.call_soon(self.listener._on_confirm, frame)
+
+    def basic_ack(self, delivery_tag):
+        self.acked.append(delivery_tag)
+
+
+class TestAsyncRabbitMQListener(unittest.TestCase):
+    def setUp(self):
+        config = Config(
+            RABBITMQ=Config(RESPONSE_QUEUE="response", EXCHANGE="DANE-exchange"),
+            DANE_SERVER=Config(LISTENER=Config(PUBLISH_TIMEOUT=0.5)),
+        )
+        self.listener = AsyncRabbitMQListener(config)
+        self.responses = []
+        self.listener.assign_callback(
+            lambda task_id, response: self.responses.append((task_id, response))
+        )
+        self.thread = threading.Thread(target=self.listener.loop.run_forever)
+        self.thread.start()
+        self.listener._loop_thread = self.thread
+
+    def tearDown(self):
+        self.listener.loop.call_soon_threadsafe(self.listener.loop.stop)
+        self.thread.join()
+        self.listener.executor.shutdown()
+
+    def _connected(self, **kwargs):
+        self.listener.pub_channel = FakeChannel(self.listener, **kwargs)
+        self.listener._ready.set()
+        return self.listener.pub_channel
+
+    def test_publish_confirmed(self):
+        channel = self._connected()
+        self.listener.publish("Video.TEST", FakeTask("t1"), FakeDocument())
+        self.assertEqual(channel.tag, 1)
+        self.assertEqual(self.listener._confirms, {})
+
+    def test_publish_rejected(self):
+        self._connected(nack=["t1"])
+        with self.assertRaises(ResourceConnectionError):
+            self.listener.publish("Video.TEST", FakeTask("t1"), FakeDocument())
+
+    def test_publish_unroutable(self):
+        self._connected(unroutable=["t1"])
+        self.listener.publish("Video.TEST", FakeTask("t1"), FakeDocument())
+        self.assertEqual(
+            self.responses,
+            [
+                (
+                    "t1",
+                    {
+                        "state": ProcState.NO_ROUTE_TO_QUEUE.value,
+                        "message": "Unroutable task",
+                    },
+                )
+            ],
+        )
+
+    def test_publish_without_channel(self):
+        # the connection dropped after the listener was ready
+        self.listener._ready.set()
+        with self.assertRaises(ResourceConnectionError):
+            self.listener.publish("Video.TEST", FakeTask("t1"), FakeDocument())
+
+        # a publish waits for the next channel
+        threading.Timer(0.1, self._connected).start()
+        self.listener.publish("Video.TEST", FakeTask("t2"), FakeDocument())
+
+    def test_responses_are_acked_after_callback(self):
+        channel = FakeChannel(self.listener)
+
+        async def handle(messages):
+            self.listener._semaphore = asyncio.Semaphore(2)
+            await asyncio.gather(
+                *(self.listener._handle_response(channel, *m) for m in messages)
+            )
+
+        messages = [
+            (
+                SimpleNamespace(delivery_tag=1),
+                pika.BasicProperties(correlation_id="t1"),
+                b'{"state": 200, "message": "Done"}',
+            ),
+            (
+                SimpleNamespace(delivery_tag=2),
+                pika.BasicProperties(correlation_id="t2"),
+                b"not json",
+            ),
+        ]
+        asyncio.run_coroutine_threadsafe(handle(messages), self.listener.loop).result(5)
+        self.assertEqual(self.responses, [("t1", {"state": 200, "message": "Done"})])
+        # the undecodable response is dropped, but acked
+        self.assertEqual(sorted(channel.acked), [1, 2])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,177 @@
+import json
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+from dane.state import ProcState
+from elasticsearch7 import NotFoundError
+
+from dane_server.blobstore import (
+    BlobChecksumError,
+    FileBlobStore,
+    is_claim_check,
+    offload,
+    CLAIM_CHECK,
+)
+from dane_server.handler import Handler
+
+
+class TestFileBlobStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = FileBlobStore(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _path(self, reference):
+        return os.path.join(self.tmp.name, reference["key"])
+
+    def test_put_and_stream(self):
+        reference = self.store.put(b"x" * 1000)
+        self.assertEqual(reference["backend"], "file")
+        self.assertEqual(reference["size"], 1000)
+        self.assertEqual(b"".join(self.store.stream(reference, 64)), b"x" * 1000)
+
+        # content addressed, the same data is stored once
+        self.assertEqual(self.store.put(b"x" * 1000), reference)
+        self.assertEqual(len(os.listdir(os.path.dirname(self._path(reference)))), 1)
+
+    def test_corrupt_blob_is_not_streamed(self):
+        reference = self.store.put(b"payload")
+        with open(self._path(reference), "wb") as f:
+            f.write(b"changed")
+        with self.assertRaises(BlobChecksumError):
+            self.store.stream(reference)
+
+    def test_delete(self):
+        reference = self.store.put(b"payload")
+        self.assertTrue(self.store.delete(reference))
+        self.assertFalse(self.store.delete(reference))
+        with self.assertRaises(FileNotFoundError):
+            self.store.stream(reference)
+
+    def test_invalid_key(self):
+        with self.assertRaises(ValueError):
+            self.store.open({"key": "../../etc/passwd"})
+
+    def test_offload(self):
+        small = {"a": 1}
+        self.assertIs(offload(small, self.store, 100), small)
+        self.assertIs(offload(small, None, 1), small)
+
+        large = {"a": "x" * 100}
+        claim_check = offload(large, self.store, 100)
+        self.assertTrue(is_claim_check(claim_check))
+        self.assertIs(offload(claim_check, self.store, 1), claim_check)
+        data = b"".join(self.store.stream(claim_check[CLAIM_CHECK]))
+        self.assertEqual(json.loads(data), large)
+
+
+class FakeHandler:
+    def __init__(self, blobs, payload):
+        self.blobs = blobs
+        self.payload = payload
+        self.queue = SimpleNamespace()  # connected
+
+    def resultFromResultId(self, result_id):
+        return SimpleNamespace(_id=result_id, payload=self.payload)
+
+
+class TestResultPayloadAPI(unittest.TestCase):
+    def setUp(self):
+        from dane_server import api
+
+        self.api = api
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = FileBlobStore(self.tmp.name)
+        self.client = api.app.test_client()
+        self.handler = api._handler
+
+    def tearDown(self):
+        self.api._handler = self.handler
+        self.tmp.cleanup()
+
+    def _get(self, payload):
+        self.api._handler = FakeHandler(self.store, payload)
+        return self.client.get("/DANE/result/r1/payload")
+
+    def test_inline_payload(self):
+        response = self._get({"a": 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json(), {"a": 1})
+
+    def test_streamed_payload(self):
+        large = {"a": "x" * 1000}
+        response = self._get(offload(large, self.store, 100))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json(), large)
+        self.assertEqual(
+            response.headers["Content-Length"], str(len(response.get_data()))
+        )
+
+    def test_missing_payload(self):
+        payload = offload({"a": "x" * 1000}, self.store, 100)
+        self.store.delete(payload[CLAIM_CHECK])
+        self.assertEqual(self._get(payload).status_code, 404)
+
+    def test_resolved_in_result(self):
+        large = {"a": "x" * 1000}
+        self.api._handler = FakeHandler(self.store, offload(large, self.store, 100))
+        response = self.client.get("/DANE/result/r1")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()["payload"], large)
+
+    def test_corrupt_payload(self):
+        payload = offload({"a": "x" * 1000}, self.store, 100)
+        with open(os.path.join(self.tmp.name, payload[CLAIM_CHECK]["key"]), "w") as f:
+            f.write("{}")
+        self.assertEqual(self._get(payload).status_code, 500)
+        self.assertEqual(self.client.get("/DANE/result/r1").status_code, 500)
+
+
+class CallbackHandler(Handler):
+    """Records the follow-up work of callback()"""
+
+    def __init__(self, tasks):
+        self.INDEX = "dane-index"
+        self.cache = None
+        self.tasks = tasks
+        self.followed_up = []
+        self.offloaded = []
+
+    def updateTaskState(self, task_id, state, message):
+        if task_id not in self.tasks:
+            raise NotFoundError(404, "document_missing_exception")
+        self.tasks[task_id] = state
+
+    def _follow_up(self, task_id, state, message, response):
+        self.followed_up.append(task_id)
+
+    def offloadResults(self, task_ids):
+        self.offloaded.extend(task_ids)
+
+
+class TestCallback(unittest.TestCase):
+    def test_offloaded_after_state_update(self):
+        handler = CallbackHandler({"t1": 102})
+        response = {"state": ProcState.SUCCESS.value, "message": "Success"}
+        handler.callback("t1", response)
+        self.assertEqual(handler.tasks["t1"], 200)
+        self.assertEqual(handler.offloaded, ["t1"])
+        # the response itself is left alone
+        self.assertEqual(response["state"], 200)
+
+    def test_failed_state_update(self):
+        handler = CallbackHandler({"t1": 102})
+        handler.callback("t2", {"state": 200, "message": "Success"})
+        handler.callback("t1", {"message": "no state"})
+        handler.callback("t1", {"state": "done", "message": "Success"})
+        self.assertEqual(handler.tasks["t1"], 102)
+        self.assertEqual(handler.followed_up, [])
+        self.assertEqual(handler.offloaded, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
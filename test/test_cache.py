@@ -0,0 +1,225 @@
+import copy
+import json
+import time
+import unittest
+from types import SimpleNamespace
+
+from dane.errors import DocumentExistsError, TaskExistsError
+from dane.state import ProcState
+from elasticsearch7 import NotFoundError
+from elasticsearch7.serializer import JSONSerializer
+
+from dane_server import api
+from dane_server.cache import TTLCache, cache_from_config
+from dane_server.dedup import ResponseDeduplicator
+from dane_server.handler import Handler
+
+
+class TestTTLCache(unittest.TestCase):
+    def test_lru_eviction(self):
+        cache = TTLCache(maxsize=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertNotIn("b", cache)
+        self.assertEqual(len(cache), 2)
+
+    def test_expiry(self):
+        cache = TTLCache(ttl=0.05)
+        cache.set("a", 1)
+        self.assertEqual(cache.get("a"), 1)
+        time.sleep(0.1)
+        self.assertIsNone(cache.get("a"))
+
+    def test_from_config(self):
+        self.assertIsNone(cache_from_config({}))
+        config = {"DANE_SERVER": {"CACHE": {"ENABLED": True, "SIZE": 10}}}
+        self.assertEqual(cache_from_config(config).maxsize, 10)
+        # a per process cache is of no use to invalidate the API's entries
+        self.assertIsNone(cache_from_config(config, shared_only=True))
+
+
+class FakeElasticsearch:
+    """An index of a document, its task and the task's result, counting the
+    lookups of the handler
+    """
+
+    def __init__(self):
+        self.transport = SimpleNamespace(serializer=JSONSerializer())
+        self.indices = SimpleNamespace(refresh=lambda index: None)
+        self.lookups = 0
+        self.docs = {
+            "d1": {
+                "target": {"id": "t", "url": "http://x", "type": "Video"},
+                "creator": {"id": "c", "type": "Human"},
+            },
+            "t1": {
+                "task": {"key": "ASR", "state": 201, "msg": "Created", "priority": 1}
+            },
+            "r1": {
+                "result": {
+                    "generator": {
+                        "id": "g",
+                        "type": "Software",
+                        "name": "ASR",
+                        "homepage": "http://g",
+                    },
+                    "payload": {"text": "hello"},
+                }
+            },
+        }
+
+    def get(self, index, id, **kwargs):
+        self.lookups += 1
+        if id not in self.docs:
+            return {"found": False}
+        return {"found": True, "_id": id, "_source": copy.deepcopy(self.docs[id])}
+
+    def search(self, index, body=None, scroll=None, **kwargs):
+        if scroll:
+            # the blob references of deleted results, there are none
+            return {"hits": {"hits": []}}
+        self.lookups += 1
+        (_id,) = [
+            clause["match"]["_id"]
+            for clause in body["query"]["bool"]["must"]
+            if "match" in clause
+        ]
+        hits = []
+        if _id in self.docs:
+            hits.append({"_id": _id, "_source": copy.deepcopy(self.docs[_id])})
+        return {"hits": {"total": {"value": len(hits)}, "hits": hits}}
+
+    def update(self, index, id, body, **kwargs):
+        self.docs[id]["task"].update(body["doc"]["task"])
+
+    def delete(self, index, id, **kwargs):
+        if self.docs.pop(id, None) is None:
+            raise NotFoundError(404, "not_found")
+
+    def delete_by_query(self, index, body, **kwargs):
+        return {"deleted": 0}
+
+    def bulk(self, body, **kwargs):
+        items = []
+        for line in body.splitlines():
+            _id = json.loads(line)["delete"]["_id"]
+            status = 200 if self.docs.pop(_id, None) is not None else 404
+            items.append({"delete": {"_id": _id, "status": status}})
+        return {"errors": False, "items": items}
+
+
+def cached_handler():
+    handler = Handler.__new__(Handler)  # without connecting
+    handler.INDEX = "dane-index"
+    handler.es = FakeElasticsearch()
+    handler.cache = TTLCache()
+    handler.queue = SimpleNamespace()  # connected
+    handler.blobs = None
+    handler.delete_chunk_size = 10
+    return handler
+
+
+class TestHandlerCache(unittest.TestCase):
+    def setUp(self):
+        self.handler = cached_handler()
+        self.es = self.handler.es
+
+    def test_read_through(self):
+        for _ in range(2):
+            document = self.handler.documentFromDocumentId("d1")
+            task = self.handler.taskFromTaskId("t1")
+            result = self.handler.resultFromResultId("r1")
+        self.assertEqual(self.es.lookups, 3)
+        self.assertEqual(document.target["id"], "t")
+        self.assertEqual(task.state, 201)
+        self.assertEqual(result.payload, {"text": "hello"})
+
+    def test_update_task_state(self):
+        self.handler.taskFromTaskId("t1")
+        self.handler.updateTaskState("t1", ProcState.SUCCESS.value, "Success")
+        self.assertEqual(self.handler.taskFromTaskId("t1").state, 200)
+        self.assertEqual(self.es.lookups, 2)
+
+    def test_run_and_retry(self):
+        self.handler.taskFromTaskId("t1")
+        # e.g. changed by another API process
+        self.es.docs["t1"]["task"]["state"] = ProcState.SUCCESS.value
+        # neither queues a finished task again, decided on its current state
+        self.handler.run("t1")
+        self.assertEqual(self.handler.taskFromTaskId("t1").state, 200)
+        self.handler.retry("t1")
+        self.assertEqual(self.es.lookups, 3)
+
+    def test_delete_task(self):
+        task = self.handler.taskFromTaskId("t1")
+        self.assertTrue(self.handler.deleteTask(task))
+        with self.assertRaises(TaskExistsError):
+            self.handler.taskFromTaskId("t1")
+
+    def test_delete_documents(self):
+        self.handler.documentFromDocumentId("d1")
+        self.handler.taskFromTaskId("t1")
+        deleted = self.handler.deleteDocuments(["d1"])
+        self.assertEqual(deleted["documents"], 1)
+        with self.assertRaises(DocumentExistsError):
+            self.handler.documentFromDocumentId("d1")
+        # its tasks and results are dropped too
+        self.assertEqual(len(self.handler.cache), 0)
+
+
+class TestETag(unittest.TestCase):
+    def setUp(self):
+        self.handler = cached_handler()
+        self.saved = api._handler
+        api._handler = self.handler
+        self.client = api.app.test_client()
+
+    def tearDown(self):
+        api._handler = self.saved
+
+    def test_not_modified(self):
+        for url in ("/DANE/document/d1", "/DANE/task/t1", "/DANE/result/r1"):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            etag = response.headers["ETag"]
+            self.assertTrue(etag)
+
+            response = self.client.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.get_data(), b"")
+            self.assertEqual(response.headers["ETag"], etag)
+
+    def test_modified(self):
+        etag = self.client.get("/DANE/task/t1").headers["ETag"]
+        self.handler.updateTaskState("t1", ProcState.SUCCESS.value, "Success")
+        response = self.client.get("/DANE/task/t1", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers["ETag"], etag)
+        self.assertEqual(response.get_json()["state"], "200")
+
+
+class TestResponseDeduplicator(unittest.TestCase):
+    def test_redeliveries(self):
+        checked = []
+
+        def applied(task_id, response):
+            checked.append(task_id)
+            return task_id == "applied"
+
+        dedup = ResponseDeduplicator(applied=applied)
+        body = b'{"state": 200, "message": "Success"}'
+        response = {"state": 200, "message": "Success"}
+
+        dedup.handled("t1", body)
+        # first deliveries are never skipped, a rerun may return the same
+        self.assertIsNone(dedup.is_duplicate("t1", body, response, False))
+        self.assertEqual(dedup.is_duplicate("t1", body, response, True), "cache")
+        self.assertEqual(checked, [])
+
+        # the follow-up work of a response found in the index may not have run
+        self.assertEqual(dedup.is_duplicate("applied", body, response, True), "index")
+        self.assertIsNone(dedup.is_duplicate("t2", body, response, True))
+        self.assertEqual(checked, ["applied", "t2"])
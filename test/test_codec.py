@@ -0,0 +1,46 @@
+import unittest
+
+from dane_server import codec
+
+
+class TestCodec(unittest.TestCase):
+    def test_json_is_default(self):
+        body = b'{"state": 200, "message": "Success"}'
+        self.assertEqual(codec.decode(memoryview(body))["state"], 200)
+        self.assertEqual(
+            codec.decode(body, "application/json; charset=utf-8")["state"], 200
+        )
+
+    def test_compressed_roundtrip(self):
+        response = {"state": 200, "message": "x" * 2000}
+        c = codec.Codec(content_encoding="gzip", compress_min_size=1024)
+        body, content_type, content_encoding = c.encode(response)
+        self.assertEqual(content_encoding, "gzip")
+        self.assertLess(len(body), 2000)
+        self.assertEqual(
+            codec.decode(memoryview(body), content_type, content_encoding), response
+        )
+
+        body, _, content_encoding = c.encode({"state": 200})
+        self.assertIsNone(content_encoding)
+
+    def test_unsupported(self):
+        with self.assertRaises(ValueError):
+            codec.decode(b"<xml/>", "application/xml")
+        with self.assertRaises(ValueError):
+            codec.decode(b"{}", None, "br")
+
+    def test_corrupt(self):
+        body, _, _ = codec.Codec(content_encoding="gzip", compress_min_size=0).encode(
+            {"state": 200}
+        )
+        for corrupt in (b"not gzip", body[:-4], body[:10] + b"x" + body[11:]):
+            with self.assertRaises(codec.DecodeError):
+                codec.decode(memoryview(corrupt), None, "gzip")
+        with self.assertRaises(codec.DecodeError):
+            codec.decode(b"{not json", None)
+
+    @unittest.skipIf(codec.zstandard is None, "requires zstandard")
+    def test_corrupt_zstd(self):
+        with self.assertRaises(codec.DecodeError):
+            codec.decode(b"not zstd", None, "zstd")
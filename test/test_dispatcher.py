@@ -0,0 +1,86 @@
+import threading
+import time
+import unittest
+from concurrent.futures import Future
+
+from dane_server.dispatcher import TaskDispatcher
+
+
+class InlineExecutor:
+    """Runs tasks on submit, so their futures are done before a callback is
+    added and the callback runs inline
+    """
+
+    def submit(self, fn, *args):
+        future = Future()
+        future.set_result(fn(*args))
+        return future
+
+    def shutdown(self, wait=True):
+        pass
+
+
+class RecordingDispatcher(TaskDispatcher):
+    def __init__(self, *args, delay=0, fail=(), **kwargs):
+        super().__init__(None, *args, **kwargs)
+        self.delay = delay
+        self.fail = set(fail)
+        self.started = []
+        self.running = {}
+        self.max_running = {}
+        self._lock = threading.Lock()
+
+    def _run(self, task):
+        key = task["key"]
+        with self._lock:
+            self.started.append(task["_id"])
+            self.running[key] = self.running.get(key, 0) + 1
+            self.max_running[key] = max(self.max_running.get(key, 0), self.running[key])
+        time.sleep(self.delay)
+        with self._lock:
+            self.running[key] -= 1
+        if task["_id"] in self.fail:
+            return (task["_id"], "failed")
+        return None
+
+
+def tasks(key, n):
+    return [{"_id": "{}-{}".format(key, i), "key": key} for i in range(n)]
+
+
+class TestTaskDispatcher(unittest.TestCase):
+    def test_report(self):
+        dispatcher = RecordingDispatcher(concurrency=4, fail=["B-0"])
+        report = dispatcher.dispatch(tasks("A", 3) + tasks("B", 2))
+        dispatcher.shutdown()
+        self.assertEqual(report.dispatched, {"A": 3, "B": 1})
+        self.assertEqual(report.failed, {"B": 1})
+        self.assertEqual(report.errors, [("B-0", "failed")])
+
+    def test_per_key_concurrency(self):
+        dispatcher = RecordingDispatcher(
+            concurrency=4, per_key_concurrency=2, delay=0.01
+        )
+        dispatcher.dispatch(tasks("A", 10) + tasks("B", 2))
+        dispatcher.shutdown()
+        self.assertEqual(dispatcher.max_running["A"], 2)
+        # B was not starved by the backlog of A
+        self.assertLess(dispatcher.started.index("B-0"), 4)
+
+    def test_order(self):
+        dispatcher = RecordingDispatcher(concurrency=1)
+        batch = tasks("A", 2) + tasks("B", 2)
+        batch = [batch[0], batch[2], batch[1], batch[3]]
+        dispatcher.dispatch(batch)
+        dispatcher.shutdown()
+        self.assertEqual(dispatcher.started, [t["_id"] for t in batch])
+
+    def test_finished_tasks_do_not_recurse(self):
+        dispatcher = RecordingDispatcher(concurrency=1)
+        dispatcher.executor = InlineExecutor()
+        report = dispatcher.dispatch(tasks("A", 5000))
+        self.assertEqual(report.dispatched["A"], 5000)
+
+
+if __name__ == "__main__":
+    unittest.main()
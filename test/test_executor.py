@@ -0,0 +1,72 @@
+import threading
+import time
+import unittest
+
+from dane_server.executor import KeyedExecutor
+
+
+class TestKeyedExecutor(unittest.TestCase):
+    def test_same_key_in_order(self):
+        executor = KeyedExecutor(max_workers=4)
+        lock = threading.Lock()
+        order = {"a": [], "b": []}
+        running = {"a": 0, "b": 0}
+        overlap = []
+
+        def job(key, i):
+            with lock:
+                running[key] += 1
+                overlap.append(running[key] > 1)
+            time.sleep(0.001)
+            with lock:
+                order[key].append(i)
+                running[key] -= 1
+
+        for i in range(50):
+            executor.submit("a", job, "a", i)
+            executor.submit("b", job, "b", i)
+        executor.shutdown()
+        self.assertEqual(order["a"], list(range(50)))
+        self.assertEqual(order["b"], list(range(50)))
+        self.assertFalse(any(overlap))
+
+    def test_different_keys_in_parallel(self):
+        executor = KeyedExecutor(max_workers=2)
+        barrier = threading.Barrier(2, timeout=5)
+        executor.submit("a", barrier.wait)
+        executor.submit("b", barrier.wait)
+        executor.shutdown()
+        self.assertFalse(barrier.broken)
+
+    def test_on_done_after_failure(self):
+        executor = KeyedExecutor(max_workers=1)
+        done = []
+
+        def fail():
+            raise ValueError("broken")
+
+        executor.submit("a", fail, on_done=lambda: done.append(1))
+        executor.submit("a", lambda: None, on_done=lambda: done.append(2))
+        executor.shutdown()
+        self.assertEqual(done, [1, 2])
+
+    def test_max_in_flight(self):
+        executor = KeyedExecutor(max_workers=1, max_in_flight=1)
+        release = threading.Event()
+        executor.submit("a", release.wait)
+
+        submitted = threading.Event()
+        thread = threading.Thread(
+            target=lambda: (executor.submit("b", lambda: None), submitted.set())
+        )
+        thread.start()
+        # blocks until the first job is done
+        self.assertFalse(submitted.wait(0.1))
+        release.set()
+        self.assertTrue(submitted.wait(5))
+        thread.join()
+        executor.shutdown()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+import threading
+import unittest
+from types import SimpleNamespace
+
+from elasticsearch7 import NotFoundError
+
+from dane_server.jobs import ElasticsearchJobStore, JobRunner
+
+
+class FakeElasticsearch:
+    def __init__(self):
+        self.indices = SimpleNamespace(create=lambda **kwargs: None)
+        self.docs = {}
+        self.expired = []
+
+    def index(self, index, id, body):
+        self.docs[id] = dict(body)
+
+    def get(self, index, id):
+        if id not in self.docs:
+            raise NotFoundError(404, "not_found")
+        return {"_id": id, "_source": self.docs[id]}
+
+    def delete_by_query(self, index, body, conflicts):
+        self.expired.append(body["query"]["range"]["created_at"]["lt"])
+
+
+class TestJobRunner(unittest.TestCase):
+    def test_progress_and_result(self):
+        runner = JobRunner(max_workers=1)
+
+        def work(job, items):
+            for i in range(len(items)):
+                job.progress(i + 1)
+            return {"deleted": len(items)}
+
+        job = runner.submit("test", work, ["a", "b", "c"], total=3)
+        runner.shutdown()
+        self.assertEqual(job.state, "done")
+        self.assertEqual(job.to_dict()["done"], 3)
+        self.assertEqual(job.result, {"deleted": 3})
+        self.assertEqual(runner.get(job.id), job.to_dict())
+        self.assertIsNone(runner.get("unknown"))
+
+    def test_failure(self):
+        runner = JobRunner(max_workers=1)
+
+        def work(job):
+            raise ValueError("broken")
+
+        job = runner.submit("test", work)
+        runner.shutdown()
+        self.assertEqual(job.state, "failed")
+        self.assertEqual(job.error, "broken")
+
+    def test_busy_and_interrupt(self):
+        runner = JobRunner(max_workers=1)
+        release = threading.Event()
+        job = runner.submit("test", lambda job: release.wait(5))
+        self.assertTrue(runner.busy())
+
+        runner.interrupt()
+        self.assertEqual(runner.get(job.id)["state"], "failed")
+        release.set()
+        runner.shutdown()
+        self.assertFalse(runner.busy())
+
+    def test_elasticsearch_store(self):
+        es = FakeElasticsearch()
+        # e.g. two API processes using the same index
+        runner = JobRunner(max_workers=1, store=ElasticsearchJobStore(es, "jobs"))
+        other = JobRunner(max_workers=1, store=ElasticsearchJobStore(es, "jobs"))
+
+        job = runner.submit("test", lambda job: job.progress(1, 1) or "ok")
+        runner.shutdown()
+        self.assertEqual(other.get(job.id)["state"], "done")
+        self.assertEqual(other.get(job.id)["result"], "ok")
+        self.assertIsNone(other.get("unknown"))
+        self.assertEqual(len(es.expired), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
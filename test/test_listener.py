@@ -0,0 +1,180 @@
+import json
+import threading
+import time
+import unittest
+from types import SimpleNamespace
+
+import pika
+
+from dane_server.executor import KeyedExecutor
+from dane_server.RabbitMQListener import RabbitMQListener
+
+
+class Config(dict):
+    def __getattr__(self, name):
+        return self[name]
+
+
+def config(**listener):
+    return Config(
+        RABBITMQ=Config(RESPONSE_QUEUE="response", EXCHANGE="DANE-exchange"),
+        DANE_SERVER=Config(LISTENER=Config(listener)),
+    )
+
+
+class OfflineListener(RabbitMQListener):
+    def connect(self):
+        pass
+
+
+class FakeChannel:
+    def __init__(self):
+        self.acked = []
+        self.nacked = []
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        self.acked.append((delivery_tag, multiple))
+
+    def basic_nack(self, delivery_tag, multiple=False, requeue=True):
+        self.nacked.append((delivery_tag, multiple))
+
+
+def message(tag, task_id, state=200, redelivered=False, body=None):
+    if body is None:
+        body = json.dumps({"state": state, "message": "Done"}).encode("utf-8")
+    method = SimpleNamespace(delivery_tag=tag, redelivered=redelivered)
+    props = pika.BasicProperties(correlation_id=task_id)
+    return method, props, body
+
+
+class TestRabbitMQListener(unittest.TestCase):
+    def setUp(self):
+        self.channel = FakeChannel()
+        self.called = []
+        self.followed_up = []
+        self.applied = set()
+
+    def _listener(self, **settings):
+        listener = OfflineListener(config(**settings))
+        listener.assign_callback(lambda t, r: self.called.append((t, r["state"])))
+        listener.assign_batch_callback(
+            lambda responses: self.called.extend((t, r["state"]) for t, r in responses)
+        )
+        listener.assign_dedup_check(
+            lambda t, r: t in self.applied,
+            lambda t, r: self.followed_up.append(t),
+        )
+        return listener
+
+    def test_redelivery_redoes_follow_up(self):
+        listener = self._listener()
+        self.applied.add("t1")
+
+        # not in the dedup cache, but the state is in the index: the state
+        # update is not repeated, the follow-up work is
+        listener._on_response(self.channel, *message(1, "t1", redelivered=True))
+        self.assertEqual(self.called, [])
+        self.assertEqual(self.followed_up, ["t1"])
+        self.assertEqual(self.channel.acked, [(1, False)])
+
+        # once handled it is skipped altogether
+        listener._on_response(self.channel, *message(2, "t1", redelivered=True))
+        self.assertEqual(self.followed_up, ["t1"])
+        self.assertEqual(self.channel.acked, [(1, False), (2, False)])
+
+        listener._on_response(self.channel, *message(3, "t2", redelivered=True))
+        self.assertEqual(self.called, [("t2", 200)])
+
+    def test_batch_redelivery_redoes_follow_up(self):
+        listener = self._listener(BATCH_SIZE=10)
+        self.applied.add("t1")
+        listener._on_batch(
+            self.channel,
+            [message(1, "t1", redelivered=True), message(2, "t2", redelivered=True)],
+        )
+        self.assertEqual(self.called, [("t2", 200)])
+        self.assertEqual(self.followed_up, ["t1"])
+        self.assertEqual(self.channel.acked, [(2, True)])
+
+    def test_corrupt_body_is_dropped(self):
+        listener = self._listener()
+        method, _, _ = message(1, "t1")
+        props = pika.BasicProperties(correlation_id="t1", content_encoding="gzip")
+        listener._on_response(self.channel, method, props, b"not gzip")
+        self.assertEqual(self.called, [])
+        self.assertEqual(self.channel.acked, [(1, False)])
+
+    def test_batch_is_acked_at_once(self):
+        listener = self._listener(BATCH_SIZE=10)
+        listener._on_batch(
+            self.channel,
+            [
+                message(1, "t1"),
+                message(2, "t2", body=b"not json"),
+                message(3, "t3", state=500),
+            ],
+        )
+        # the undecodable response is dropped, but acked with the rest
+        self.assertEqual(self.called, [("t1", 200), ("t3", 500)])
+        self.assertEqual(self.channel.acked, [(3, True)])
+        self.assertEqual(self.channel.nacked, [])
+
+    def test_failed_batch_is_requeued(self):
+        listener = self._listener(BATCH_SIZE=10)
+
+        def fail(responses):
+            raise RuntimeError("Elasticsearch is down")
+
+        listener.assign_batch_callback(fail)
+        listener._on_batch(self.channel, [message(1, "t1"), message(2, "t2")])
+        self.assertEqual(self.channel.acked, [])
+        self.assertEqual(self.channel.nacked, [(2, True)])
+
+        # nothing was remembered as handled, the redelivery is handled again
+        listener.assign_batch_callback(
+            lambda responses: self.called.extend(t for t, _ in responses)
+        )
+        listener._on_batch(
+            self.channel,
+            [message(3, "t1", redelivered=True), message(4, "t2", redelivered=True)],
+        )
+        self.assertEqual(self.called, ["t1", "t2"])
+
+    def test_parallel_callbacks_ack_when_done(self):
+        # as with PARALLEL_CALLBACKS, without its publisher connection
+        listener = self._listener()
+        listener.executor = KeyedExecutor(max_workers=4)
+        listener.connection = SimpleNamespace(
+            add_callback_threadsafe=lambda callback: callback()
+        )
+        started = threading.Event()
+        release = threading.Event()
+
+        def callback(task_id, response):
+            if task_id == "t1":
+                started.set()
+                release.wait(5)
+            self.called.append(task_id)
+
+        listener.assign_callback(callback)
+        listener._on_response(self.channel, *message(1, "t1"))
+        listener._on_response(self.channel, *message(2, "t1", state=500))
+        listener._on_response(self.channel, *message(3, "t2"))
+        self.assertTrue(started.wait(5))
+
+        # t2 is not held up by t1, the second response of t1 waits for the first
+        for _ in range(50):
+            if self.called:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.called, ["t2"])
+        self.assertEqual(self.channel.acked, [(3, False)])
+
+        release.set()
+        listener.executor.shutdown()
+        self.assertEqual(self.called, ["t2", "t1", "t1"])
+        self.assertEqual(self.channel.acked, [(3, False), (1, False), (2, False)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+import unittest
+import urllib.error
+import urllib.request
+
+from dane_server.metrics import CONTENT_TYPE, Registry, start_metrics_server
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_counter(self):
+        counter = self.registry.counter("tasks_total", "Tasks", labels=["key"])
+        counter.inc(key="A")
+        counter.inc(2, key="A")
+        counter.inc(key='say "hi"\n')
+        self.assertEqual(counter.value(key="A"), 3)
+        self.assertEqual(counter.value(key="B"), 0)
+        self.assertEqual(
+            counter.render(),
+            [
+                "# HELP tasks_total Tasks",
+                "# TYPE tasks_total counter",
+                'tasks_total{key="A"} 3.0',
+                'tasks_total{key="say \\"hi\\"\\n"} 1.0',
+            ],
+        )
+
+    def test_labels_must_match(self):
+        counter = self.registry.counter("tasks_total", "Tasks", labels=["key"])
+        with self.assertRaises(ValueError):
+            counter.inc()
+        with self.assertRaises(ValueError):
+            counter.inc(key="A", state=200)
+
+    def test_gauge(self):
+        gauge = self.registry.gauge("held", "Held tasks")
+        gauge.set(5)
+        gauge.inc()
+        gauge.dec(3)
+        self.assertEqual(gauge.value(), 3)
+        self.assertIn("held 3.0", gauge.render())
+
+    def test_histogram(self):
+        histogram = self.registry.histogram("seconds", "Duration", buckets=(1, 5))
+        for value in (0.5, 1, 3, 10):
+            histogram.observe(value)
+        self.assertEqual(histogram.count(), 4)
+        self.assertEqual(
+            histogram.render()[2:],
+            [
+                'seconds_bucket{le="1.0"} 2',
+                'seconds_bucket{le="5.0"} 3',
+                'seconds_bucket{le="+Inf"} 4',
+                "seconds_sum 14.5",
+                "seconds_count 4",
+            ],
+        )
+
+    def test_registry(self):
+        counter = self.registry.counter("b_total", "B")
+        self.assertIs(self.registry.counter("b_total", "B"), counter)
+        with self.assertRaises(ValueError):
+            self.registry.gauge("b_total", "B")
+
+        self.registry.gauge("a", "A").set(1)
+        counter.inc()
+        self.assertEqual(
+            self.registry.render(),
+            "# HELP a A\n# TYPE a gauge\na 1.0\n"
+            "# HELP b_total B\n# TYPE b_total counter\nb_total 1.0\n",
+        )
+
+    def test_metrics_server(self):
+        self.registry.counter("requests_total", "Requests").inc()
+        server = start_metrics_server(0, host="127.0.0.1", registry=self.registry)
+        url = "http://127.0.0.1:{}".format(server.server_address[1])
+        try:
+            with urllib.request.urlopen(url + "/metrics", timeout=5) as response:
+                self.assertEqual(response.headers["Content-Type"], CONTENT_TYPE)
+                self.assertEqual(
+                    response.read().decode("utf-8"), self.registry.render()
+                )
+            with self.assertRaises(urllib.error.HTTPError) as e:
+                urllib.request.urlopen(url + "/other", timeout=5)
+            self.assertEqual(e.exception.code, 404)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,99 @@
+import json
+import os
+import tempfile
+import unittest
+
+from dane_server.outbox import Outbox, OutboxJournal
+
+
+class Config(dict):
+    def __getattr__(self, name):
+        return self[name]
+
+
+class FakeTask:
+    def __init__(self, _id, key="TEST", priority=1):
+        self._id = _id
+        self.key = key
+        self.priority = priority
+
+    def to_json(self):
+        return json.dumps({"_id": self._id, "key": self.key})
+
+
+class FakeDocument:
+    def to_json(self):
+        return json.dumps({"_id": "doc"})
+
+
+class FakePublisher:
+    def __init__(self, fail=()):
+        self.fail = set(fail)
+        self.published = []
+
+    def assign_callback(self, callback):
+        pass
+
+    def publish_encoded_many(self, messages):
+        failed = {}
+        for routing_key, properties, body in messages:
+            if properties.correlation_id in self.fail:
+                failed[properties.correlation_id] = "nack"
+            else:
+                self.published.append(properties.correlation_id)
+        return failed
+
+
+class TestOutbox(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "outbox.sqlite")
+        self.config = Config(
+            RABBITMQ=Config(RESPONSE_QUEUE="response"), DANE_SERVER=Config()
+        )
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def _outbox(self, publisher):
+        # the relay thread is not started, tests call relay() directly
+        return Outbox(self.config, OutboxJournal(self.path), lambda: publisher)
+
+    def test_relay_after_restart(self):
+        outbox = self._outbox(FakePublisher())
+        outbox.publish_many(
+            [("Video.TEST", FakeTask(str(i)), FakeDocument()) for i in range(3)]
+        )
+        self.assertEqual(outbox.journal.stats()[0], 3)
+        outbox.journal.close()
+
+        # a new process replays what the previous one journaled
+        publisher = FakePublisher()
+        outbox = self._outbox(publisher)
+        self.assertEqual(outbox.relay(), 3)
+        self.assertEqual(publisher.published, ["0", "1", "2"])
+        self.assertEqual(outbox.journal.stats()[0], 0)
+
+    def test_unconfirmed_are_retried(self):
+        publisher = FakePublisher(fail=["1"])
+        outbox = self._outbox(publisher)
+        outbox.interval = 0
+        outbox.publish_many(
+            [("Video.TEST", FakeTask(str(i)), FakeDocument()) for i in range(2)]
+        )
+
+        outbox.relay()
+        self.assertEqual(publisher.published, ["0"])
+        self.assertEqual(outbox.journal.stats()[0], 1)
+
+        publisher.fail.clear()
+        outbox.relay()
+        self.assertEqual(publisher.published, ["0", "1"])
+        self.assertEqual(outbox.journal.stats()[0], 0)
+
+    def test_leased_rows_are_not_handed_out_twice(self):
+        journal = OutboxJournal(self.path)
+        outbox = self._outbox(FakePublisher())
+        outbox.publish_many([("Video.TEST", FakeTask("0"), FakeDocument())])
+        self.assertEqual(len(journal.lease("a", 10, 60)), 1)
+        self.assertEqual(journal.lease("b", 10, 60), [])
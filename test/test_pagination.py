@@ -0,0 +1,83 @@
+import unittest
+
+from elasticsearch7 import RequestError
+
+from dane_server.pagination import (
+    CursorPager,
+    InvalidCursorError,
+    decode_cursor,
+    encode_cursor,
+)
+
+
+class FakeES:
+    def __init__(self, hits):
+        self.hits = hits
+        self.bodies = []
+        self.closed = []
+
+    def open_point_in_time(self, index, keep_alive):
+        return {"id": "pit-1"}
+
+    def close_point_in_time(self, body):
+        self.closed.append(body["id"])
+
+    def search(self, body, size, index=None):
+        self.bodies.append(body)
+        after = body.get("search_after", [-1])[0]
+        hits = [h for h in self.hits if h["sort"][0] > after][:size]
+        return {
+            "pit_id": "pit-2",
+            "hits": {"total": {"value": len(self.hits)}, "hits": hits},
+        }
+
+
+class TestCursorPager(unittest.TestCase):
+    def test_cursor_roundtrip(self):
+        state = {"after": [1609459200000, 42], "pit": "abc"}
+        self.assertEqual(decode_cursor(encode_cursor(state)), state)
+        with self.assertRaises(InvalidCursorError):
+            decode_cursor("not a cursor")
+        # forged cursors
+        for state in ({"after": [{"script": 1}]}, {"after": [1], "pit": 5}, []):
+            with self.assertRaises(InvalidCursorError):
+                decode_cursor(encode_cursor(state))
+
+    def test_cursor_rejected_by_elasticsearch(self):
+        es = FakeES([])
+
+        def search(body, size, index=None):
+            raise RequestError(400, "parsing_exception", {})
+
+        es.search = search
+        pager = CursorPager(es, "index")
+        with self.assertRaises(InvalidCursorError):
+            pager.page({"query": {}}, 2, encode_cursor({"after": ["x"]}))
+        # without a cursor it is not the client's fault
+        with self.assertRaises(RequestError):
+            pager.page({"query": {}}, 2)
+
+    def test_pages(self):
+        es = FakeES([{"_id": str(i), "sort": [i]} for i in range(5)])
+        pager = CursorPager(es, "index")
+
+        seen, cursor = [], None
+        while True:
+            hits, total, cursor = pager.page({"query": {}, "from": 10}, 2, cursor)
+            seen.extend(hit["_id"] for hit in hits)
+            if cursor is None:
+                break
+
+        self.assertEqual(seen, ["0", "1", "2", "3", "4"])
+        self.assertEqual(total, 5)
+        self.assertNotIn("from", es.bodies[0])
+        # later pages continue on the point in time returned by the last one
+        self.assertEqual(es.bodies[1]["pit"]["id"], "pit-2")
+        self.assertEqual(es.closed, ["pit-2"])
+
+    def test_walk_closes_abandoned_point_in_time(self):
+        es = FakeES([{"_id": str(i), "sort": [i]} for i in range(5)])
+        hits = CursorPager(es, "index").walk({"query": {}}, 2)
+        self.assertEqual(next(hits)["_id"], "0")
+        hits.close()
+        self.assertEqual(es.closed, ["pit-2"])
@@ -0,0 +1,173 @@
+import os
+import signal
+import tempfile
+import time
+import unittest
+import urllib.request
+
+from dane_server.prefork import PreforkServer, available_cpus
+
+
+def app_factory():
+    def app(environ, start_response):
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return [str(os.getpid()).encode("ascii")]
+
+    return app
+
+
+def start_master(server):
+    """Runs the master in a child process, returns its pid"""
+    server.bind()
+    master = os.fork()
+    if master == 0:
+        code = 1
+        try:
+            server.run()
+            code = 0
+        finally:
+            os._exit(code)
+    server.socket.close()
+    return master
+
+
+def stop_master(master):
+    try:
+        os.kill(master, signal.SIGTERM)
+        _, status = os.waitpid(master, 0)
+        return os.waitstatus_to_exitcode(status)
+    except (ProcessLookupError, ChildProcessError):
+        return None
+
+
+def get_pid(port):
+    url = "http://127.0.0.1:{}/".format(port)
+    for _ in range(50):
+        try:
+            with urllib.request.urlopen(url, timeout=5) as response:
+                return int(response.read())
+        except OSError:
+            # e.g. a worker is being replaced
+            time.sleep(0.1)
+    raise AssertionError("No response")
+
+
+class TestPreforkServer(unittest.TestCase):
+    def setUp(self):
+        self.server = PreforkServer(
+            app_factory,
+            host="127.0.0.1",
+            port=0,
+            workers=2,
+            threads=2,
+            max_requests=3,
+            graceful_timeout=5,
+        )
+        self.master = start_master(self.server)
+
+    def tearDown(self):
+        stop_master(self.master)
+
+    def _get(self):
+        return get_pid(self.server.port)
+
+    def test_served_by_forked_workers(self):
+        pids = {self._get() for _ in range(4)}
+        self.assertNotIn(os.getpid(), pids)
+        self.assertNotIn(self.master, pids)
+
+    def test_workers_are_recycled(self):
+        pids = [self._get() for _ in range(20)]
+        # 2 workers of at most 3 requests each cannot serve 20 requests
+        self.assertGreater(len(set(pids)), 2)
+        for pid in set(pids):
+            self.assertLessEqual(pids.count(pid), 3)
+
+    def test_graceful_stop(self):
+        self._get()
+        self.assertEqual(stop_master(self.master), 0)
+
+
+class TestBackgroundWork(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        # the hooks run in the workers, they share these files with the test
+        self.busy_flag = os.path.join(self.tmp.name, "busy")
+        self.exited = os.path.join(self.tmp.name, "exited")
+        open(self.busy_flag, "w").close()
+
+        def on_exit():
+            with open(self.exited, "a") as f:
+                f.write("{}\n".format(os.getpid()))
+
+        self.server = PreforkServer(
+            app_factory,
+            host="127.0.0.1",
+            port=0,
+            workers=1,
+            threads=1,
+            max_requests=1,
+            graceful_timeout=2,
+            busy=lambda: os.path.exists(self.busy_flag),
+            on_exit=on_exit,
+        )
+        self.master = start_master(self.server)
+
+    def tearDown(self):
+        stop_master(self.master)
+        self.tmp.cleanup()
+
+    def _exited(self):
+        if not os.path.exists(self.exited):
+            return []
+        with open(self.exited) as f:
+            return [int(line) for line in f]
+
+    def test_busy_worker_is_not_recycled(self):
+        pids = {get_pid(self.server.port) for _ in range(3)}
+        self.assertEqual(len(pids), 1)
+
+        # the first request after the work is done retires the worker
+        os.unlink(self.busy_flag)
+        pid = get_pid(self.server.port)
+        self.assertNotEqual(get_pid(self.server.port), pid)
+        # its replacement retires after one request as well
+        self.assertEqual(self._exited()[0], pid)
+
+    def test_stop_waits_for_work_until_timeout(self):
+        pid = get_pid(self.server.port)
+        started = time.monotonic()
+        self.assertEqual(stop_master(self.master), 0)
+        # the worker waited for the work, and was not killed by the master
+        self.assertGreater(time.monotonic() - started, 0.5)
+        self.assertEqual(self._exited(), [pid])
+
+
+@unittest.skipUnless(hasattr(os, "sched_getaffinity"), "Linux only")
+class TestAvailableCpus(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cpus = len(os.sched_getaffinity(0))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _write(self, name, content):
+        path = os.path.join(self.tmp.name, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(content)
+
+    def test_without_limit(self):
+        self.assertEqual(available_cpus(self.tmp.name), self.cpus)
+        self._write("cpu.max", "max 100000\n")
+        self.assertEqual(available_cpus(self.tmp.name), self.cpus)
+
+    def test_cgroup_v2_limit(self):
+        self._write("cpu.max", "50000 100000\n")
+        self.assertEqual(available_cpus(self.tmp.name), 1)
+
+    def test_cgroup_v1_limit(self):
+        self._write("cpu/cpu.cfs_quota_us", "150000\n")
+        self._write("cpu/cpu.cfs_period_us", "100000\n")
+        self.assertEqual(available_cpus(self.tmp.name), min(self.cpus, 2))
@@ -0,0 +1,150 @@
+import time
+import unittest
+from types import SimpleNamespace
+
+import pika
+from dane.state import ProcState
+
+from dane_server.RabbitMQPublisher import RabbitMQPublisher
+
+
+class Config(dict):
+    def __getattr__(self, name):
+        return self[name]
+
+
+class OfflinePublisher(RabbitMQPublisher):
+    def connect(self):
+        pass
+
+
+class FakeChannel:
+    """The asynchronous channel of a batch publish"""
+
+    def __init__(self, closed_at=None):
+        self.is_open = True
+        self._impl = self
+        self.published = []
+        self.closed_at = closed_at
+
+    def basic_publish(self, exchange, routing_key, body, properties, mandatory):
+        if len(self.published) == self.closed_at:
+            raise pika.exceptions.ChannelClosed(406, "PRECONDITION_FAILED")
+        self.published.append(properties.correlation_id)
+
+
+class FakeConnection:
+    """Confirms (or rejects, or returns) what was published when processing
+    data events, unless the broker is `stuck`
+    """
+
+    def __init__(self, publisher, channel, nack=(), unroutable=(), stuck=False):
+        self.publisher = publisher
+        self.channel = channel
+        self.nack = set(nack)
+        self.unroutable = set(unroutable)
+        self.stuck = stuck
+        self.confirmed = 0
+        self.max_unconfirmed = 0
+
+    def process_data_events(self, time_limit=0):
+        unconfirmed = len(self.channel.published) - self.confirmed
+        self.max_unconfirmed = max(self.max_unconfirmed, unconfirmed)
+        if self.stuck:
+            time.sleep(min(time_limit, 0.01))
+            return
+        while self.confirmed < len(self.channel.published):
+            task_id = self.channel.published[self.confirmed]
+            self.confirmed += 1
+            if task_id in self.unroutable:
+                self.publisher._on_batch_return(
+                    self.channel,
+                    None,
+                    pika.BasicProperties(correlation_id=task_id),
+                    b"",
+                )
+            method = (
+                pika.spec.Basic.Nack if task_id in self.nack else pika.spec.Basic.Ack
+            )
+            self.publisher._on_batch_confirm(
+                SimpleNamespace(method=method(delivery_tag=self.confirmed))
+            )
+
+
+def messages(n):
+    return [
+        ("Video.TEST", pika.BasicProperties(correlation_id="t{}".format(i)), b"{}")
+        for i in range(n)
+    ]
+
+
+class TestRabbitMQPublisher(unittest.TestCase):
+    def _publisher(self, window=4, closed_at=None, **kwargs):
+        config = Config(
+            RABBITMQ=Config(EXCHANGE="DANE-exchange", RESPONSE_QUEUE="response"),
+            DANE_SERVER=Config(QUEUE=Config(CONFIRM_WINDOW=window)),
+        )
+        publisher = OfflinePublisher(config)
+        self.responses = []
+        publisher.assign_callback(
+            lambda task_id, response: self.responses.append((task_id, response))
+        )
+        publisher._batch_channel = FakeChannel(closed_at)
+        publisher._batch_tag = 0
+        publisher.connection = FakeConnection(
+            publisher, publisher._batch_channel, **kwargs
+        )
+        return publisher
+
+    def test_window(self):
+        publisher = self._publisher(window=4)
+        self.assertEqual(publisher.publish_encoded_many(messages(10)), {})
+        self.assertEqual(len(publisher._batch_channel.published), 10)
+        self.assertLessEqual(publisher.connection.max_unconfirmed, 4)
+
+    def test_rejected_and_unroutable(self):
+        publisher = self._publisher(nack=["t1"], unroutable=["t2"])
+        failed = publisher.publish_encoded_many(messages(3))
+        self.assertEqual(failed, {"t1": "Message was rejected by the broker"})
+        self.assertEqual(
+            self.responses,
+            [
+                (
+                    "t2",
+                    {
+                        "state": ProcState.NO_ROUTE_TO_QUEUE.value,
+                        "message": "Unroutable task",
+                    },
+                )
+            ],
+        )
+
+    def test_window_timeout(self):
+        publisher = self._publisher(window=2, stuck=True)
+        started = time.monotonic()
+        failed = publisher.publish_encoded_many(messages(5), timeout=0.2)
+        self.assertLess(time.monotonic() - started, 5)
+        # the unconfirmed and the unsent messages failed
+        self.assertEqual(sorted(failed), ["t0", "t1", "t2", "t3", "t4"])
+        self.assertEqual(publisher._batch_channel, None)
+
+    def test_channel_closed(self):
+        publisher = self._publisher(window=2, closed_at=3)
+        failed = publisher.publish_encoded_many(messages(5))
+        # t2 was sent, but not confirmed
+        self.assertEqual(sorted(failed), ["t2", "t3", "t4"])
+
+    def test_last_confirms_timeout(self):
+        publisher = self._publisher(window=10, stuck=True)
+        failed = publisher.publish_encoded_many(messages(2), timeout=0.1)
+        self.assertEqual(
+            failed,
+            {
+                "t0": "No publisher confirm within 0.1s",
+                "t1": "No publisher confirm within 0.1s",
+            },
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
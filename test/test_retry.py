@@ -0,0 +1,212 @@
+import copy
+import unittest
+from types import SimpleNamespace
+
+import pika
+from dane.state import ProcState
+
+from dane_server.RabbitMQPublisher import message_ttl
+from dane_server.retry import ATTEMPT_HEADER, DELAY_HEADER, RetryPolicy, RetryRelay
+
+
+class Config(dict):
+    def __getattr__(self, name):
+        return self[name]
+
+
+class OfflineRelay(RetryRelay):
+    def connect(self):
+        pass
+
+    def _put_policy(self, name, policy):
+        self.policies[name] = policy
+
+    def _delete_policy(self, name):
+        self.policies.pop(name, None)
+
+
+class FakeChannel:
+    def __init__(self, unroutable=False):
+        self.unroutable = unroutable
+        self.published = []
+        self.properties = []
+        self.acked = []
+
+    def basic_publish(self, exchange, routing_key, properties, mandatory, body):
+        if self.unroutable:
+            raise pika.exceptions.UnroutableError([])
+        self.published.append((exchange, routing_key, dict(properties.headers)))
+        self.properties.append(copy.deepcopy(properties))
+
+    def basic_ack(self, delivery_tag):
+        self.acked.append(delivery_tag)
+
+
+def death(queue, reason):
+    return {"queue": queue, "reason": reason, "count": 1, "exchange": ""}
+
+
+def dead_letter(props, queue, reason):
+    """What RabbitMQ does to a message it dead-letters"""
+    props = copy.deepcopy(props)
+    props.headers = dict(props.headers or {})
+    props.headers["x-death"] = [death(queue, reason)] + props.headers.get("x-death", [])
+    props.expiration = None
+    return props
+
+
+def ttl(props, policy):
+    """The TTL (ms) of a message in a queue: the lower of its expiration and
+    the message-ttl of the queue
+    """
+    ttls = [int(props.expiration)] if props.expiration else []
+    if "message-ttl" in policy["definition"]:
+        ttls.append(policy["definition"]["message-ttl"])
+    return min(ttls, default=None)
+
+
+class TestRetryPolicy(unittest.TestCase):
+    def test_delays(self):
+        policy = RetryPolicy(delays=(60, 10), max_attempts=2, key_attempts={"A": 5})
+        self.assertEqual([policy.delay(n) for n in (1, 2, 3)], [10, 60, 60])
+        self.assertEqual(policy.attempts_for("A"), 5)
+        self.assertEqual(policy.attempts_for("B"), 2)
+
+
+class TestRetryRelay(unittest.TestCase):
+    def setUp(self):
+        config = Config(
+            RABBITMQ=Config(EXCHANGE="DANE-exchange", RESPONSE_QUEUE="response"),
+            DANE_SERVER=Config(),
+        )
+        self.relay = OfflineRelay(config, RetryPolicy(delays=(10, 60), max_attempts=2))
+        self.relay.policies = {}
+        self.relay.channel = FakeChannel()
+        self.relay.pub_channel = FakeChannel()
+        self.given_up = []
+        self.relay.assign_callback(
+            lambda task_id, response: self.given_up.append((task_id, response))
+        )
+
+    def _dead(self, headers, tag=1):
+        method = SimpleNamespace(delivery_tag=tag, routing_key="Video.ASR")
+        props = pika.BasicProperties(correlation_id="t1", headers=headers)
+        self.relay._on_dead(method, props, b"{}")
+        return self.relay.pub_channel.published
+
+    def test_reason(self):
+        delay_queue = self.relay.delay_queue(10)
+        reason = self.relay.reason
+        self.assertEqual(reason({}), "unroutable")
+        self.assertEqual(reason({"x-death": [death("ASR", "rejected")]}), "rejected")
+        self.assertEqual(reason({"x-death": [death("ASR", "expired")]}), "expired")
+        # delayed, then unroutable: the alternate exchange adds no x-death
+        self.assertEqual(
+            reason({"x-death": [death(delay_queue, "expired")]}), "unroutable"
+        )
+        self.assertEqual(
+            reason(
+                {"x-death": [death("ASR", "rejected"), death(delay_queue, "expired")]}
+            ),
+            "rejected",
+        )
+        self.assertEqual(
+            reason(
+                {
+                    "x-last-death-queue": delay_queue,
+                    "x-last-death-reason": "expired",
+                    "x-death": [death("ASR", "rejected")],
+                }
+            ),
+            "unroutable",
+        )
+
+    def test_retried_with_backoff(self):
+        published = self._dead({"x-death": [death("ASR", "rejected")]})
+        self.assertEqual(published[0][0], self.relay.retry_exchange)
+        self.assertEqual(published[0][1], "Video.ASR")
+        self.assertEqual(published[0][2][ATTEMPT_HEADER], 1)
+        self.assertEqual(published[0][2][DELAY_HEADER], "10")
+
+        headers = dict(published[0][2])
+        headers["x-death"] = [death("ASR", "rejected"), death("x", "expired")]
+        published = self._dead(headers, tag=2)
+        self.assertEqual(published[1][2][ATTEMPT_HEADER], 2)
+        self.assertEqual(published[1][2][DELAY_HEADER], "60")
+        self.assertEqual(self.given_up, [])
+        self.assertEqual(self.relay.channel.acked, [1, 2])
+
+    def test_give_up(self):
+        self._dead({ATTEMPT_HEADER: 2, "x-death": [death("ASR", "expired")]})
+        self.assertEqual(
+            self.given_up,
+            [
+                (
+                    "t1",
+                    {
+                        "state": ProcState.ERROR.value,
+                        "message": "Task was expired (after 2 retries)",
+                    },
+                )
+            ],
+        )
+        self.assertEqual(self.relay.channel.acked, [1])
+
+    def test_give_up_unroutable_after_delay(self):
+        delay_queue = self.relay.delay_queue(60)
+        self._dead({ATTEMPT_HEADER: 2, "x-death": [death(delay_queue, "expired")]})
+        self.assertEqual(
+            self.given_up[0][1]["state"], ProcState.NO_ROUTE_TO_QUEUE.value
+        )
+
+    def test_give_up_without_delay_queue(self):
+        self.relay.pub_channel = FakeChannel(unroutable=True)
+        self._dead({"x-death": [death("ASR", "rejected")]})
+        self.assertEqual(self.given_up[0][1]["message"], "Task was rejected")
+        self.assertEqual(self.relay.channel.acked, [1])
+
+
+class TestMessageTTL(unittest.TestCase):
+    def _config(self, **retry):
+        return Config(
+            RABBITMQ=Config(
+                EXCHANGE="DANE-exchange", RESPONSE_QUEUE="response", MANAGEMENT_HOST=""
+            ),
+            DANE_SERVER=Config(RETRY=Config(**retry)),
+        )
+
+    def test_only_with_retries(self):
+        self.assertIsNone(message_ttl(self._config(MESSAGE_TTL=60)))
+        self.assertEqual(message_ttl(self._config(ENABLED=True, MESSAGE_TTL=60)), 60)
+
+    def test_expires_after_each_retry(self):
+        relay = OfflineRelay(
+            self._config(ENABLED=True, MESSAGE_TTL=60),
+            RetryPolicy(delays=(10,), max_attempts=2),
+        )
+        relay.policies = {}
+        relay.apply_policies()
+        relay.channel = FakeChannel()
+        relay.pub_channel = FakeChannel()
+        worker_queue = relay.policies["DANE-exchange-retry-queues"]
+        delay_queue = {"definition": {"message-ttl": 10000}}
+
+        props = relay.properties(SimpleNamespace(_id="t1", priority=0))
+        for attempt in (1, 2):
+            self.assertEqual(ttl(props, worker_queue), 60000)
+            props = dead_letter(props, "ASR", "expired")
+            relay._on_dead(
+                SimpleNamespace(delivery_tag=attempt, routing_key="Video.ASR"),
+                props,
+                b"{}",
+            )
+            props = relay.pub_channel.properties[-1]
+            self.assertEqual(props.headers[ATTEMPT_HEADER], attempt)
+            # the delay is not cut short by the task's TTL
+            self.assertEqual(ttl(props, delay_queue), 10000)
+            props = dead_letter(props, relay.delay_queue(10), "expired")
+        self.assertEqual(relay.channel.acked, [1, 2])
+
+
+if __name__ == "__main__":
+    unittest.main()
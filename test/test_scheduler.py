@@ -0,0 +1,158 @@
+import logging
+import tempfile
+import time
+import unittest
+
+from dane_server.admission import AdmissionController
+from dane_server.leases import FileLeaseStore, PartitionLeases
+from dane_server.server import TaskScheduler
+
+
+class FakeHandler:
+    def __init__(self, pages):
+        self.pages = pages
+        self.since = []
+        self.marked = []
+
+    def markTasks(self, task_ids, message):
+        self.marked.extend(task_ids)
+
+    def getUnfinishedSince(self, since=None, only_runnable=True, size=1000):
+        self.since.append(since)
+        return self.pages.pop(0) if self.pages else []
+
+
+class FlakyLeaseStore(FileLeaseStore):
+    down = False
+
+    def heartbeat(self, owner, ttl):
+        if self.down:
+            raise ConnectionError("lease store is down")
+        super().heartbeat(owner, ttl)
+
+
+class TestTaskScheduler(unittest.TestCase):
+    def _scheduler(self, handler, **kwargs):
+        scheduler = TaskScheduler(
+            handler=handler,
+            logger=logging.getLogger("DANE"),
+            interval=8,
+            min_interval=1,
+            incremental=True,
+            **kwargs,
+        )
+        scheduler._last_full_rescan = float("inf")  # never due in these tests
+        return scheduler
+
+    def test_watermark_advances_and_dedupes(self):
+        t1 = {"_id": "a", "key": "TEST", "updated_at": "2022-01-01T10:00:00"}
+        t2 = {"_id": "b", "key": "TEST", "updated_at": "2022-01-01T10:00:05"}
+        handler = FakeHandler([[t1, t2], [t2]])
+        scheduler = self._scheduler(handler)
+
+        self.assertEqual(scheduler._fetch_changed(), [t1, t2])
+        self.assertEqual(scheduler.watermark, "2022-01-01T10:00:05")
+
+        # the lagged window returns t2 again, but it is unchanged
+        self.assertEqual(scheduler._fetch_changed(), [])
+        self.assertEqual(handler.since, [None, "2022-01-01T10:00:03"])
+
+    def test_stalled_watermark_skips_ahead(self):
+        t1 = {"_id": "a", "key": "TEST", "updated_at": "2022-01-01T10:00:00"}
+        handler = FakeHandler([[t1], [t1]])
+        scheduler = self._scheduler(handler, batch_size=1)
+
+        scheduler._fetch_changed()
+        scheduler._fetch_changed()
+        self.assertEqual(scheduler.watermark, "2022-01-01T10:00:01")
+
+    def test_adaptive_interval(self):
+        scheduler = self._scheduler(FakeHandler([]))
+        self.assertEqual(scheduler._next_interval(8, 3), 1)
+        self.assertEqual(scheduler._next_interval(1, 0), 2)
+        self.assertEqual(scheduler._next_interval(4, 0), 8)
+        self.assertEqual(scheduler._next_interval(8, 0), 8)
+
+    def test_urgency_orders_by_priority_then_age(self):
+        tasks = [
+            {"_id": "a", "priority": 1, "created_at": "2022-01-01T10:00:00"},
+            {"_id": "b", "priority": 5, "created_at": "2022-01-02T10:00:00"},
+            {"_id": "c", "priority": 5, "created_at": "2022-01-01T10:00:00"},
+        ]
+        ordered = sorted(tasks, key=TaskScheduler.urgency)
+        self.assertEqual([t["_id"] for t in ordered], ["c", "b", "a"])
+
+    def test_admission_holds_tasks_until_queue_drains(self):
+        class FakeMonitor:
+            depth = 9
+
+            def update(self):
+                pass
+
+            def stats(self, task_key):
+                return (self.depth, 1)
+
+        monitor = FakeMonitor()
+        handler = FakeHandler([])
+        scheduler = self._scheduler(
+            handler, admission=AdmissionController(monitor, high_water=10)
+        )
+        tasks = [{"_id": str(i), "key": "TEST", "priority": 1} for i in range(3)]
+
+        self.assertEqual(len(scheduler._admit(tasks)), 1)
+        self.assertEqual(sorted(handler.marked), ["1", "2"])
+
+        # held tasks are offered again once the queue has drained
+        monitor.depth = 0
+        self.assertEqual(len(scheduler._admit([])), 2)
+        self.assertEqual(scheduler._held, {})
+
+
+class TestPartitionLeases(unittest.TestCase):
+    def test_partitions_are_shared_and_taken_over(self):
+        store = FileLeaseStore(tempfile.mkdtemp())
+        a = PartitionLeases(store, 4, owner="a", ttl=0.2)
+        b = PartitionLeases(store, 4, owner="b", ttl=60)
+
+        a.refresh()
+        self.assertEqual(len(a.held), 4)
+
+        # b joins, a gives up half on its next renewal and b picks them up
+        b.refresh()
+        a.refresh()
+        b.refresh()
+        self.assertEqual(len(a.held), 2)
+        self.assertEqual(len(b.held), 2)
+        self.assertEqual(a.held | b.held, frozenset(range(4)))
+
+        # a dies and its leases expire, b takes over everything
+        time.sleep(0.3)
+        b.refresh()
+        self.assertEqual(b.held, frozenset(range(4)))
+
+    def test_partitions_are_dropped_when_renewal_fails(self):
+        store = FlakyLeaseStore(tempfile.mkdtemp())
+        leases = PartitionLeases(store, 4, owner="a", ttl=0.3)
+        leases.start()
+        try:
+            time.sleep(0.05)
+            self.assertEqual(leases.held, frozenset(range(4)))
+            generation = leases.generation
+
+            # while the store is down the leases expire, another instance
+            # may take the partitions over
+            store.down = True
+            time.sleep(0.4)
+            self.assertEqual(leases.held, frozenset())
+            self.assertGreater(leases.generation, generation)
+
+            store.down = False
+            time.sleep(0.2)
+            self.assertEqual(leases.held, frozenset(range(4)))
+        finally:
+            leases.stop()
+            leases.join()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,37 @@
+import unittest
+
+from dane_server.worker_stats import WorkerStatsCollector
+
+
+class Config:
+    class RABBITMQ:
+        USER = "guest"
+        PASSWORD = "guest"
+
+
+class TestWorkerStatsCollector(unittest.TestCase):
+    def test_rates(self):
+        collector = WorkerStatsCollector(
+            Config, samples=2, exclude=["DANE-response-queue"]
+        )
+        for t, published, delivered, usage in [
+            (0, 0, 0, 0.2),
+            (10, 50, 20, 0.4),
+            (20, 100, 60, 0.6),
+        ]:
+            queue = {
+                "name": "ASR",
+                "messages": published - delivered,
+                "consumers": 2,
+                "consumer_utilisation": usage,
+                "message_stats": {"publish": published, "deliver_get": delivered},
+            }
+            collector.record([queue, {"name": "DANE-response-queue"}], t)
+
+        (worker,) = collector.workers()
+        # only the last two samples are kept
+        self.assertEqual(worker["rate_in"], 5.0)
+        self.assertEqual(worker["rate_out"], 4.0)
+        self.assertAlmostEqual(worker["utilisation"], 0.5)
+        self.assertEqual(worker["in_queue"], 40)
+        self.assertEqual(worker["active_workers"], 2)